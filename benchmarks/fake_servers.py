@@ -0,0 +1,343 @@
+"""In-process stand-ins for the Withings, GitHub and Garmin endpoints.
+
+Example:
+    with FakeServer(measuregrps=make_measuregrps(1000), page_size=200) as srv:
+        os.environ.update(srv.environ())
+        sync(WithingsAccount(), args)
+        print(srv.calls)
+
+The Withings and GitHub clients are pointed at the server through their
+base URL variables. Garmin Connect has no such setting, while the server
+runs, garth.Client is replaced by FakeGarminClient.
+"""
+import base64
+import json
+import os
+import random
+import threading
+import time
+
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlsplit
+
+STATUS_TOO_MANY_REQUESTS = 601
+
+
+class FakeGarminClient:
+    """Stand-in for garth.Client sending its requests to a FakeServer"""
+
+    def __init__(self, url):
+        self.url = url
+
+    def login(self, email, password):
+        import requests
+
+        response = requests.post(
+            self.url + "/sso/login", data={"email": email}
+        )
+        response.raise_for_status()
+
+    def upload(self, fp):
+        import requests
+
+        response = requests.post(
+            self.url + "/upload-service/upload", files={"file": fp}
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def connectapi(self, path):
+        import requests
+
+        response = requests.get(self.url + path)
+        response.raise_for_status()
+        return response.json()
+
+
+class FakeServer:
+    """Serve Withings oauth2/getmeas, GitHub secrets and Garmin Connect
+
+    latency: seconds added to every request
+    error_rate: share of requests answered with HTTP 500
+    rate_limit: max Withings requests per second before status 601
+    retry_after: Retry-After seconds sent with the rate limited replies
+    page_size: getmeas groups per page, None for a single page
+    existing: (record type, UTC timestamp) already on Garmin Connect"""
+
+    def __init__(
+        self,
+        measuregrps=(),
+        height=1.8,
+        latency=0.0,
+        error_rate=0.0,
+        rate_limit=None,
+        page_size=None,
+        retry_after=None,
+        existing=(),
+        seed=0,
+    ):
+        self.measuregrps = sorted(measuregrps, key=lambda g: g["date"])
+        self.height = height
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.page_size = page_size
+        self.retry_after = retry_after
+        self.existing = list(existing)
+        self.random = random.Random(seed)
+        self.public_key = base64.b64encode(os.urandom(32)).decode()
+
+        self.calls = Counter()
+        self.secrets = {}
+        self.uploads = []
+        self._lock = threading.Lock()
+        self._window = (0, 0)  # second, requests in that second
+        self._tokens = 0
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        self._thread = None
+        self._garmin = mock.patch(
+            "garth.Client", lambda: FakeGarminClient(self.url)
+        )
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def environ(self):
+        """environment pointing the sync at this server"""
+        return {
+            "WITHINGS_API_URL": self.url,
+            "GITHUB_API_URL": self.url,
+            "WITHINGS_CALLBACK_URL": "http://localhost/callback",
+            "WITHINGS_CLIENT_ID": "client",
+            "WITHINGS_CONSUMER_SECRET": "secret",
+            "WITHINGS_ACCESS_TOKEN": "access",
+            "WITHINGS_AUTH_CODE": "code",
+            "WITHINGS_REFRESH_TOKEN": "refresh",
+            "GH_TOKEN": "token",
+            "GH_REPOSITORY": "owner/repo",
+        }
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.httpd.serve_forever,
+            kwargs={"poll_interval": 0.05},
+            daemon=True,
+        )
+        self._thread.start()
+        self._garmin.start()
+        return self
+
+    def stop(self):
+        self._garmin.stop()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def rate_limited(self):
+        """count a Withings request, tell if it exceeds the rate limit"""
+        if self.rate_limit is None:
+            return False
+        with self._lock:
+            second = int(time.time())
+            start, count = self._window
+            count = count + 1 if second == start else 1
+            self._window = (second, count)
+            return count > self.rate_limit
+
+    def failing(self):
+        with self._lock:
+            return self.random.random() < self.error_rate
+
+    def oauth2(self, form):
+        with self._lock:
+            self._tokens += 1
+            n = self._tokens
+        return {
+            "status": 0,
+            "body": {
+                "userid": "1",
+                "access_token": f"access-{n}",
+                "refresh_token": f"refresh-{n}",
+                "expires_in": 10800,
+                "scope": "user.metrics",
+                "token_type": "Bearer",
+            },
+        }
+
+    def getmeas(self, form):
+        if "meastype" in form:
+            date = self.measuregrps[0]["date"] if self.measuregrps else 0
+            measuregrps = [
+                {
+                    "grpid": 0,
+                    "date": date,
+                    "category": 1,
+                    "measures": [
+                        {"type": 4, "value": int(self.height * 100), "unit": -2}
+                    ],
+                }
+            ]
+        else:
+            start = int(form.get("startdate", 0))
+            end = int(form.get("enddate", 2**32))
+            measuregrps = [
+                g for g in self.measuregrps if start <= g["date"] <= end
+            ]
+        offset = int(form.get("offset", 0))
+        more = 0
+        if self.page_size is not None:
+            more = int(offset + self.page_size < len(measuregrps))
+            measuregrps = measuregrps[offset : offset + self.page_size]
+        return {
+            "status": 0,
+            "body": {
+                "updatetime": int(time.time()),
+                "timezone": "UTC",
+                "measuregrps": measuregrps,
+                "more": more,
+                "offset": offset + len(measuregrps) if more else 0,
+            },
+        }
+
+    def existing_range(self, kind, path):
+        """get the `existing` records of a kind within the days of a Garmin
+        range path"""
+        start, end = path.split("/")[-2:]
+        first = time.mktime(time.strptime(start, "%Y-%m-%d"))
+        last = time.mktime(time.strptime(end, "%Y-%m-%d")) + 86399
+        return [
+            timestamp
+            for record_type, timestamp in self.existing
+            if record_type == kind and first <= timestamp <= last
+        ]
+
+    def weight_range(self, path):
+        return {
+            "dailyWeightSummaries": [
+                {
+                    "allWeightMetrics": [
+                        {"timestampGMT": timestamp * 1000}
+                        for timestamp in self.existing_range("weight", path)
+                    ]
+                }
+            ]
+        }
+
+    def blood_pressure_range(self, path):
+        return {
+            "measurementSummaries": [
+                {
+                    "measurements": [
+                        {
+                            "measurementTimestampGMT": datetime.fromtimestamp(
+                                timestamp, timezone.utc
+                            )
+                            .replace(tzinfo=None)
+                            .isoformat()
+                        }
+                        for timestamp in self.existing_range(
+                            "blood_pressure", path
+                        )
+                    ]
+                }
+            ]
+        }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, code, payload=None, headers=None):
+        body = json.dumps(payload).encode() if payload is not None else b""
+        self.send_response(code)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _dispatch(self, method):
+        fake = self.server.fake
+        path = urlsplit(self.path).path
+        body = self._body()
+        fake.calls[f"{method} {_endpoint(path)}"] += 1
+
+        if fake.latency:
+            time.sleep(fake.latency)
+        if fake.failing():
+            return self._reply(500, {"error": "injected failure"})
+
+        if path in ("/v2/oauth2", "/measure"):
+            if fake.rate_limited():
+                headers = None
+                if fake.retry_after is not None:
+                    headers = {"Retry-After": str(fake.retry_after)}
+                return self._reply(
+                    200, {"status": STATUS_TOO_MANY_REQUESTS}, headers
+                )
+            form = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+            if path == "/v2/oauth2":
+                return self._reply(200, fake.oauth2(form))
+            return self._reply(200, fake.getmeas(form))
+
+        if path.endswith("/actions/secrets/public-key") and method == "GET":
+            return self._reply(200, {"key": fake.public_key, "key_id": "1"})
+        if "/actions/secrets/" in path and method == "PUT":
+            name = path.rsplit("/", 1)[1]
+            with fake._lock:
+                fake.secrets[name] = json.loads(body)["encrypted_value"]
+            return self._reply(204)
+
+        if path == "/sso/login" and method == "POST":
+            return self._reply(200, {})
+        if path == "/upload-service/upload" and method == "POST":
+            with fake._lock:
+                fake.uploads.append(body)
+            return self._reply(201, {"detailedImportResult": {}})
+        if path.startswith("/weight-service/weight/range/"):
+            return self._reply(200, fake.weight_range(path))
+        if path.startswith("/bloodpressure-service/bloodpressure/range/"):
+            return self._reply(200, fake.blood_pressure_range(path))
+
+        return self._reply(404, {"error": "not found"})
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_PUT(self):
+        self._dispatch("PUT")
+
+
+def _endpoint(path):
+    """collapse secret names and dates so call counts are per endpoint"""
+    if "/actions/secrets/" in path and not path.endswith("/public-key"):
+        return "/actions/secrets/{name}"
+    if "/actions/secrets/" in path:
+        return "/actions/secrets/public-key"
+    if "/range/" in path:
+        return path.split("/range/")[0] + "/range"
+    return path
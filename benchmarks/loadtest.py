@@ -0,0 +1,165 @@
+"""Load test of the sync pipeline with many concurrent synthetic accounts.
+
+Every account runs a full sync (token refresh, secret update, height and
+measurement fetch, prepare, FIT encoding and upload) against the stand-in
+servers of fake_servers.py.
+
+Usage:
+    python benchmarks/loadtest.py --accounts 200 --concurrency 32 \\
+        --groups 1000 --latency 0.05 --error-rate 0.01 --output load.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import statistics
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from concurrency import limits  # noqa: E402
+from fake_servers import FakeServer  # noqa: E402
+from payloads import make_measuregrps  # noqa: E402
+from run import git_revision, make_args  # noqa: E402
+from withings import WithingsAccount  # noqa: E402
+from sync import sync  # noqa: E402
+
+
+def sync_account(index, environ, args):
+    """sync one synthetic account, return (seconds, error or None)"""
+    environ = dict(environ, WITHINGS_USER_ID=f"load-{index}")
+    start = time.perf_counter()
+    try:
+        sync(WithingsAccount(environ=environ), args)
+    except Exception as ex:
+        return time.perf_counter() - start, f"{type(ex).__name__}: {ex}"
+    return time.perf_counter() - start, None
+
+
+def percentiles(timings):
+    """get the p50, p95 and p99 of the timings"""
+    if len(timings) < 2:
+        value = timings[0] if timings else None
+        return {"p50": value, "p95": value, "p99": value}
+    cuts = statistics.quantiles(timings, n=100, method="inclusive")
+    return {"p50": cuts[49], "p95": cuts[94], "p99": cuts[98]}
+
+
+def peak_memory_mb():
+    """get the peak resident memory of this process in MiB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def run(args):
+    """sync args.accounts accounts, return the load test results"""
+    measuregrps = make_measuregrps(args.groups)
+    server = FakeServer(
+        measuregrps=measuregrps,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        rate_limit=args.rate_limit,
+        page_size=args.page_size,
+    ).start()
+    try:
+        environ = server.environ()
+        sync_args = make_args(measuregrps)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            outcomes = list(
+                executor.map(
+                    lambda index: sync_account(index, environ, sync_args),
+                    range(args.accounts),
+                )
+            )
+        duration = time.perf_counter() - start
+    finally:
+        server.stop()
+
+    timings = [seconds for seconds, error in outcomes if error is None]
+    errors = [error for _, error in outcomes if error is not None]
+    return {
+        "accounts": args.accounts,
+        "succeeded": len(timings),
+        "failed": len(errors),
+        "errors": sorted(set(errors))[:10],
+        "duration": duration,
+        "accounts_per_second": args.accounts / duration,
+        "latency": percentiles(timings),
+        "peak_memory_mb": peak_memory_mb(),
+        "api_calls": dict(server.calls),
+        "uploads": len(server.uploads),
+        "concurrency_limits": limits(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--accounts", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument(
+        "--groups", type=int, default=100, help="measure groups per account"
+    )
+    parser.add_argument("--latency", type=float, default=0.0, metavar="S")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=int, metavar="RPS")
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--max-p95", type=float, metavar="S")
+    parser.add_argument("--output", type=str, metavar="FILE")
+    args = parser.parse_args()
+
+    # the pipeline logs at INFO for every account
+    logging.basicConfig(level=logging.CRITICAL)
+
+    results = run(args)
+    latency = results["latency"]
+    print(
+        f"{results['succeeded']}/{results['accounts']} accounts in"
+        f" {results['duration']:.2f}s"
+        f" ({results['accounts_per_second']:.1f}/s),"
+        f" peak memory {results['peak_memory_mb']:.0f} MiB"
+    )
+    if latency["p50"] is not None:
+        print(
+            f"per account: p50 {latency['p50']:.3f}s"
+            f" p95 {latency['p95']:.3f}s p99 {latency['p99']:.3f}s"
+        )
+    print(f"api calls: {results['api_calls']}")
+    print(f"adaptive concurrency limits: {results['concurrency_limits']}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fp:
+            json.dump(
+                {
+                    "revision": git_revision(),
+                    "python": platform.python_version(),
+                    "created": time.time(),
+                    "config": vars(args),
+                    "results": results,
+                },
+                fp,
+                indent=2,
+            )
+
+    if (
+        args.max_p95 is not None
+        and latency["p95"] is not None
+        and latency["p95"] > args.max_p95
+    ):
+        print(
+            f"p95 {latency['p95']:.3f}s exceeds {args.max_p95}s",
+            file=sys.stderr,
+        )
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,63 @@
+"""Synthetic Withings payloads for the benchmarks."""
+import random
+
+# weigh-ins alternate with blood pressure readings, four groups a day
+START = 1577836800  # 2020-01-01 00:00 UTC
+DAY = 86400
+PER_DAY = 4
+
+
+def make_measuregrps(count, start=START, seed=0):
+    """generate `count` getmeas measure groups, oldest first"""
+    rnd = random.Random(seed)
+    groups = []
+    for i in range(count):
+        slot = i % PER_DAY
+        date = (
+            start
+            + (i // PER_DAY) * DAY
+            + slot * 4 * 3600
+            + rnd.randrange(6 * 3600, 9 * 3600)
+        )
+        if i % 2 == 0:
+            measures = [
+                {"type": 1, "value": rnd.randrange(6500, 8500), "unit": -2},
+                {"type": 6, "value": rnd.randrange(150, 250), "unit": -1},
+                {"type": 76, "value": rnd.randrange(5000, 6000), "unit": -2},
+                {"type": 77, "value": rnd.randrange(3800, 4500), "unit": -2},
+                {"type": 88, "value": rnd.randrange(280, 320), "unit": -2},
+                {"type": 11, "value": rnd.randrange(50, 80), "unit": 0},
+            ]
+        else:
+            measures = [
+                {"type": 9, "value": rnd.randrange(70, 90), "unit": 0},
+                {"type": 10, "value": rnd.randrange(110, 140), "unit": 0},
+                {"type": 11, "value": rnd.randrange(50, 80), "unit": 0},
+            ]
+        groups.append(
+            {
+                "grpid": i + 1,
+                "attrib": 0,
+                "date": date,
+                "created": date,
+                "modified": date,
+                "category": 1,
+                "deviceid": "bench",
+                "measures": measures,
+            }
+        )
+    return groups
+
+
+def make_getmeas(count, start=START, seed=0):
+    """generate a full getmeas response body"""
+    return {
+        "status": 0,
+        "body": {
+            "updatetime": start,
+            "timezone": "UTC",
+            "measuregrps": make_measuregrps(count, start, seed),
+            "more": 0,
+            "offset": 0,
+        },
+    }
@@ -0,0 +1,198 @@
+"""Benchmark runner for measurement processing and FIT encoding.
+
+Usage:
+    python benchmarks/run.py --output results.json
+    python benchmarks/run.py --sizes 10 1000 --compare results.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from datetime import datetime
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from fake_servers import FakeServer  # noqa: E402
+from payloads import START, DAY, make_measuregrps  # noqa: E402
+from fit import FitEncoderWeight  # noqa: E402
+from measures import message_fields  # noqa: E402
+from withings import WithingsAccount, WithingsMeasureGroup  # noqa: E402
+from utils import generate_fitdata, prepare_syncdata  # noqa: E402
+from sync import sync  # noqa: E402
+
+SIZES = (10, 1000, 10000, 100000)
+FEATURES = ["BLOOD_PRESSURE"]
+
+
+def make_args(measuregrps):
+    """build sync arguments covering the whole payload"""
+    last = max(g["date"] for g in measuregrps) if measuregrps else START
+    return SimpleNamespace(
+        fromdate=datetime.fromtimestamp(START - DAY),
+        todate=datetime.fromtimestamp(last),
+        no_upload=False,
+        garmin_username="bench",
+        garmin_password="bench",
+        features=FEATURES,
+        chunk_days=0,
+        fit_device_info="record",
+        fit_compact=False,
+        fit_separate=False,
+        reconcile=False,
+        newest_first=False,
+        fit_deterministic=False,
+        fit_cache=None,
+        archive=None,
+        archive_max_age=None,
+        secrets="github",
+        merge_window=0,
+    )
+
+
+def timeit(func, repeat, setup=None):
+    """run `func` `repeat` times, return the timings in seconds
+
+    if given, `setup` runs untimed before every call and its result is
+    passed to `func`"""
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            arg = setup()
+            start = time.perf_counter()
+            func(arg)
+        else:
+            start = time.perf_counter()
+            func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def unfinished_weight_encoder(syncdata):
+    """encode the weight records without finishing the file"""
+    fit = FitEncoderWeight()
+    fit.write_file_info()
+    fit.write_file_creator()
+    for record in syncdata:
+        if record["type"] != "weight":
+            continue
+        fit.write_device_info(timestamp=record["timestamp"])
+        fit.write_message(
+            "weight_scale",
+            record["timestamp"],
+            message_fields("weight_scale", record),
+        )
+    return fit
+
+
+def sync_end_to_end(args):
+    """log in to the stand-in servers and run a full sync"""
+    sync(WithingsAccount(), args)
+
+
+def bench_size(size, repeat):
+    """run every benchmark case for one payload size"""
+    measuregrps = make_measuregrps(size)
+    server = FakeServer(measuregrps=measuregrps, page_size=1000).start()
+    os.environ.update(server.environ())
+    groups = [WithingsMeasureGroup(g) for g in measuregrps]
+    args = make_args(measuregrps)
+    _, _, syncdata = prepare_syncdata(1.8, groups, args)
+    fit_weight, _ = generate_fitdata(syncdata)
+
+    cases = {
+        "measure_group": (
+            None,
+            lambda: [WithingsMeasureGroup(g) for g in measuregrps],
+        ),
+        "prepare_syncdata": (
+            None,
+            lambda: prepare_syncdata(1.8, groups, args),
+        ),
+        "generate_fitdata": (None, lambda: generate_fitdata(syncdata)),
+        "fit_crc": (None, fit_weight.crc),
+        "fit_finish": (
+            lambda: unfinished_weight_encoder(syncdata),
+            lambda fit: fit.finish(),
+        ),
+        "sync": (None, lambda: sync_end_to_end(args)),
+    }
+
+    results = {"fit_bytes": fit_weight.get_size()}
+    try:
+        for name, (setup, func) in cases.items():
+            timings = timeit(func, repeat, setup)
+            results[name] = {
+                "min": min(timings),
+                "mean": sum(timings) / len(timings),
+                "repeat": repeat,
+            }
+            logging.warning("%s[%s]: %.6fs", name, size, min(timings))
+    finally:
+        server.stop()
+    results["api_calls"] = dict(server.calls)
+    return results
+
+
+def git_revision():
+    """get the current commit, if any"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    """print the ratio of every case against a previous results file"""
+    with open(baseline_path, encoding="utf-8") as fp:
+        baseline = json.load(fp)
+    for size, cases in results["results"].items():
+        for name, result in cases.items():
+            previous = baseline["results"].get(size, {}).get(name)
+            if not isinstance(previous, dict) or "min" not in previous:
+                continue
+            ratio = result["min"] / previous["min"]
+            print(f"{name}[{size}]: {ratio:.2f}x of baseline")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=SIZES, metavar="GROUPS"
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", type=str, metavar="FILE")
+    parser.add_argument("--compare", type=str, metavar="FILE")
+    args = parser.parse_args()
+
+    # the pipeline logs at INFO, keep it out of the timings
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+
+    results = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "created": time.time(),
+        "results": {
+            str(size): bench_size(size, args.repeat) for size in args.sizes
+        },
+    }
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fp:
+            json.dump(results, fp, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
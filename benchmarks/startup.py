@@ -0,0 +1,75 @@
+"""Startup benchmark of the sync CLI based on `python -X importtime`.
+
+Fails when importing sync.py pulls in a dependency that should only be
+imported by the code paths that need it, or when the import gets slower
+than --max-ms.
+
+Usage:
+    python benchmarks/startup.py --output startup.json --max-ms 100
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+# imported lazily by withings.py, garmin.py, sync.py and state.py
+DEFERRED = ("garth", "nacl", "requests", "asyncio", "sqlite3")
+
+
+def import_times(module="sync"):
+    """import `module` in a fresh interpreter, return {name: cumulative us}"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=SRC,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-ms", type=float, metavar="MS")
+    parser.add_argument("--output", type=str, metavar="FILE")
+    args = parser.parse_args()
+
+    runs = [import_times() for _ in range(args.repeat)]
+    best = min(run["sync"] for run in runs) / 1000
+    loaded = sorted(
+        {name.split(".")[0] for name in runs[0]} & set(DEFERRED)
+    )
+
+    print(f"import sync: {best:.1f} ms (best of {args.repeat})")
+    failures = []
+    if loaded:
+        failures.append(f"eagerly imported: {', '.join(loaded)}")
+    if args.max_ms is not None and best > args.max_ms:
+        failures.append(f"{best:.1f} ms exceeds {args.max_ms} ms")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fp:
+            json.dump(
+                {"import_ms": best, "eager": loaded, "runs": runs},
+                fp,
+                indent=2,
+            )
+
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
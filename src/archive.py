@@ -0,0 +1,345 @@
+"""This module keeps every fetched measurement in a local binary archive."""
+import heapq
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+log = logging.getLogger("archive")
+
+# timestamp, grpid, modified, category, attrib, measure type, unit,
+# device number (see devices.json, -1 for none), value
+RECORD = struct.Struct("<qqqhhhhiq")
+# timestamp, record number
+INDEX = struct.Struct("<qQ")
+
+# measurements can still arrive or be edited for a while after they were
+# taken, only the part of a fetched range older than this counts as archived
+SETTLE_SECONDS = 7 * 86400
+# the pending index entries are merged into the sorted index once they
+# exceed this many or a 16th of the index
+COMPACT_ENTRIES = 4096
+COMPACT_RATIO = 16
+
+
+class _Mapped:
+    """read only mmap of a file of fixed-width entries, empty if missing"""
+
+    def __init__(self, path, entry):
+        self.entry = entry
+        self.map = None
+        self.size = 0
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path, "rb") as fp:
+                self.map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            self.size = len(self.map) // entry.size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        return self.entry.unpack_from(self.map, i * self.entry.size)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+
+
+class MeasureArchive:
+    """Append-only archive of Withings measure groups
+
+    Measures are stored as fixed-width records in `measures.bin`, in the
+    order they were fetched. `measures.idx` lists (timestamp, record number)
+    pairs sorted by timestamp, so a date range is found with a binary search
+    on the memory-mapped index. The entries of new records are appended to
+    `measures.log` and only merged into the sorted index by compact().
+    `ranges.json` keeps the date ranges that were fetched completely, with
+    the time they were fetched, they are answered from the archive until
+    they are older than `max_age` seconds (never without one)."""
+
+    def __init__(self, path, max_age=None, settle=SETTLE_SECONDS):
+        self.path = path
+        self.max_age = max_age
+        self.settle = settle
+        os.makedirs(path, exist_ok=True)
+        self.records_path = os.path.join(path, "measures.bin")
+        self.index_path = os.path.join(path, "measures.idx")
+        self.log_path = os.path.join(path, "measures.log")
+        self.devices_path = os.path.join(path, "devices.json")
+        self.ranges_path = os.path.join(path, "ranges.json")
+
+    def _write(self, path, data):
+        """replace a file of the archive atomically"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(data)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _read_json(self, path):
+        if not os.path.exists(path):
+            return []
+        with open(path) as fp:
+            return json.load(fp)
+
+    def get_ranges(self):
+        """get the archived date ranges as sorted [start, end, fetched]"""
+        return self._read_json(self.ranges_path)
+
+    def covers(self, startdate, enddate, now=None):
+        """check if the range startdate..enddate was archived completely,
+        by ranges that are not older than `max_age`"""
+        now = time.time() if now is None else now
+        position = startdate
+        for start, end, fetched in self.get_ranges():
+            if end < position:
+                continue
+            if start > position:
+                return False
+            if self.max_age is not None and now - fetched > self.max_age:
+                return False
+            position = end + 1
+            if position > enddate:
+                return True
+        return False
+
+    def _add_range(self, startdate, enddate, fetched):
+        """mark startdate..enddate as fetched at `fetched`, it replaces the
+        overlapping parts of older ranges"""
+        ranges = []
+        for start, end, time_fetched in self.get_ranges():
+            if start < startdate:
+                ranges.append([start, min(end, startdate - 1), time_fetched])
+            if end > enddate:
+                ranges.append([max(start, enddate + 1), end, time_fetched])
+        ranges.append([startdate, enddate, fetched])
+
+        merged = []
+        for start, end, time_fetched in sorted(ranges):
+            if (
+                merged
+                and start == merged[-1][1] + 1
+                and time_fetched == merged[-1][2]
+            ):
+                merged[-1][1] = end
+            else:
+                merged.append([start, end, time_fetched])
+        self._write(self.ranges_path, json.dumps(merged).encode())
+
+    @staticmethod
+    def _bisect(index, timestamp):
+        """first position of the index with a timestamp >= timestamp"""
+        low, high = 0, len(index)
+        while low < high:
+            mid = (low + high) // 2
+            if index[mid][0] < timestamp:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def _pending(self):
+        """get the index entries not compacted yet, sorted"""
+        pending = _Mapped(self.log_path, INDEX)
+        try:
+            return sorted(pending[i] for i in range(len(pending)))
+        finally:
+            pending.close()
+
+    def _entries(self, index, pending, startdate=None, enddate=None):
+        """yield the index entries of startdate..enddate in order, from
+        the sorted index and the pending entries
+
+        An entry can be in both after a compaction was interrupted, it is
+        yielded once."""
+        first = 0 if startdate is None else self._bisect(index, startdate)
+        indexed = (index[i] for i in range(first, len(index)))
+        previous = None
+        for entry in heapq.merge(indexed, pending):
+            if startdate is not None and entry[0] < startdate:
+                continue
+            if enddate is not None and entry[0] > enddate:
+                break
+            if entry != previous:
+                yield entry
+            previous = entry
+
+    def _scan(self, startdate, enddate):
+        """yield the records of startdate..enddate in timestamp order"""
+        index = _Mapped(self.index_path, INDEX)
+        records = _Mapped(self.records_path, RECORD)
+        try:
+            for _, number in self._entries(
+                index, self._pending(), startdate, enddate
+            ):
+                yield records[number]
+        finally:
+            index.close()
+            records.close()
+
+    def compact(self):
+        """merge the pending entries into the sorted index
+
+        One streaming merge of the index with the sorted pending entries,
+        the only place the index is rewritten."""
+        pending = self._pending()
+        if not pending:
+            return
+        index = _Mapped(self.index_path, INDEX)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                buffer = bytearray()
+                for entry in self._entries(index, pending):
+                    buffer += INDEX.pack(*entry)
+                    if len(buffer) >= 1 << 16:
+                        fp.write(buffer)
+                        buffer.clear()
+                fp.write(buffer)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(tmp_path, self.index_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        finally:
+            index.close()
+        # a crash before this leaves the entries in both, see _entries
+        os.unlink(self.log_path)
+        log.debug("Compacted %d index entries", len(pending))
+
+    def get_measuregrps(self, startdate, enddate):
+        """get the archived measure groups of a range in getmeas format
+
+        A group that was edited on Withings is archived once per version,
+        the latest version wins."""
+        devices = self._read_json(self.devices_path)
+        measuregrps = {}
+        for (
+            timestamp,
+            grpid,
+            modified,
+            category,
+            attrib,
+            mtype,
+            unit,
+            device,
+            value,
+        ) in self._scan(startdate, enddate):
+            measuregrp = measuregrps.get((timestamp, grpid))
+            if measuregrp is None or modified > measuregrp["modified"]:
+                measuregrp = measuregrps[(timestamp, grpid)] = {
+                    "grpid": grpid,
+                    "attrib": attrib,
+                    "date": timestamp,
+                    "modified": modified,
+                    "category": category,
+                    "deviceid": devices[device] if device >= 0 else None,
+                    "measures": [],
+                }
+            elif modified < measuregrp["modified"]:
+                continue
+            measuregrp["measures"].append(
+                {"type": mtype, "value": value, "unit": unit}
+            )
+        return list(measuregrps.values())
+
+    def append(self, measuregrps, startdate, enddate, fetched=None):
+        """archive the measure groups fetched for startdate..enddate
+
+        Groups that are already archived are skipped, so a range can be
+        fetched again without duplicating records, edited groups are kept
+        as a new version. Only the part of the range older than `settle`
+        seconds before the fetch counts as archived."""
+        fetched = int(time.time() if fetched is None else fetched)
+        known = set()
+        if measuregrps:
+            dates = [measuregrp["date"] for measuregrp in measuregrps]
+            known = {
+                (timestamp, grpid, modified)
+                for timestamp, grpid, modified, *_ in self._scan(
+                    min(dates), max(dates)
+                )
+            }
+
+        devices = self._read_json(self.devices_path)
+        device_numbers = {device: i for i, device in enumerate(devices)}
+        number = (
+            os.path.getsize(self.records_path) // RECORD.size
+            if os.path.exists(self.records_path)
+            else 0
+        )
+        data = bytearray()
+        new_entries = []
+        for measuregrp in measuregrps:
+            key = (
+                measuregrp["date"],
+                measuregrp.get("grpid") or 0,
+                measuregrp.get("modified") or 0,
+            )
+            if key in known:
+                continue
+            known.add(key)
+            device = -1
+            if measuregrp.get("deviceid") is not None:
+                device = device_numbers.setdefault(
+                    measuregrp["deviceid"], len(device_numbers)
+                )
+            for measure in measuregrp["measures"]:
+                data += RECORD.pack(
+                    *key,
+                    measuregrp.get("category") or 1,
+                    measuregrp.get("attrib") or 0,
+                    measure["type"],
+                    measure["unit"],
+                    device,
+                    measure["value"],
+                )
+                new_entries.append((key[0], number))
+                number += 1
+
+        if data:
+            if len(device_numbers) > len(devices):
+                self._write(
+                    self.devices_path,
+                    json.dumps(list(device_numbers)).encode(),
+                )
+            with open(self.records_path, "ab") as fp:
+                fp.write(data)
+                fp.flush()
+                os.fsync(fp.fileno())
+            # records are written before the index entries that point at
+            # them, which are appended unsorted until the next compaction
+            with open(self.log_path, "ab") as fp:
+                fp.write(
+                    b"".join(INDEX.pack(*entry) for entry in new_entries)
+                )
+                fp.flush()
+                os.fsync(fp.fileno())
+            pending = os.path.getsize(self.log_path) // INDEX.size
+            indexed = (
+                os.path.getsize(self.index_path) // INDEX.size
+                if os.path.exists(self.index_path)
+                else 0
+            )
+            if pending > max(COMPACT_ENTRIES, indexed // COMPACT_RATIO):
+                self.compact()
+
+        settled = min(enddate, fetched - self.settle)
+        if settled >= startdate:
+            self._add_range(startdate, settled, fetched)
+        log.debug(
+            "Archived %d measures of %s..%s",
+            len(new_entries),
+            startdate,
+            enddate,
+        )
+        return len(new_entries)
@@ -0,0 +1,433 @@
+"""This module syncs the measurements of several Withings accounts."""
+import argparse
+import io
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+
+from collections import deque
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+
+from garmin import GarminConnect
+from measures import FIT_FIELDS
+from metrics import metrics
+from utils import (
+    drop_existing,
+    generate_fitdata,
+    generate_fitdata_combined,
+    prepare_syncdata,
+)
+
+log = logging.getLogger("batch")
+
+# windows of an account encoded ahead of its uploads, so the fetches and
+# the encoding overlap without holding the FIT files of the whole range
+PIPELINE_WINDOWS = 2
+# accounts synced at the same time, each one logs in to Withings and Garmin
+JOBS = 8
+
+
+def load_accounts(path):
+    """read the accounts file
+
+    It holds a JSON list of accounts, each with the `environ` variables of
+    the Withings account and optionally its `garmin_username` and
+    `garmin_password`. Variables missing from `environ` are taken from the
+    environment, except WITHINGS_USER_ID: every account needs its own, the
+    tokens, state and directories of the accounts are kept apart by it."""
+    with open(path, encoding="utf-8") as fp:
+        accounts = json.load(fp)
+    seen = set()
+    for index, account in enumerate(accounts):
+        user_id = account.get("environ", {}).get("WITHINGS_USER_ID")
+        if not user_id:
+            raise ValueError(
+                f"Account {index} of {path} has no WITHINGS_USER_ID"
+                " in its environ."
+            )
+        if user_id in seen:
+            raise ValueError(
+                f"Several accounts of {path} have the WITHINGS_USER_ID"
+                f" {user_id}."
+            )
+        seen.add(user_id)
+    return accounts
+
+
+def save_accounts(path, accounts):
+    """write the accounts file atomically, e.g. with rotated tokens"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as fp:
+            json.dump(accounts, fp, indent=2)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def to_columns(syncdata):
+    """turn prepared records into one list per FIT field
+
+    The columns are much cheaper to send to a worker process than the
+    records, which also hold the raw Withings measures."""
+    return {
+        field: [record.get(field) for record in syncdata]
+        for field in FIT_FIELDS
+    }
+
+
+def encode_columns(
+    columns,
+    device_info="record",
+    compact=False,
+    combined=True,
+    deterministic=False,
+):
+    """encode columnar records, return a list of (description, FIT bytes)
+
+    Runs in a worker process."""
+    syncdata = [
+        dict(zip(FIT_FIELDS, values))
+        for values in zip(*(columns[field] for field in FIT_FIELDS))
+    ]
+    options = {
+        "device_info": device_info,
+        "compact": compact,
+        "deterministic": deterministic,
+    }
+    if combined:
+        fit_files = [
+            (
+                "weight and blood pressure",
+                generate_fitdata_combined(syncdata, **options),
+            )
+        ]
+    else:
+        fit_weight, fit_blood_pressure = generate_fitdata(syncdata, **options)
+        fit_files = [
+            ("weight", fit_weight),
+            ("blood pressure", fit_blood_pressure),
+        ]
+    return [
+        (description, fit.getvalue())
+        for description, fit in fit_files
+        if fit is not None
+    ]
+
+
+def account_environ(account):
+    """get the environment variables of an account"""
+    environ = dict(os.environ)
+    environ.update(account.get("environ", {}))
+    return environ
+
+
+def account_id(account):
+    """get the Withings user id of an account, see load_accounts"""
+    return account["environ"]["WITHINGS_USER_ID"]
+
+
+def account_args(account, args):
+    """get the arguments of one account, with its Garmin credentials
+
+    Every account gets its own directory in the --archive and --fit-cache
+    ones, an upload of one account must not count for another."""
+    args = argparse.Namespace(**vars(args))
+    for key in ("garmin_username", "garmin_password"):
+        if account.get(key):
+            setattr(args, key, account[key])
+    for key in ("archive", "fit_cache"):
+        path = getattr(args, key)
+        if path:
+            setattr(args, key, os.path.join(path, account_id(account)))
+    return args
+
+
+def encode_window(window, groups, height, garmin, pool, cache, args):
+    """prepare the measure groups of a window and encode them in the pool
+
+    Returns the job of the window for sync_account: the window, the time
+    of its last measurement, the fit cache key of its records (None when
+    they were cached) and the future of its (description, FIT bytes)."""
+    from sync import fit_options, get_existing
+
+    existing = get_existing(garmin, *window, args)
+    with metrics.stage("prepare"):
+        _, last_timestamp, syncdata = prepare_syncdata(height, groups, args)
+        if existing:
+            syncdata = drop_existing(syncdata, existing)
+    metrics.count("prepare", records=len(syncdata))
+    combined, options = fit_options(args)
+    key = None
+    if cache is not None:
+        from fitcache import records_key
+
+        key = records_key(syncdata, combined=combined, **options)
+        cached = cache.get(key)
+        if cached is not None:
+            metrics.count("fit.cache", records=len(syncdata))
+            future = Future()
+            future.set_result(cached)
+            return window, last_timestamp, None, future
+    future = pool.submit(
+        encode_columns, to_columns(syncdata), combined=combined, **options
+    )
+    return window, last_timestamp, key, future
+
+
+def sync_account(account, args, pool, secrets, state=None, lease=None):
+    """Sync one account, encoding its fit files in the process pool
+
+    The rotated tokens go to the `secrets` backend of the batch, as soon as
+    they are rotated. Like sync(), the progress is checkpointed after every
+    uploaded window. With the `lease` of a queued job (see
+    workqueue.Heartbeat), the sync stops before the next upload or write
+    once another worker took over the account. Returns the number of
+    uploaded fit files."""
+    from sync import (
+        archive_max_age,
+        fetch_windows,
+        get_sync_range,
+        mark_sent,
+        plan_windows,
+        unsent,
+    )
+    from withings import WithingsAccount
+
+    args = account_args(account, args)
+    withings = WithingsAccount(
+        state=state, environ=account_environ(account), secrets=secrets
+    )
+    if args.archive:
+        from archive import MeasureArchive
+
+        withings.archive = MeasureArchive(args.archive, archive_max_age(args))
+    cache = None
+    if args.fit_cache:
+        from fitcache import FitCache
+
+        cache = FitCache(args.fit_cache)
+
+    startdate, enddate = get_sync_range(withings, args)
+    newest_first = args.newest_first
+    height = withings.get_height()
+    upload = not args.no_upload and args.garmin_username
+    garmin = GarminConnect() if upload else None
+
+    uploaded = 0
+    # newest first, the last sync only moves once all windows are uploaded
+    lastsync = None
+
+    def finish(job):
+        """upload and checkpoint a window once its fit files are encoded"""
+        nonlocal uploaded, lastsync
+        window, last_timestamp, key, future = job
+        fit_files = []
+        if future is not None:
+            with metrics.stage("fit.encode"):
+                fit_files = future.result()
+        if key is not None:
+            cache.put(key, fit_files)
+        if not garmin:
+            return
+        for description, fit in unsent(
+            [(d, io.BytesIO(payload)) for d, payload in fit_files], args
+        ):
+            if lease is not None:
+                lease.check()
+            if not garmin.logged_in:
+                garmin.login(args.garmin_username, args.garmin_password)
+            garmin.upload_file(fit)
+            mark_sent(fit.getvalue(), args)
+            uploaded += 1
+            log.info(
+                "Fit file with %s information of %s uploaded",
+                description,
+                withings.account,
+            )
+        if lease is not None:
+            lease.check()
+        withings.add_checkpoint(startdate, *window)
+        if args.fromdate or last_timestamp is None:
+            return
+        if newest_first:
+            lastsync = max(lastsync or last_timestamp, last_timestamp)
+        else:
+            withings.set_lastsync(last_timestamp)
+
+    # a window is encoded by a worker while the next ones are fetched, and
+    # uploaded once PIPELINE_WINDOWS more are on their way
+    jobs = deque()
+    failure = None
+    windows = plan_windows(withings, startdate, enddate, args)
+    for window_start, window_end, groups in fetch_windows(
+        withings, windows, args.merge_window
+    ):
+        window = (window_start, window_end)
+        if groups is None:
+            # the windows fetched before are still uploaded and checkpointed
+            failure = ConnectionError(
+                "Fetching the Withings measurements failed"
+            )
+            break
+        if not groups:
+            jobs.append((window, None, None, None))
+        else:
+            jobs.append(
+                encode_window(
+                    window, groups, height, garmin, pool, cache, args
+                )
+            )
+        if len(jobs) > PIPELINE_WINDOWS:
+            finish(jobs.popleft())
+    while jobs:
+        finish(jobs.popleft())
+    if failure is not None:
+        raise failure
+    if lease is not None:
+        lease.check()
+    if lastsync is not None:
+        withings.set_lastsync(lastsync)
+    withings.clear_checkpoint()
+    return uploaded
+
+
+class AccountsSecretBackend:
+    """Tokens kept in the `environ` of the accounts of the accounts file
+
+    The batch mode replaces the shared secret backends with this one, which
+    keeps the tokens of every account apart. Rotated tokens are written to
+    the accounts file at `path` right away, if there is one, so a failing
+    or killed batch can't lose them."""
+
+    def __init__(self, accounts, path=None):
+        self.accounts = accounts
+        self.path = path
+        self._by_id = {account_id(account): account for account in accounts}
+        self._lock = threading.Lock()
+
+    def load(self, account):
+        return {}
+
+    def save(self, account, secrets):
+        with self._lock:
+            self._by_id[account].setdefault("environ", {}).update(secrets)
+            if self.path is not None:
+                save_accounts(self.path, self.accounts)
+        log.info("Rotated tokens of account %s saved", account)
+
+
+class QueueSecretBackend:
+    """Tokens kept in the jobs of the work queue
+
+    Rotated tokens are saved right away, and only while the worker still
+    owns the job of the account, see WorkQueue.set_tokens."""
+
+    def __init__(self, queue, worker):
+        self.queue = queue
+        self.worker = worker
+
+    def load(self, account):
+        return self.queue.get_tokens(account)
+
+    def save(self, account, secrets):
+        from workqueue import LeaseLost
+
+        if not self.queue.set_tokens(account, self.worker, secrets):
+            raise LeaseLost(f"Lost the lease of account {account}")
+        log.info("Rotated tokens of account %s saved", account)
+
+
+def sync_batch(accounts_path, args, state=None, workers=None, jobs=JOBS):
+    """Sync all accounts of the accounts file
+
+    The Withings and Garmin requests of up to `jobs` accounts run on
+    threads, the FIT encoding runs on `workers` processes (default: one per
+    core), so the CPU work isn't serialised on the GIL next to the I/O."""
+    accounts = load_accounts(accounts_path)
+    secrets = AccountsSecretBackend(accounts, accounts_path)
+    failed = 0
+    # the workers are started from the account threads, forking them
+    # could copy locks held by another thread
+    pool = ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    )
+    threads = ThreadPoolExecutor(max_workers=max(1, min(jobs, len(accounts))))
+    with pool, threads:
+        futures = [
+            threads.submit(sync_account, account, args, pool, secrets, state)
+            for account in accounts
+        ]
+        for index, future in enumerate(futures):
+            try:
+                future.result()
+            except Exception as ex:
+                failed += 1
+                log.error("Sync of account %d failed: %s", index, ex)
+    log.info("Synced %d of %d accounts", len(accounts) - failed, len(accounts))
+    return failed
+
+
+def run_worker(queue_path, accounts_path, args, workers=None, enqueue=False):
+    """Sync the accounts claimed from a shared work queue until none is left
+
+    Several workers, on one host or on hosts sharing the queue database, can
+    run at the same time: every account is leased by one worker at a time,
+    so its Withings token is refreshed by a single worker. The rotated
+    tokens are saved in the queue right away, and a worker that lost the
+    lease of an account stops syncing it. The sync state is reopened for
+    every job, use a SQLite --state to share it. With
+    `enqueue`, a sync of every account of the accounts file is queued
+    first. Returns the number of failed jobs."""
+    from state import open_state_store
+    from workqueue import WorkQueue, worker_name
+
+    queue = WorkQueue(queue_path)
+    # load_accounts fails on accounts sharing an id, they'd be one job
+    accounts = {
+        account_id(account): account
+        for account in load_accounts(accounts_path)
+    }
+    if enqueue:
+        queue.enqueue(accounts)
+    worker = worker_name()
+    secrets = QueueSecretBackend(queue, worker)
+    failed = 0
+
+    pool = ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    )
+    with pool:
+        while True:
+            job = queue.claim(worker)
+            if job is None:
+                break
+            account = accounts.get(job)
+            if account is None:
+                queue.complete(job, worker, "not in the accounts file")
+                continue
+
+            error = None
+            log.info("Worker %s syncs account %s", worker, job)
+            with queue.lease(job, worker) as lease:
+                try:
+                    state = open_state_store(args.state)
+                    sync_account(account, args, pool, secrets, state, lease)
+                except Exception as ex:
+                    error = str(ex)
+                    failed += 1
+                    log.error("Sync of account %s failed: %s", job, ex)
+            if not queue.complete(job, worker, error):
+                log.error("The lease of account %s ran out", job)
+    return failed
@@ -0,0 +1,136 @@
+"""This module adapts the number of concurrent requests to an endpoint."""
+import logging
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+
+log = logging.getLogger("concurrency")
+
+STATUS_TOO_MANY_REQUESTS = 429
+SMOOTHING = 0.1
+# the latency baseline is the lowest latency of this many recent requests
+WINDOW = 100
+
+
+def is_overload(ex):
+    """tell if an exception means the service is overloaded
+
+    Connection errors and timeouts count, as do HTTP 429 and 5xx responses
+    (requests errors carry the response, garth errors the requests error)."""
+    error = getattr(ex, "error", ex)
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None)
+    if status is not None:
+        return status == STATUS_TOO_MANY_REQUESTS or status >= 500
+    return isinstance(ex, OSError)
+
+
+class Call:
+    """One request admitted by a limiter, see AdaptiveLimiter.request"""
+
+    def __init__(self):
+        self.overload = False
+
+    def overloaded(self):
+        """report a rate limit answered with a successful response"""
+        self.overload = True
+
+
+class AdaptiveLimiter:
+    """AIMD limit of the requests in flight to one endpoint
+
+    The limit grows by one for every `limit` requests that finish without
+    a sign of overload, i.e. by about one per round trip. It is cut by
+    `backoff` on a rate limit, a server error or when the smoothed latency
+    rises above `tolerance` times the lowest latency of the last `window`
+    requests, at most once per round trip so that a burst of failures
+    counts as one signal. The baseline follows an endpoint that got slower
+    for good, instead of cutting the limit for the rest of the run."""
+
+    def __init__(
+        self,
+        name,
+        initial=4,
+        minimum=1,
+        maximum=64,
+        backoff=0.5,
+        tolerance=2.0,
+        window=WINDOW,
+    ):
+        self.name = name
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.inflight = 0
+        self.min_latency = None
+        self._recent = deque(maxlen=window)
+        self.latency = None
+        self._last_cut = 0.0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def request(self):
+        """wait for a free slot, then run the wrapped request in it"""
+        with self._cond:
+            while self.inflight >= int(self.limit):
+                self._cond.wait()
+            self.inflight += 1
+        call = Call()
+        start = time.monotonic()
+        try:
+            yield call
+        except Exception as ex:
+            call.overload = call.overload or is_overload(ex)
+            raise
+        finally:
+            self._release(time.monotonic() - start, call.overload)
+
+    def _release(self, latency, overload):
+        with self._cond:
+            self.inflight -= 1
+            now = time.monotonic()
+            self._recent.append(latency)
+            self.min_latency = min(self._recent)
+            if self.latency is None:
+                self.latency = latency
+            # exponentially weighted, a single slow request is no signal
+            self.latency += SMOOTHING * (latency - self.latency)
+            slow = self.latency > self.min_latency * self.tolerance
+            if overload or slow:
+                # one cut per round trip
+                if now - self._last_cut > self.latency:
+                    self._last_cut = now
+                    self.limit = max(self.minimum, self.limit * self.backoff)
+                    log.debug(
+                        "%s: %s, limit cut to %d",
+                        self.name,
+                        "overloaded" if overload else "slow",
+                        self.limit,
+                    )
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def limiter(name, **options):
+    """get the limiter shared by all requests to endpoint `name`
+
+    The options of the first call create it."""
+    with _limiters_lock:
+        if name not in _limiters:
+            _limiters[name] = AdaptiveLimiter(name, **options)
+        return _limiters[name]
+
+
+def limits():
+    """get the current limit of every endpoint"""
+    with _limiters_lock:
+        return {name: int(lim.limit) for name, lim in _limiters.items()}
@@ -4,6 +4,10 @@ from struct import unpack
 from datetime import datetime
 import time
 
+from metrics import metrics
+
+FIT_EPOCH = 631065600
+
 
 def _calcCRC(crc, byte):
     table = [
@@ -200,11 +204,17 @@ class FitEncoder(Fit):
     LMSG_TYPE_FILE_INFO = 0
     LMSG_TYPE_FILE_CREATOR = 1
     LMSG_TYPE_DEVICE_INFO = 2
+    # FIT message -> local message type of its data messages, no idea why
+    # 14 for blood pressure, it was found somewhere in the deepest web
+    LMSG_TYPES = {"weight_scale": 3, "blood_pressure": 14}
 
-    def __init__(self):
+    def __init__(self, compact=False):
+        """compact: leave fields without a value out of the definitions"""
         self.buf = BytesIO()
         self.write_header()  # create header first
-        self.device_info_defined = False
+        self.compact = compact
+        # local message type -> field definitions currently in effect
+        self.definitions = {}
 
     def __str__(self):
         orig_pos = self.buf.tell()
@@ -251,6 +261,34 @@ class FitEncoder(Fit):
             values.append(FitBaseType.pack(basetype, value))
         return (b"".join(field_defs), b"".join(values))
 
+    def _write_message(self, lmsg_type, msg_name, content):
+        """write a data message, preceded by its definition when the fields
+        differ from the ones defined last for this local message type"""
+        if self.compact:
+            content = [field for field in content if field[2] is not None]
+        fields, values = self._build_content_block(content)
+
+        if self.definitions.get(lmsg_type) != fields:
+            header = self.record_header(definition=True, lmsg_type=lmsg_type)
+            msg_number = self.GMSG_NUMS[msg_name]
+            fixed_content = pack(
+                "BBHB", 0, 0, msg_number, len(content)
+            )  # reserved, architecture(0: little endian)
+            self.buf.write(header + fixed_content + fields)
+            self.definitions[lmsg_type] = fields
+
+        header = self.record_header(lmsg_type=lmsg_type)
+        self.buf.write(header + values)
+
+    def write_message(self, msg_name, timestamp, fields):
+        """write a timestamped data message
+
+        fields: the (field number, base type, value, scale) of the message,
+        see measures.message_fields"""
+        content = [(253, FitBaseType.uint32, self.timestamp(timestamp), 1)]
+        content.extend(fields)
+        self._write_message(self.LMSG_TYPES[msg_name], msg_name, content)
+
     def write_file_info(
         self,
         serial_number=None,
@@ -260,7 +298,7 @@ class FitEncoder(Fit):
         number=None,
     ):
         if time_created is None:
-            time_created = datetime.now()
+            time_created = int(time.time())
 
         content = [
             (3, FitBaseType.uint32z, serial_number, None),
@@ -270,55 +308,15 @@ class FitEncoder(Fit):
             (5, FitBaseType.uint16, number, None),
             (0, FitBaseType.enum, self.FILE_TYPE, None),  # type
         ]
-        fields, values = self._build_content_block(content)
-
-        # create fixed content
-        msg_number = self.GMSG_NUMS["file_id"]
-        fixed_content = pack(
-            "BBHB", 0, 0, msg_number, len(content)
-        )  # reserved, architecture(0: little endian)
-
-        self.buf.write(
-            b"".join(
-                [
-                    # definition
-                    self.record_header(
-                        definition=True, lmsg_type=self.LMSG_TYPE_FILE_INFO
-                    ),
-                    fixed_content,
-                    fields,
-                    # record
-                    self.record_header(lmsg_type=self.LMSG_TYPE_FILE_INFO),
-                    values,
-                ]
-            )
-        )
+        self._write_message(self.LMSG_TYPE_FILE_INFO, "file_id", content)
 
     def write_file_creator(self, software_version=None, hardware_version=None):
         content = [
             (0, FitBaseType.uint16, software_version, None),
             (1, FitBaseType.uint8, hardware_version, None),
         ]
-        fields, values = self._build_content_block(content)
-
-        msg_number = self.GMSG_NUMS["file_creator"]
-        fixed_content = pack(
-            "BBHB", 0, 0, msg_number, len(content)
-        )  # reserved, architecture(0: little endian)
-        self.buf.write(
-            b"".join(
-                [
-                    # definition
-                    self.record_header(
-                        definition=True, lmsg_type=self.LMSG_TYPE_FILE_CREATOR
-                    ),
-                    fixed_content,
-                    fields,
-                    # record
-                    self.record_header(lmsg_type=self.LMSG_TYPE_FILE_CREATOR),
-                    values,
-                ]
-            )
+        self._write_message(
+            self.LMSG_TYPE_FILE_CREATOR, "file_creator", content
         )
 
     def write_device_info(
@@ -349,21 +347,9 @@ class FitEncoder(Fit):
             (6, FitBaseType.uint8, hardware_version, 1),
             (11, FitBaseType.uint8, battery_status, None),
         ]
-        fields, values = self._build_content_block(content)
-
-        if not self.device_info_defined:
-            header = self.record_header(
-                definition=True, lmsg_type=self.LMSG_TYPE_DEVICE_INFO
-            )
-            msg_number = self.GMSG_NUMS["device_info"]
-            fixed_content = pack(
-                "BBHB", 0, 0, msg_number, len(content)
-            )  # reserved, architecture(0: little endian)
-            self.buf.write(header + fixed_content + fields)
-            self.device_info_defined = True
-
-        header = self.record_header(lmsg_type=self.LMSG_TYPE_DEVICE_INFO)
-        self.buf.write(header + values)
+        self._write_message(
+            self.LMSG_TYPE_DEVICE_INFO, "device_info", content
+        )
 
     def record_header(self, definition=False, lmsg_type=0):
         msg = 0
@@ -386,11 +372,13 @@ class FitEncoder(Fit):
 
     def finish(self):
         """re-weite file-header, then append crc to end of file"""
-        data_size = self.get_size() - self.HEADER_SIZE
-        self.write_header(data_size=data_size)
-        crc = self.crc()
-        self.buf.seek(0, 2)
-        self.buf.write(crc)
+        with metrics.stage("fit.finish"):
+            data_size = self.get_size() - self.HEADER_SIZE
+            self.write_header(data_size=data_size)
+            crc = self.crc()
+            self.buf.seek(0, 2)
+            self.buf.write(crc)
+        metrics.count("fit.finish", nbytes=self.get_size())
 
     def get_size(self):
         orig_pos = self.buf.tell()
@@ -404,109 +392,24 @@ class FitEncoder(Fit):
 
     def timestamp(self, t):
         """the timestamp in fit protocol is seconds since
-        UTC 00:00 Dec 31 1989 (631065600)"""
+        UTC 00:00 Dec 31 1989 (631065600)
+
+        t is a UTC epoch timestamp, datetimes are still accepted"""
         if isinstance(t, datetime):
-            t = time.mktime(t.timetuple())
-        return t - 631065600
+            t = int(t.timestamp())
+        return t - FIT_EPOCH
 
 
 class FitEncoderBloodPressure(FitEncoder):
-    # Here might be dragons - no idea what lsmg stand for, found 14 somewhere in the deepest web
-    LMSG_TYPE_BLOOD_PRESSURE = 14
-
-    def __init__(self):
-        super().__init__()
-        self.blood_pressure_monitor_defined = False
-
-    def write_blood_pressure(
-        self,
-        timestamp,
-        diastolic_blood_pressure=None,
-        systolic_blood_pressure=None,
-        mean_arterial_pressure=None,
-        map_3_sample_mean=None,
-        map_morning_values=None,
-        map_evening_values=None,
-        heart_rate=None,
-    ):
-        # BLOOD PRESSURE FILE MESSAGES
-        content = [
-            (253, FitBaseType.uint32, self.timestamp(timestamp), 1),
-            (0, FitBaseType.uint16, systolic_blood_pressure, 1),
-            (1, FitBaseType.uint16, diastolic_blood_pressure, 1),
-            (2, FitBaseType.uint16, mean_arterial_pressure, 1),
-            (3, FitBaseType.uint16, map_3_sample_mean, 1),
-            (4, FitBaseType.uint16, map_morning_values, 1),
-            (5, FitBaseType.uint16, map_evening_values, 1),
-            (6, FitBaseType.uint8, heart_rate, 1),
-        ]
-        fields, values = self._build_content_block(content)
-
-        if not self.blood_pressure_monitor_defined:
-            header = self.record_header(
-                definition=True, lmsg_type=self.LMSG_TYPE_BLOOD_PRESSURE
-            )
-            msg_number = self.GMSG_NUMS["blood_pressure"]
-            fixed_content = pack(
-                "BBHB", 0, 0, msg_number, len(content)
-            )  # reserved, architecture(0: little endian)
-            self.buf.write(header + fixed_content + fields)
-            self.blood_pressure_monitor_defined = True
-
-        header = self.record_header(lmsg_type=self.LMSG_TYPE_BLOOD_PRESSURE)
-        self.buf.write(header + values)
+    """Blood pressure messages, written with write_message"""
 
 
 class FitEncoderWeight(FitEncoder):
-    LMSG_TYPE_WEIGHT_SCALE = 3
-
-    def __init__(self):
-        super().__init__()
-        self.weight_scale_defined = False
+    """Weight scale messages, written with write_message"""
 
-    def write_weight_scale(
-        self,
-        timestamp,
-        weight,
-        percent_fat=None,
-        percent_hydration=None,
-        visceral_fat_mass=None,
-        bone_mass=None,
-        muscle_mass=None,
-        basal_met=None,
-        active_met=None,
-        physique_rating=None,
-        metabolic_age=None,
-        visceral_fat_rating=None,
-        bmi=None,
-    ):
-        content = [
-            (253, FitBaseType.uint32, self.timestamp(timestamp), 1),
-            (0, FitBaseType.uint16, weight, 100),
-            (1, FitBaseType.uint16, percent_fat, 100),
-            (2, FitBaseType.uint16, percent_hydration, 100),
-            (3, FitBaseType.uint16, visceral_fat_mass, 100),
-            (4, FitBaseType.uint16, bone_mass, 100),
-            (5, FitBaseType.uint16, muscle_mass, 100),
-            (7, FitBaseType.uint16, basal_met, 4),
-            (9, FitBaseType.uint16, active_met, 4),
-            (8, FitBaseType.uint8, physique_rating, 1),
-            (10, FitBaseType.uint8, metabolic_age, 1),
-            (11, FitBaseType.uint8, visceral_fat_rating, 1),
-            (13, FitBaseType.uint16, bmi, 10),
-        ]
-        fields, values = self._build_content_block(content)
 
-        if not self.weight_scale_defined:
-            header = self.record_header(
-                definition=True, lmsg_type=self.LMSG_TYPE_WEIGHT_SCALE
-            )
-            msg_number = self.GMSG_NUMS["weight_scale"]
-            fixed_content = pack(
-                "BBHB", 0, 0, msg_number, len(content)
-            )  # reserved, architecture(0: little endian)
-            self.buf.write(header + fixed_content + fields)
-            self.weight_scale_defined = True
+class FitEncoderCombined(FitEncoderWeight, FitEncoderBloodPressure):
+    """Weight scale and blood pressure messages in a single file
 
-        header = self.record_header(lmsg_type=self.LMSG_TYPE_WEIGHT_SCALE)
-        self.buf.write(header + values)
+    Both message kinds keep their own local message type, so the file has
+    one header, file_id and CRC."""
@@ -0,0 +1,93 @@
+"""This module caches encoded FIT files by the records they contain."""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+from measures import FIT_FIELDS
+
+log = logging.getLogger("fitcache")
+
+
+def digest(data):
+    """get the content address of a payload"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def records_key(syncdata, **options):
+    """hash the records of a window and the encoding options
+
+    Only the fields written to the FIT files are hashed, in the order they
+    are encoded, so refetching unchanged measurements gives the same key."""
+    records = [
+        [record.get(field) for field in FIT_FIELDS] for record in syncdata
+    ]
+    normalised = json.dumps(
+        {"options": options, "records": records},
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return digest(normalised.encode())
+
+
+class FitCache:
+    """Content-addressed store of encoded FIT files
+
+    `files/<sha256>.fit` holds every encoded payload once, `windows/<key>`
+    lists the (description, payload hash) pairs encoded for a records key
+    and `sent/<sha256>` marks the payloads uploaded to Garmin Connect. Only
+    deterministic FIT files (see utils.file_time_created) are worth
+    caching, otherwise the same records never give the same payload."""
+
+    def __init__(self, path):
+        self.path = path
+        for directory in ("files", "windows", "sent"):
+            os.makedirs(os.path.join(path, directory), exist_ok=True)
+
+    def _file(self, directory, name):
+        return os.path.join(self.path, directory, name)
+
+    def _write(self, path, data):
+        """write a file of the cache atomically"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def get(self, key):
+        """get the (description, payload) pairs cached for a key, or None"""
+        try:
+            with open(self._file("windows", key), encoding="utf-8") as fp:
+                entries = json.load(fp)
+            fit_files = []
+            for description, payload_hash in entries:
+                path = self._file("files", payload_hash + ".fit")
+                with open(path, "rb") as fp:
+                    fit_files.append((description, fp.read()))
+        except FileNotFoundError:
+            return None
+        return fit_files
+
+    def put(self, key, fit_files):
+        """cache the (description, payload) pairs encoded for a key"""
+        entries = []
+        for description, payload in fit_files:
+            payload_hash = digest(payload)
+            path = self._file("files", payload_hash + ".fit")
+            if not os.path.exists(path):
+                self._write(path, payload)
+            entries.append((description, payload_hash))
+        self._write(self._file("windows", key), json.dumps(entries).encode())
+
+    def was_sent(self, payload):
+        """tell if the same payload was uploaded before"""
+        return os.path.exists(self._file("sent", digest(payload)))
+
+    def mark_sent(self, payload):
+        """remember that a payload was uploaded"""
+        self._write(self._file("sent", digest(payload)), b"")
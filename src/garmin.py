@@ -1,20 +1,37 @@
 """This module handles the Garmin connectivity."""
 import logging
-import garth
 import io
+import time
+
+from datetime import datetime, timezone
+from concurrency import limiter
+from metrics import metrics
 
 log = logging.getLogger("garmin")
 
+WEIGHT_RANGE_PATH = (
+    "/weight-service/weight/range/{start}/{end}?includeAll=true"
+)
+BLOOD_PRESSURE_RANGE_PATH = (
+    "/bloodpressure-service/bloodpressure/range/{start}/{end}?includeAll=true"
+)
+
 
 class GarminConnect:
     """Main GarminConnect class"""
 
     def __init__(self) -> None:
+        # garth is only imported once a Garmin upload is actually made
+        import garth
+
         self.client = garth.Client()
+        self.logged_in = False
 
     def login(self, email, password):
         try:
-            self.client.login(email, password)
+            with metrics.stage("garmin.login"):
+                self.client.login(email, password)
+            self.logged_in = True
         except Exception as ex:
             raise ConnectionError(
                 "Authentication failure: {}. Did you enter correct credentials?".format(
@@ -27,9 +44,49 @@ class GarminConnect:
         # Convert the fitfile to a in-memory file for upload
         fit_file = io.BytesIO(ffile.getvalue())
         fit_file.name = "withings.fit"
-        self.client.upload(fit_file)
+        # uploads of all accounts share one adaptive concurrency limit
+        with limiter("garmin.upload").request(), metrics.stage(
+            "garmin.upload"
+        ):
+            self.client.upload(fit_file)
+        metrics.count("garmin.upload", nbytes=len(fit_file.getvalue()))
         return True
 
+    def get_existing(self, startdate, enddate):
+        """get the timestamps of the weigh-ins and blood pressures on Garmin
+        Connect between startdate and enddate
+
+        Returns a dict of UTC epoch seconds per record type, like the
+        "type" of the prepared records."""
+        existing = {"weight": set(), "blood_pressure": set()}
+        # the range endpoints take local calendar days
+        start = time.strftime("%Y-%m-%d", time.localtime(startdate))
+        end = time.strftime("%Y-%m-%d", time.localtime(enddate))
+
+        with metrics.stage("garmin.reconcile"):
+            weights = self.client.connectapi(
+                WEIGHT_RANGE_PATH.format(start=start, end=end)
+            )
+            blood_pressures = self.client.connectapi(
+                BLOOD_PRESSURE_RANGE_PATH.format(start=start, end=end)
+            )
+
+        for summary in (weights or {}).get("dailyWeightSummaries", []):
+            for weight in summary.get("allWeightMetrics", []):
+                existing["weight"].add(weight["timestampGMT"] // 1000)
+        for summary in (blood_pressures or {}).get("measurementSummaries", []):
+            for blood_pressure in summary.get("measurements", []):
+                timestamp = datetime.fromisoformat(
+                    blood_pressure["measurementTimestampGMT"]
+                ).replace(tzinfo=timezone.utc)
+                existing["blood_pressure"].add(int(timestamp.timestamp()))
+
+        metrics.count(
+            "garmin.reconcile",
+            records=sum(len(timestamps) for timestamps in existing.values()),
+        )
+        return existing
+
 
 def sync_garmin(fit_file, args):
     """Sync generated fit file to Garmin Connect"""
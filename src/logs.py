@@ -0,0 +1,59 @@
+"""This module sets up the logging of the sync pipeline."""
+import json
+import logging
+import sys
+
+
+class _Event:
+    """Lazily rendered message of a structured event"""
+
+    __slots__ = ("event", "fields")
+
+    def __init__(self, event, fields):
+        self.event = event
+        self.fields = fields
+
+    def __str__(self):
+        return " ".join(
+            [self.event] + [f"{k}={v}" for k, v in self.fields.items()]
+        )
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Format every log record as a single JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "name": record.name,
+            "level": record.levelname,
+        }
+        if isinstance(record.msg, _Event) and not record.args:
+            entry["event"] = record.msg.event
+            entry.update(record.msg.fields)
+        else:
+            entry["message"] = record.getMessage()
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def log_event(logger, level, event, **fields):
+    """emit one structured event, fields are only rendered by handlers"""
+    if logger.isEnabledFor(level):
+        logger.log(level, _Event(event, fields))
+
+
+def setup_logging(verbose=False, json_file=None, stream=None):
+    """configure the root logger, optionally adding a JSON-lines sink
+
+    Logs go to stdout unless another `stream` is given."""
+    logging.basicConfig(
+        level=logging.DEBUG if verbose else logging.INFO,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        stream=stream or sys.stdout,
+    )
+    if json_file:
+        handler = logging.FileHandler(json_file, encoding="utf-8")
+        handler.setFormatter(JsonLinesFormatter())
+        logging.getLogger().addHandler(handler)
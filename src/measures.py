@@ -0,0 +1,217 @@
+"""This module maps the Withings measures to the FIT fields."""
+from fit import FitBaseType
+from withings import WithingsMeasure
+
+# Every column of the prepared records and the FIT field it is written to:
+# (column, Withings measure type, FIT message, field number, base type,
+# scale). The fields of a message are defined in this order in the FIT
+# files. Columns without a measure type are derived from the others (see
+# DERIVED_COLUMNS) or never set and written as invalid, columns without a
+# message are synced but not written.
+MEASURES = (
+    ("weight", WithingsMeasure.TYPE_WEIGHT, "weight_scale", 0, "uint16", 100),
+    (
+        "fat_ratio",
+        WithingsMeasure.TYPE_FAT_RATIO,
+        "weight_scale",
+        1,
+        "uint16",
+        100,
+    ),
+    ("percent_hydration", None, "weight_scale", 2, "uint16", 100),
+    ("visceral_fat_mass", None, "weight_scale", 3, "uint16", 100),
+    (
+        "bone_mass",
+        WithingsMeasure.TYPE_BONE_MASS,
+        "weight_scale",
+        4,
+        "uint16",
+        100,
+    ),
+    (
+        "muscle_mass",
+        WithingsMeasure.TYPE_MUSCLE_MASS,
+        "weight_scale",
+        5,
+        "uint16",
+        100,
+    ),
+    ("basal_met", None, "weight_scale", 7, "uint16", 4),
+    ("active_met", None, "weight_scale", 9, "uint16", 4),
+    ("physique_rating", None, "weight_scale", 8, "uint8", 1),
+    ("metabolic_age", None, "weight_scale", 10, "uint8", 1),
+    (
+        "visceral_fat_rating",
+        WithingsMeasure.TYPE_VISCERAL_FAT,
+        "weight_scale",
+        11,
+        "uint8",
+        1,
+    ),
+    ("bmi", None, "weight_scale", 13, "uint16", 10),
+    (
+        "systolic_blood_pressure",
+        WithingsMeasure.TYPE_SYSTOLIC_BLOOD_PRESSURE,
+        "blood_pressure",
+        0,
+        "uint16",
+        1,
+    ),
+    (
+        "diastolic_blood_pressure",
+        WithingsMeasure.TYPE_DIASTOLIC_BLOOD_PRESSURE,
+        "blood_pressure",
+        1,
+        "uint16",
+        1,
+    ),
+    ("mean_arterial_pressure", None, "blood_pressure", 2, "uint16", 1),
+    ("map_3_sample_mean", None, "blood_pressure", 3, "uint16", 1),
+    ("map_morning_values", None, "blood_pressure", 4, "uint16", 1),
+    ("map_evening_values", None, "blood_pressure", 5, "uint16", 1),
+    (
+        "heart_pulse",
+        WithingsMeasure.TYPE_HEART_PULSE,
+        "blood_pressure",
+        6,
+        "uint8",
+        1,
+    ),
+    (
+        "fat_free_mass",
+        WithingsMeasure.TYPE_FAT_FREE_MASS,
+        None,
+        None,
+        None,
+        None,
+    ),
+    (
+        "fat_mass_weight",
+        WithingsMeasure.TYPE_FAT_MASS_WEIGHT,
+        None,
+        None,
+        None,
+        None,
+    ),
+    ("hydration", WithingsMeasure.TYPE_HYDRATION, None, None, None, None),
+    ("temperature", WithingsMeasure.TYPE_TEMPERATURE, None, None, None, None),
+    ("spo2", WithingsMeasure.TYPE_SP02, None, None, None, None),
+    (
+        "body_temperature",
+        WithingsMeasure.TYPE_BODY_TEMPERATURE,
+        None,
+        None,
+        None,
+        None,
+    ),
+    (
+        "skin_temperature",
+        WithingsMeasure.TYPE_SKIN_TEMPERATURE,
+        None,
+        None,
+        None,
+        None,
+    ),
+    (
+        "pulse_wave_velocity",
+        WithingsMeasure.TYPE_PULSE_WAVE_VELOCITY,
+        None,
+        None,
+        None,
+        None,
+    ),
+    ("vo2max", WithingsMeasure.TYPE_VO2MAX, None, None, None, None),
+    (
+        "vascular_age",
+        WithingsMeasure.TYPE_VASCULAR_AGE,
+        None,
+        None,
+        None,
+        None,
+    ),
+    (
+        "extracellular_water",
+        WithingsMeasure.TYPE_EXTRACELLULAR_WATER,
+        None,
+        None,
+        None,
+        None,
+    ),
+    (
+        "intracellular_water",
+        WithingsMeasure.TYPE_INTRACELLULAR_WATER,
+        None,
+        None,
+        None,
+        None,
+    ),
+)
+
+# computed by utils.prepare_syncdata from the measures of weight records
+DERIVED_COLUMNS = ("percent_hydration", "bmi")
+
+# kind of record -> the column that makes a group such a record, the first
+# one found wins
+RECORD_TYPES = (
+    ("weight", "weight"),
+    ("blood_pressure", "diastolic_blood_pressure"),
+)
+
+# kind of record -> the FIT message it is written as
+RECORD_MESSAGES = {
+    "weight": "weight_scale",
+    "blood_pressure": "blood_pressure",
+}
+
+# compiled once from the table above:
+# measure type -> column
+COLUMNS_BY_TYPE = {
+    measure_type: column
+    for column, measure_type, *_ in MEASURES
+    if measure_type is not None
+}
+# FIT message -> (column, field number, base type, scale) of its fields
+MESSAGE_FIELDS = {}
+for column, _, message, number, basetype, scale in MEASURES:
+    if message is not None:
+        MESSAGE_FIELDS.setdefault(message, []).append(
+            (column, number, getattr(FitBaseType, basetype), scale)
+        )
+MESSAGE_FIELDS = {
+    message: tuple(fields) for message, fields in MESSAGE_FIELDS.items()
+}
+# the record fields read by the FIT writers
+FIT_FIELDS = ("type", "timestamp", "deviceid") + tuple(
+    column
+    for column, measure_type, message, *_ in MEASURES
+    if message is not None
+    and (measure_type is not None or column in DERIVED_COLUMNS)
+)
+
+
+def record_values(group):
+    """get the value of every mapped measure of a group by column
+
+    A single pass over the measures, the first measure of a type wins."""
+    values = {}
+    for measure in group.measures:
+        column = COLUMNS_BY_TYPE.get(measure.type)
+        if column is not None and column not in values:
+            values[column] = round(measure.get_value(), 2)
+    return values
+
+
+def record_type(values):
+    """get the kind of record of a group's values, None if it has none"""
+    for kind, column in RECORD_TYPES:
+        if values.get(column):
+            return kind
+    return None
+
+
+def message_fields(message, record):
+    """get the (field number, base type, value, scale) of a FIT message"""
+    return [
+        (number, basetype, record.get(column), scale)
+        for column, number, basetype, scale in MESSAGE_FIELDS[message]
+    ]
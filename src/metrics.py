@@ -0,0 +1,91 @@
+"""This module collects per-stage timings and counters of a sync run."""
+import json
+import threading
+import time
+
+from contextlib import contextmanager, nullcontext
+
+COUNTERS = ("calls", "seconds", "bytes", "records", "retries")
+
+
+class Metrics:
+    """This class records wall time, bytes, records and retries per stage"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # a profiling.Profiler, set by --profile
+        self.profiler = None
+        self.reset()
+
+    def reset(self):
+        """start a new run"""
+        with self._lock:
+            self.started = time.time()
+            self.stages = {}
+
+    def _stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = dict.fromkeys(COUNTERS, 0)
+        return self.stages[name]
+
+    @contextmanager
+    def stage(self, name):
+        """time the wrapped block and account it to stage `name`"""
+        profile = self.profiler.stage(name) if self.profiler else nullcontext()
+        start = time.perf_counter()
+        try:
+            with profile:
+                yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                stage = self._stage(name)
+                stage["calls"] += 1
+                stage["seconds"] += elapsed
+
+    def count(self, name, nbytes=0, records=0, retries=0):
+        """add transferred bytes, processed records or retries to a stage"""
+        with self._lock:
+            stage = self._stage(name)
+            stage["bytes"] += nbytes
+            stage["records"] += records
+            stage["retries"] += retries
+
+    def report(self):
+        """get the run report as a dict"""
+        with self._lock:
+            return {
+                "started": self.started,
+                "duration": time.time() - self.started,
+                "stages": {
+                    name: {k: round(v, 6) for k, v in stage.items()}
+                    for name, stage in self.stages.items()
+                },
+            }
+
+    def write_report(self, path):
+        """write the run report as JSON"""
+        with open(path, "w", encoding="utf-8") as fp:
+            json.dump(self.report(), fp, indent=2)
+
+    def prometheus(self, prefix="withings_sync"):
+        """get the run report in Prometheus text exposition format"""
+        report = self.report()
+        lines = [
+            f"# TYPE {prefix}_run_duration_seconds gauge",
+            f"{prefix}_run_duration_seconds {report['duration']:.6f}",
+        ]
+        for counter in COUNTERS:
+            metric = f"{prefix}_stage_{counter}_total"
+            lines.append(f"# TYPE {metric} counter")
+            for name, stage in report["stages"].items():
+                lines.append(f'{metric}{{stage="{name}"}} {stage[counter]}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """write the metrics for the node exporter textfile collector"""
+        with open(path, "w", encoding="utf-8") as fp:
+            fp.write(self.prometheus())
+
+
+metrics = Metrics()
@@ -0,0 +1,134 @@
+"""This module keeps encoded FIT files on disk until Garmin accepted them."""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+from metrics import metrics
+
+log = logging.getLogger("outbox")
+
+
+class Outbox:
+    """Persistent queue of FIT files waiting to be uploaded
+
+    Every entry is a `<id>.fit` payload next to a `<id>.json` file with its
+    description and retry schedule. Entries are only removed once uploaded,
+    failed ones are retried with exponential backoff."""
+
+    def __init__(self, path, base_delay=60, max_delay=86400):
+        self.path = path
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        os.makedirs(path, exist_ok=True)
+
+    def _write(self, name, data):
+        """write a file of the outbox atomically"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(data)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(tmp_path, os.path.join(self.path, name))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _meta(self, entry_id):
+        with open(os.path.join(self.path, entry_id + ".json")) as fp:
+            return json.load(fp)
+
+    def put(self, payload, description=""):
+        """queue a FIT payload, return its entry id
+
+        An identical payload still waiting in the outbox is queued once."""
+        digest = hashlib.sha256(payload).hexdigest()[:16]
+        for entry_id in self.entries(due_only=False):
+            if entry_id.endswith(digest):
+                return entry_id
+
+        entry_id = f"{time.time_ns()}-{digest}"
+        self._write(entry_id + ".fit", payload)
+        meta = {
+            "description": description,
+            "created": time.time(),
+            "attempts": 0,
+            "next_attempt": 0,
+            "error": None,
+        }
+        # the metadata is written last, it marks the entry as complete
+        self._write(entry_id + ".json", json.dumps(meta).encode())
+        return entry_id
+
+    def entries(self, due_only=True, now=None):
+        """get the ids of the queued entries, oldest first"""
+        now = time.time() if now is None else now
+        entry_ids = sorted(
+            name[:-5] for name in os.listdir(self.path) if name.endswith(".json")
+        )
+        if not due_only:
+            return entry_ids
+        return [
+            entry_id
+            for entry_id in entry_ids
+            if self._meta(entry_id)["next_attempt"] <= now
+        ]
+
+    def load(self, entry_id):
+        """get the FIT payload of an entry"""
+        with open(os.path.join(self.path, entry_id + ".fit"), "rb") as fp:
+            return fp.read()
+
+    def remove(self, entry_id):
+        """drop an entry once it is uploaded
+
+        The payload goes first, a crash in between leaves metadata without
+        a payload, which drain() drops, rather than a payload it never
+        sees."""
+        os.unlink(os.path.join(self.path, entry_id + ".fit"))
+        os.unlink(os.path.join(self.path, entry_id + ".json"))
+
+    def failed(self, entry_id, error):
+        """record a failed upload and schedule the next attempt"""
+        meta = self._meta(entry_id)
+        meta["attempts"] += 1
+        delay = min(self.base_delay * 2 ** (meta["attempts"] - 1), self.max_delay)
+        meta["next_attempt"] = time.time() + delay
+        meta["error"] = str(error)
+        self._write(entry_id + ".json", json.dumps(meta).encode())
+        return delay
+
+    def drain(self, upload):
+        """upload the due entries with `upload(payload, description)`
+
+        A failed entry is scheduled for a later attempt and the next ones
+        are still tried, so one bad file doesn't hold up the others.
+        Returns the number of uploaded entries."""
+        uploaded = 0
+        for entry_id in self.entries():
+            meta = self._meta(entry_id)
+            try:
+                payload = self.load(entry_id)
+            except FileNotFoundError:
+                # the payload of an uploaded entry was already removed
+                os.unlink(os.path.join(self.path, entry_id + ".json"))
+                continue
+            if meta["attempts"]:
+                metrics.count("garmin.upload", retries=1)
+            try:
+                upload(payload, meta["description"])
+            except Exception as ex:
+                delay = self.failed(entry_id, ex)
+                log.error(
+                    "Upload of %s failed, retrying in %d s: %s",
+                    entry_id,
+                    delay,
+                    ex,
+                )
+                continue
+            self.remove(entry_id)
+            uploaded += 1
+        return uploaded
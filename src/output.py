@@ -0,0 +1,157 @@
+"""This module streams the prepared sync records to downstream consumers."""
+import json
+import logging
+import sys
+
+from measures import DERIVED_COLUMNS, MEASURES
+
+log = logging.getLogger("output")
+
+OUTPUT_FORMATS = ("json", "ndjson", "parquet", "arrow")
+
+# the columns of the written records, in this order
+COLUMNS = ("timestamp", "deviceid", "type", "height") + tuple(
+    column
+    for column, measure_type, *_ in MEASURES
+    if measure_type is not None or column in DERIVED_COLUMNS
+)
+
+# the columns the FIT files hold as whole numbers, e.g. the heart pulse
+INTEGER_COLUMNS = frozenset(
+    column
+    for column, _, message, _, _, scale in MEASURES
+    if message is not None and scale == 1
+)
+
+
+def to_row(record):
+    """get the columns of a record, None where it has no value"""
+    return {column: record.get(column) for column in COLUMNS}
+
+
+def column_values(records, column):
+    """get the values of a column, truncated like in the FIT files for
+    the integer columns"""
+    values = [record.get(column) for record in records]
+    if column in INTEGER_COLUMNS:
+        values = [None if value is None else int(value) for value in values]
+    return values
+
+
+def raw_measures(record):
+    """render the raw Withings measures of a record as a list, see
+    WithingsMeasure.json_dict
+
+    A merged record can hold several measures of a type, none of them is
+    dropped."""
+    return [measure.json_dict() for measure in record.get("raw_data", ())]
+
+
+class JsonRecordWriter:
+    """Write records as a JSON array, or as JSON lines with `lines`
+
+    Every batch of records is written and flushed as it comes, the array is
+    only closed by close()."""
+
+    def __init__(self, fp, lines=False, close_fp=False):
+        self.fp = fp
+        self.lines = lines
+        self.close_fp = close_fp
+        self.count = 0
+        if not lines:
+            fp.write("[")
+
+    def write(self, records):
+        for record in records:
+            row = to_row(record)
+            row["measures"] = raw_measures(record)
+            text = json.dumps(row, default=str)
+            if self.lines:
+                self.fp.write(text + "\n")
+            else:
+                self.fp.write(("\n" if not self.count else ",\n") + text)
+            self.count += 1
+        self.fp.flush()
+
+    def close(self):
+        if not self.lines:
+            self.fp.write("\n]\n" if self.count else "]\n")
+        self.fp.flush()
+        log.info("%d record(s) written", self.count)
+        if self.close_fp:
+            self.fp.close()
+
+
+class ArrowRecordWriter:
+    """Write records to a Parquet or Arrow IPC file, needs pyarrow
+
+    Every batch of records becomes a record batch (a row group of the
+    Parquet file), so only one window of records is held at a time."""
+
+    def __init__(self, path, parquet=False):
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise RuntimeError(
+                "The parquet and arrow outputs need pyarrow"
+                " (pip install pyarrow)."
+            )
+
+        self.pa = pa
+        self.schema = pa.schema(
+            [
+                ("timestamp", pa.timestamp("s", tz="UTC")),
+                ("deviceid", pa.string()),
+                ("type", pa.string()),
+            ]
+            + [
+                (
+                    column,
+                    pa.int64() if column in INTEGER_COLUMNS else pa.float64(),
+                )
+                for column in COLUMNS[3:]
+            ]
+        )
+        self.count = 0
+        if parquet:
+            import pyarrow.parquet as pq
+
+            self.writer = pq.ParquetWriter(path, self.schema)
+        else:
+            self.writer = pa.ipc.new_file(path, self.schema)
+
+    def write(self, records):
+        if not records:
+            return
+        batch = self.pa.record_batch(
+            [
+                self.pa.array(
+                    column_values(records, field.name), type=field.type
+                )
+                for field in self.schema
+            ],
+            schema=self.schema,
+        )
+        self.writer.write_batch(batch)
+        self.count += len(records)
+
+    def close(self):
+        self.writer.close()
+        log.info("%d record(s) written", self.count)
+
+
+def open_record_writer(output_format, path=None):
+    """open a writer of the records in `output_format`, see OUTPUT_FORMATS
+
+    The JSON formats go to stdout without a `path`."""
+    if output_format in ("json", "ndjson"):
+        lines = output_format == "ndjson"
+        if path is None:
+            return JsonRecordWriter(sys.stdout, lines)
+        fp = open(path, "w", encoding="utf-8")
+        return JsonRecordWriter(fp, lines, close_fp=True)
+    if output_format in ("parquet", "arrow"):
+        if path is None:
+            raise ValueError(f"The {output_format} output needs a file.")
+        return ArrowRecordWriter(path, parquet=output_format == "parquet")
+    raise ValueError(f"Unknown output format: {output_format}")
@@ -0,0 +1,174 @@
+"""This module profiles the CPU time and memory of the sync stages."""
+import cProfile
+import json
+import logging
+import os
+import pstats
+import threading
+import tracemalloc
+
+from contextlib import contextmanager
+
+log = logging.getLogger("profiling")
+
+# metrics stage -> profiled pipeline phase
+PHASES = {
+    "withings.getmeas": "fetch",
+    "archive.read": "fetch",
+    "prepare": "prepare",
+    "fit.encode": "encode",
+    "garmin.upload": "upload",
+}
+TOP = 20
+# the collapsed stacks are cut at this depth and at calls taking less than
+# this share of the profiled time, otherwise the paths through a dense call
+# graph grow exponentially
+MAX_DEPTH = 64
+MIN_SHARE = 1e-4
+
+
+def collapsed_stacks(stats):
+    """render pstats as collapsed stacks, one `f1;f2;f3 microseconds` line
+
+    cProfile only records caller/callee pairs, so the own time of a function
+    is split over its call paths by the share of time spent on each edge.
+    The calls below MAX_DEPTH, and the calls taking less than MIN_SHARE of
+    the total time, count for the stack of their caller."""
+    callees = {}
+    for func, (_, _, _, cumtime, callers) in stats.stats.items():
+        for caller, (_, _, _, edge_cumtime) in callers.items():
+            if cumtime:
+                callees.setdefault(caller, []).append(
+                    (func, edge_cumtime / cumtime)
+                )
+
+    def name(func):
+        filename, line, function = func
+        return f"{function} ({os.path.basename(filename)}:{line})"
+
+    lines = {}
+    roots = [func for func, value in stats.stats.items() if not value[4]]
+    total = sum(stats.stats[root][3] for root in roots)
+    # also the paths that would be rounded to 0 microseconds
+    min_seconds = max(total * MIN_SHARE, 0.5e-6)
+
+    def walk(func, path, share):
+        _, _, tottime, cumtime, _ = stats.stats[func]
+        stack = ";".join(path)
+        if len(path) >= MAX_DEPTH:
+            lines[stack] = lines.get(stack, 0) + cumtime * share
+            return
+        seconds = tottime * share
+        for callee, callee_share in callees.get(func, []):
+            if callee not in stats.stats or name(callee) in path:
+                continue
+            callee_seconds = stats.stats[callee][3] * share * callee_share
+            if callee_seconds < min_seconds:
+                seconds += callee_seconds
+            else:
+                walk(callee, path + [name(callee)], share * callee_share)
+        if seconds:
+            lines[stack] = lines.get(stack, 0) + seconds
+
+    for root in roots:
+        walk(root, [name(root)], 1.0)
+    return [
+        f"{stack} {round(seconds * 1e6)}"
+        for stack, seconds in sorted(lines.items())
+        if round(seconds * 1e6)
+    ]
+
+
+class Profiler:
+    """This class profiles the fetch, prepare, encode and upload phases
+
+    Every phase gets its own cProfile profile and tracemalloc peak. Only one
+    phase is profiled at a time, stages running concurrently on other
+    threads meanwhile are timed but not profiled."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.profiles = {}
+        self.memory = {}
+
+    def start(self):
+        tracemalloc.start()
+
+    def stop(self):
+        tracemalloc.stop()
+
+    @contextmanager
+    def stage(self, name):
+        """profile the wrapped block if stage `name` is part of a phase"""
+        phase = PHASES.get(name)
+        if phase is None or not self._lock.acquire(blocking=False):
+            yield
+            return
+        try:
+            profile = self.profiles.setdefault(phase, cProfile.Profile())
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                self._measure(phase, baseline)
+        finally:
+            self._lock.release()
+
+    def _measure(self, phase, baseline):
+        """keep the peak memory of a phase
+
+        For the call with the highest peak, the largest live allocations
+        right after it are kept as well."""
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+        memory = self.memory.setdefault(phase, {"peak_bytes": 0})
+        if peak <= memory["peak_bytes"]:
+            return
+        memory["peak_bytes"] = peak
+        snapshot = tracemalloc.take_snapshot()
+        memory["allocations"] = [
+            {"line": str(stat.traceback), "bytes": stat.size}
+            for stat in snapshot.statistics("lineno")[:TOP]
+        ]
+
+    def summary(self):
+        """get the peak memory and the slowest functions of every phase"""
+        summary = {}
+        for phase, profile in self.profiles.items():
+            stats = pstats.Stats(profile)
+            functions = sorted(
+                stats.stats.items(), key=lambda item: item[1][3], reverse=True
+            )
+            summary[phase] = dict(
+                self.memory.get(phase, {}),
+                functions=[
+                    {
+                        "function": pstats.func_std_string(func),
+                        "calls": value[1],
+                        "tottime": round(value[2], 6),
+                        "cumtime": round(value[3], 6),
+                    }
+                    for func, value in functions[:TOP]
+                ],
+            )
+        return summary
+
+    def write(self, directory, prefix="profile"):
+        """write `<prefix>-<phase>.pstats`, `<prefix>-<phase>.collapsed` and
+        a `<prefix>.json` summary to directory"""
+        os.makedirs(directory, exist_ok=True)
+        for phase, profile in self.profiles.items():
+            path = os.path.join(directory, f"{prefix}-{phase}")
+            profile.dump_stats(path + ".pstats")
+            with open(path + ".collapsed", "w", encoding="utf-8") as fp:
+                fp.writelines(
+                    line + "\n"
+                    for line in collapsed_stacks(pstats.Stats(profile))
+                )
+        with open(
+            os.path.join(directory, prefix + ".json"), "w", encoding="utf-8"
+        ) as fp:
+            json.dump(self.summary(), fp, indent=2)
+        log.info("Profile written to %s", directory)
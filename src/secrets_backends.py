@@ -0,0 +1,230 @@
+"""This module stores the rotated Withings tokens between runs."""
+import base64
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from metrics import metrics
+
+log = logging.getLogger("secrets_backends")
+
+SECRETS_KEY = "WITHINGS_SECRETS_KEY"
+# the tokens Withings rotates, see withings.ROTATED_SECRETS
+TOKEN_NAMES = ("WITHINGS_ACCESS_TOKEN", "WITHINGS_REFRESH_TOKEN")
+
+
+class EnvSecretBackend:
+    """Tokens kept as variables of a dotenv file, `.env` by default
+
+    Saved tokens replace their lines of the file and the other lines are
+    kept, so the file can hold the rest of the configuration too. It is
+    replaced atomically and only readable by its owner, the tokens aren't
+    encrypted."""
+
+    def __init__(self, path=".env"):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _read_lines(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, encoding="utf-8") as fp:
+            return fp.read().splitlines()
+
+    def load(self, account):
+        secrets = {}
+        with self._lock:
+            for line in self._read_lines():
+                name, sep, value = line.partition("=")
+                if sep and name.strip() in TOKEN_NAMES:
+                    secrets[name.strip()] = value.strip()
+        return secrets
+
+    def save(self, account, secrets):
+        with self._lock:
+            lines = []
+            for line in self._read_lines():
+                name = line.partition("=")[0].strip()
+                if name not in secrets:
+                    lines.append(line)
+            lines.extend(f"{name}={value}" for name, value in secrets.items())
+            data = ("\n".join(lines) + "\n").encode()
+
+            directory = os.path.dirname(os.path.abspath(self.path))
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as fp:
+                    fp.write(data)
+                    fp.flush()
+                    os.fsync(fp.fileno())
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        log.info("Rotated tokens saved to %s", self.path)
+
+
+class FileSecretBackend:
+    """Tokens kept in a local file encrypted with a nacl SecretBox
+
+    The key is the base64 encoded 32 bytes of WITHINGS_SECRETS_KEY. The file
+    holds the tokens of every account, it is replaced atomically."""
+
+    _locks = {}
+
+    def __init__(self, path, key):
+        from nacl.secret import SecretBox
+
+        self.path = path
+        self.box = SecretBox(base64.b64decode(key))
+        self._lock = self._locks.setdefault(
+            os.path.abspath(path), threading.Lock()
+        )
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, "rb") as fp:
+            return json.loads(self.box.decrypt(fp.read()))
+
+    def load(self, account):
+        with self._lock:
+            return self._read().get(account, {})
+
+    def save(self, account, secrets):
+        with self._lock:
+            accounts = self._read()
+            accounts.setdefault(account, {}).update(secrets)
+            data = self.box.encrypt(json.dumps(accounts).encode())
+
+            directory = os.path.dirname(os.path.abspath(self.path))
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as fp:
+                    fp.write(data)
+                    fp.flush()
+                    os.fsync(fp.fileno())
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+
+
+class GitHubSecretBackend:
+    """Tokens stored as GitHub Actions secrets of the repository
+
+    GitHub secrets can't be read back, the workflow passes them in the
+    environment. All secrets of a save share one public key request."""
+
+    def __init__(self, token, repository, api_url):
+        self.token = token
+        self.repository = repository
+        self.api_url = api_url
+
+    def load(self, account):
+        return {}
+
+    def encrypt_secret(self, public_key: str, secret_value: str) -> str:
+        """Encrypt the secret with the provided public key using sodium lib"""
+        import nacl.encoding
+        from nacl.public import PrivateKey, PublicKey, Box
+
+        public_key_bytes = base64.b64decode(public_key)
+        public_key = PublicKey(public_key_bytes)
+
+        private_key = PrivateKey.generate()
+        sealed_box = Box(private_key, public_key)
+
+        encrypted = sealed_box.encrypt(
+            secret_value.encode(), encoder=nacl.encoding.Base64Encoder
+        )
+        return encrypted.decode("utf-8")
+
+    def get_public_key(self):
+        """Get the public key for the repository's secrets."""
+        import requests
+
+        headers = {
+            "Authorization": f"token {self.token}",
+            "Accept": "application/vnd.github+json",
+        }
+        with metrics.stage("github.public_key"):
+            response = requests.get(
+                f"{self.api_url}/repos/{self.repository}"
+                "/actions/secrets/public-key",
+                headers=headers,
+            )
+        metrics.count("github.public_key", nbytes=len(response.content))
+        response.raise_for_status()
+        return response.json()["key"], response.json()["key_id"]
+
+    def save(self, account, secrets):
+        import requests
+
+        public_key, key_id = self.get_public_key()
+        headers = {
+            "Authorization": f"token {self.token}",
+            "Accept": "application/vnd.github.v3+json",
+        }
+
+        for secret_name, secret_value in secrets.items():
+            data = {
+                "encrypted_value": self.encrypt_secret(
+                    public_key, secret_value
+                ),
+                "key_id": key_id,
+            }
+            url = (
+                f"{self.api_url}/repos/{self.repository}"
+                f"/actions/secrets/{secret_name}"
+            )
+
+            try:
+                log.info(
+                    "Updating secret: %s for repository: %s",
+                    secret_name,
+                    self.repository,
+                )
+                with metrics.stage("github.update_secret"):
+                    response = requests.put(url, headers=headers, json=data)
+                metrics.count(
+                    "github.update_secret", nbytes=len(response.content)
+                )
+                response.raise_for_status()
+                log.info("Successfully updated secret: %s", secret_name)
+            except requests.exceptions.RequestException as e:
+                log.error(
+                    "Failed to update secret: %s. Error: %s", secret_name, e
+                )
+                raise
+
+
+def open_secret_backend(spec, environ, github_api_url):
+    """open the secret backend `spec`: "github", "env", "env:PATH" or
+    "file:PATH"
+
+    A backend object, e.g. of the batch mode, is returned as is."""
+    if not isinstance(spec, str):
+        return spec
+    if spec == "env":
+        return EnvSecretBackend()
+    if spec.startswith("env:"):
+        return EnvSecretBackend(spec[len("env:"):])
+    if spec.startswith("file:"):
+        try:
+            key = environ[SECRETS_KEY]
+        except KeyError:
+            raise AttributeError(f"{SECRETS_KEY} is not set.")
+        return FileSecretBackend(spec[len("file:"):], key)
+    if spec == "github":
+        try:
+            return GitHubSecretBackend(
+                environ["GH_TOKEN"],
+                environ["GH_REPOSITORY"],
+                github_api_url,
+            )
+        except KeyError:
+            raise AttributeError("Some ENVIRONMENT variables are not found.")
+    raise ValueError(f"Unknown secret backend: {spec}")
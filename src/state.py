@@ -0,0 +1,103 @@
+"""This module persists the sync state between runs."""
+import json
+import os
+import tempfile
+import threading
+
+SQLITE_SUFFIXES = (".db", ".sqlite", ".sqlite3")
+
+
+class StateStore:
+    """In-memory state store, the base of the persistent ones
+
+    The state is a small JSON document per account, e.g. the timestamp of
+    the last synced measurement or the progress of a chunked sync."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = {}
+
+    def get(self, account, key, default=None):
+        """get a state value of an account"""
+        with self._lock:
+            return self._state.get(account, {}).get(key, default)
+
+    def set(self, account, key, value):
+        """set a state value of an account, None removes it"""
+        with self._lock:
+            values = self._state.setdefault(account, {})
+            if value is None:
+                values.pop(key, None)
+            else:
+                values[key] = value
+            self._save(account, key, value)
+
+    def _save(self, account, key, value):
+        pass
+
+
+class FileStateStore(StateStore):
+    """State store kept in a JSON file, replaced atomically on every write"""
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as fp:
+                self._state = json.load(fp)
+
+    def _save(self, account, key, value):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as fp:
+                json.dump(self._state, fp, indent=2)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+class SQLiteStateStore(StateStore):
+    """State store kept in a SQLite database, one row per value"""
+
+    def __init__(self, path):
+        import sqlite3
+
+        super().__init__()
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            " account TEXT, key TEXT, value TEXT,"
+            " PRIMARY KEY (account, key))"
+        )
+        self._db.commit()
+        for account, key, value in self._db.execute(
+            "SELECT account, key, value FROM state"
+        ):
+            self._state.setdefault(account, {})[key] = json.loads(value)
+
+    def _save(self, account, key, value):
+        with self._db:
+            if value is None:
+                self._db.execute(
+                    "DELETE FROM state WHERE account = ? AND key = ?",
+                    (account, key),
+                )
+            else:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO state VALUES (?, ?, ?)",
+                    (account, key, json.dumps(value)),
+                )
+
+
+def open_state_store(path=None):
+    """open the state store at `path`, picking the backend by its suffix"""
+    if path is None:
+        return StateStore()
+    if path.endswith(SQLITE_SUFFIXES):
+        return SQLiteStateStore(path)
+    return FileStateStore(path)
@@ -1,22 +1,32 @@
 """This module syncs measurement data from Withings to Garmin a/o TrainerRoad."""
 import argparse
-import time
+import io
+import os
 import sys
+import time
 import logging
 
 from datetime import date, datetime
 
 from withings import WithingsAccount
-from garmin import sync_garmin
+from garmin import GarminConnect
+from logs import setup_logging
+from metrics import metrics
+from outbox import Outbox
+from output import OUTPUT_FORMATS, open_record_writer
+from state import open_state_store
 from utils import (
+    DEVICE_INFO_MODES,
+    drop_existing,
     generate_fitdata,
+    generate_fitdata_combined,
     prepare_syncdata,
+    split_merge_cluster,
 )
 
 
-def sync(withings, args):
-    """Sync measurements from Withings to Garmin a/o TrainerRoad"""
-
+def get_sync_range(withings, args):
+    """get the start and end timestamps to sync"""
     if not args.fromdate:
         startdate = withings.get_lastsync()
     else:
@@ -28,45 +38,506 @@ def sync(withings, args):
         time.strftime("%Y-%m-%d %H:%M", time.localtime(startdate)),
         time.strftime("%Y-%m-%d %H:%M", time.localtime(enddate)),
     )
+    return startdate, enddate
+
+
+def split_range(startdate, enddate, chunk_days, newest_first=False):
+    """split [startdate, enddate] into windows of `chunk_days` days
+
+    With newest_first, the windows are aligned to enddate and returned in
+    descending order."""
+    if not chunk_days:
+        return [(startdate, enddate)]
+    step = chunk_days * 86400
+    if newest_first:
+        return [
+            (max(window_end - step + 1, startdate), window_end)
+            for window_end in range(enddate, startdate - 1, -step)
+        ]
+    return [
+        (window_start, min(window_start + step - 1, enddate))
+        for window_start in range(startdate, enddate + 1, step)
+    ]
+
+
+def archive_max_age(args):
+    """get --archive-max-age in seconds, None if not given"""
+    if args.archive_max_age is None:
+        return None
+    return args.archive_max_age * 86400
+
+
+def missing_ranges(startdate, enddate, done):
+    """get the parts of startdate..enddate outside of the `done` ranges,
+    in ascending order"""
+    missing = []
+    position = startdate
+    for start, end in sorted(done):
+        if start > position:
+            missing.append((position, min(start - 1, enddate)))
+        position = max(position, end + 1)
+        if position > enddate:
+            break
+    if position <= enddate:
+        missing.append((position, enddate))
+    return missing
+
+
+def plan_windows(withings, startdate, enddate, args):
+    """get the windows of startdate..enddate left to sync, in sync order
+
+    The windows checkpointed by an interrupted run from the same startdate
+    are left out, also when that run had an earlier end, so a run resumed
+    on a later day only syncs what is missing."""
+    missing = missing_ranges(
+        startdate, enddate, withings.get_checkpoint(startdate)
+    )
+    if missing != [(startdate, enddate)]:
+        for first, last in missing:
+            logging.info(
+                "Resuming sync of %s to %s",
+                time.strftime("%Y-%m-%d %H:%M", time.localtime(first)),
+                time.strftime("%Y-%m-%d %H:%M", time.localtime(last)),
+            )
+    if args.newest_first:
+        missing.reverse()
+    return [
+        window
+        for first, last in missing
+        for window in split_range(
+            first, last, args.chunk_days, args.newest_first
+        )
+    ]
+
+
+def fetch_windows(withings, windows, tolerance):
+    """fetch the measure groups of the windows, in the given order
+
+    Yields the (start, end, groups) of every window, with None groups for a
+    failed fetch, after which no window is fetched. The groups that a merge
+    (see --merge-window) could join with the next window's are moved to it
+    with their part of the range, so a weigh-in isn't split into two records
+    by a window boundary. The range is only cut at a gap of more than
+    `tolerance` seconds, so a resumed run cuts it at the same place."""
+    carried = []
+    span = None
+    for index, (start, end) in enumerate(windows):
+        groups = withings.get_measurements(startdate=start, enddate=end)
+        if groups is None:
+            yield start, end, None
+            return
+        groups = carried + groups
+        if span is not None:
+            start, end = min(start, span[0]), max(end, span[1])
+        carried = []
+        span = None
+        following = windows[index + 1] if index + 1 < len(windows) else None
+        if following and following[0] == end + 1:
+            # oldest first, the first groups of the next window
+            groups, carried = split_merge_cluster(groups, tolerance, end + 1)
+            if carried:
+                span = (carried[0].date, end)
+                end = carried[0].date - 1
+        elif following and following[1] == start - 1:
+            # newest first, the last groups of the previous window
+            groups, carried = split_merge_cluster(
+                groups, tolerance, start - 1
+            )
+            if carried:
+                span = (start, carried[-1].date)
+                start = carried[-1].date + 1
+        if start <= end:
+            yield start, end, groups
+
+
+def merge_chunks(chunks, tolerance):
+    """move the measure groups that a merge could join with the next chunk's
+    to it, see fetch_windows
+
+    The chunks are in file order, the groups chained to the last one read
+    are carried over."""
+    carried = []
+    for groups in chunks:
+        groups, carried = split_merge_cluster(
+            carried + groups, tolerance, groups[-1].date
+        )
+        if groups:
+            yield groups
+    if carried:
+        yield carried
+
+
+def get_existing(garmin, startdate, enddate, args):
+    """get the records Garmin Connect already has, if --reconcile is set"""
+    if not garmin or not args.reconcile:
+        return None
+    if not garmin.logged_in:
+        garmin.login(args.garmin_username, args.garmin_password)
+    return garmin.get_existing(startdate, enddate)
+
+
+def fit_options(args):
+    """get whether weight and blood pressure share a fit file, and the
+    encoding options of the fit files"""
+    combined = "BLOOD_PRESSURE" in args.features and not args.fit_separate
+    options = {
+        "device_info": args.fit_device_info,
+        "compact": args.fit_compact,
+        # cached files are only reusable if the same records give the same
+        # bytes
+        "deterministic": args.fit_deterministic or bool(args.fit_cache),
+    }
+    return combined, options
+
+
+def encode_fitdata(height, groups, args, existing=None, output=None):
+    """Prepare the measure groups and encode them as fit files
+
+    Weight and blood pressure go into one file when the blood pressure
+    feature is enabled, unless `args.fit_separate` is set. Records in
+    `existing` (see GarminConnect.get_existing) are left out of the fit
+    files, all records are written to the `output` record writer (see
+    output.open_record_writer). Returns the timestamp of the last
+    measurement and a list of (description, fit file) tuples."""
+    with metrics.stage("prepare"):
+        _, last_timestamp, syncdata = prepare_syncdata(height, groups, args)
+        if output is not None:
+            output.write(syncdata)
+        if existing:
+            syncdata = drop_existing(syncdata, existing)
+    metrics.count("prepare", records=len(syncdata))
+
+    combined, options = fit_options(args)
+    cache = key = None
+    if args.fit_cache:
+        from fitcache import FitCache, records_key
+
+        cache = FitCache(args.fit_cache)
+        key = records_key(syncdata, combined=combined, **options)
+        cached = cache.get(key)
+        if cached is not None:
+            logging.info("Reusing the cached fit files of unchanged records")
+            metrics.count("fit.cache", records=len(syncdata))
+            return last_timestamp, [
+                (description, io.BytesIO(payload))
+                for description, payload in cached
+            ]
+
+    with metrics.stage("fit.encode"):
+        if combined:
+            fit_files = [
+                (
+                    "weight and blood pressure",
+                    generate_fitdata_combined(syncdata, **options),
+                )
+            ]
+        else:
+            fit_weight, fit_blood_pressure = generate_fitdata(
+                syncdata, **options
+            )
+            fit_files = [
+                ("weight", fit_weight),
+                ("blood pressure", fit_blood_pressure),
+            ]
+    fit_files = [
+        (description, fit) for description, fit in fit_files if fit is not None
+    ]
+    if cache is not None:
+        cache.put(key, [(d, fit.getvalue()) for d, fit in fit_files])
+    return last_timestamp, fit_files
+
+
+def unsent(fit_files, args):
+    """leave out the fit files uploaded before, with --fit-cache"""
+    if not args.fit_cache:
+        return fit_files
+    from fitcache import FitCache
+
+    cache = FitCache(args.fit_cache)
+    remaining = [
+        (description, fit)
+        for description, fit in fit_files
+        if not cache.was_sent(fit.getvalue())
+    ]
+    if len(remaining) < len(fit_files):
+        logging.info(
+            "%d fit file(s) were uploaded before, skipping them",
+            len(fit_files) - len(remaining),
+        )
+    return remaining
+
+
+def mark_sent(payload, args):
+    """remember an uploaded fit file, with --fit-cache"""
+    if args.fit_cache:
+        from fitcache import FitCache
+
+        FitCache(args.fit_cache).mark_sent(payload)
+
+
+def upload_fitdata(garmin, fit_files, args, outbox=None):
+    """Upload the fit files to Garmin Connect
+
+    With an outbox, the files are queued before the upload and stay queued
+    until Garmin accepted them. Tells if the files were uploaded or queued,
+    which includes identical files uploaded before."""
+    fit_files = unsent(fit_files, args)
+    if not fit_files:
+        return True
+    if outbox is not None:
+        for description, fit in fit_files:
+            outbox.put(fit.getvalue(), description)
+        drain_outbox(garmin, args, outbox)
+        return True
+
+    uploaded = False
+    logging.debug("attempting to upload fit file...")
+    if not garmin.logged_in:
+        garmin.login(args.garmin_username, args.garmin_password)
+    for description, fit in fit_files:
+        if garmin.upload_file(fit):
+            uploaded = True
+            mark_sent(fit.getvalue(), args)
+            logging.info(
+                "Fit file with %s information uploaded to Garmin Connect",
+                description,
+            )
+    return uploaded
+
+
+def drain_outbox(garmin, args, outbox):
+    """Upload the due fit files of the outbox"""
+
+    def upload(payload, description):
+        if not garmin.logged_in:
+            garmin.login(args.garmin_username, args.garmin_password)
+        garmin.upload_file(io.BytesIO(payload))
+        mark_sent(payload, args)
+        logging.info(
+            "Fit file with %s information uploaded to Garmin Connect",
+            description,
+        )
+
+    outbox.drain(upload)
+    queued = len(outbox.entries(due_only=False))
+    if queued:
+        logging.warning("%d fit file(s) waiting in the outbox", queued)
+
+
+def sync(withings, args, outbox=None, output=None):
+    """Sync measurements from Withings to Garmin a/o TrainerRoad
+
+    The range is synced in windows of `args.chunk_days` days. The progress is
+    saved after every uploaded window, so an interrupted run resumes with
+    the windows it didn't complete (see plan_windows). With
+    `args.newest_first`, the most recent window is synced first and the
+    older ones follow in descending order. Fit files queued in the
+    `outbox` count as uploaded, they are retried by the next runs. The
+    records of every window are streamed to the `output` record writer."""
+    startdate, enddate = get_sync_range(withings, args)
+    newest_first = args.newest_first
 
     height = withings.get_height()
-    groups = withings.get_measurements(startdate=startdate, enddate=enddate)
+    synced = False
+    upload = not args.no_upload and args.garmin_username
+    garmin = GarminConnect() if upload else None
+    # newest first, the last sync only moves once all windows are uploaded
+    lastsync = None
+    complete = True
+
+    windows = plan_windows(withings, startdate, enddate, args)
+    for window_start, window_end, groups in fetch_windows(
+        withings, windows, args.merge_window
+    ):
+        if groups is None:
+            # nothing is checkpointed, the next run fetches the window again
+            raise ConnectionError("Fetching the Withings measurements failed")
+        if not groups:
+            if not args.no_upload:
+                withings.add_checkpoint(startdate, window_start, window_end)
+            continue
+        synced = True
+
+        existing = get_existing(garmin, window_start, window_end, args)
+        last_timestamp, fit_files = encode_fitdata(
+            height, groups, args, existing, output
+        )
+
+        if args.no_upload:
+            logging.info("Skipping upload")
+            continue
+        # Upload to Garmin Connect
+        if not garmin:
+            logging.info("No Garmin username - skipping sync")
+            continue
+        if not fit_files:
+            # Garmin Connect has every record, the window is synced
+            logging.info("No new measurements to upload")
+        # the Garmin session is reused for every file and window
+        if upload_fitdata(garmin, fit_files, args, outbox):
+            withings.add_checkpoint(startdate, window_start, window_end)
+            # Save this sync so we don't re-download the same data again (if no range has been specified)
+            if args.fromdate or last_timestamp is None:
+                continue
+            if newest_first:
+                lastsync = max(lastsync or last_timestamp, last_timestamp)
+            else:
+                withings.set_lastsync(last_timestamp)
+        else:
+            complete = False
+
+    if lastsync is not None and complete:
+        withings.set_lastsync(lastsync)
+    withings.clear_checkpoint()
+
+    # retry the files left over by earlier runs, even without new data
+    if garmin and outbox is not None and not synced:
+        drain_outbox(garmin, args, outbox)
 
     # Only upload if there are measurement returned
-    if groups is None or len(groups) == 0:
+    if not synced:
         logging.error("No measurements to upload for date or period specified")
         return
+    return 0
 
-    _, _, syncdata = prepare_syncdata(height, groups, args)
 
-    fit_data_weight, fit_data_blood_pressure = generate_fitdata(syncdata)
+def sync_archive(args, outbox=None, output=None):
+    """Sync the measurements of a Withings data export archive
 
-    if not args.no_upload:
-        # Upload to Garmin Connect
-        if args.garmin_username and (
-            fit_data_weight is not None or fit_data_blood_pressure is not None
-        ):
-            logging.debug("attempting to upload fit file...")
-            if fit_data_weight is not None:
-                gar_wg_state = sync_garmin(fit_data_weight, args)
-                if gar_wg_state:
-                    logging.info(
-                        "Fit file with weight information uploaded to Garmin Connect"
-                    )
-            if fit_data_blood_pressure is not None:
-                gar_bp_state = sync_garmin(fit_data_blood_pressure, args)
-                if gar_bp_state:
-                    logging.info(
-                        "Fit file with blood pressure information uploaded to Garmin Connect"
-                    )
-            if gar_wg_state or gar_bp_state:
-                # Save this sync so we don't re-download the same data again (if no range has been specified)
-                if not args.fromdate:
-                    withings.set_lastsync()
-        else:
-            logging.info("No Garmin username - skipping sync")
-    else:
+    The archive is parsed locally and fed to the same prepare, encode and
+    upload steps as the API measurements, in chunks of groups."""
+    from withings_export import WithingsExport
+
+    startdate = 0
+    if args.fromdate:
+        startdate = int(time.mktime(args.fromdate.timetuple()))
+    enddate = int(time.mktime(args.todate.timetuple())) + 86399
+
+    upload = not args.no_upload and args.garmin_username
+    garmin = GarminConnect() if upload else None
+    synced = False
+
+    with WithingsExport(args.import_archive) as archive:
+        height = archive.get_height()
+        chunks = archive.iter_groups(startdate, enddate)
+        for groups in merge_chunks(chunks, args.merge_window):
+            synced = True
+            metrics.count("import", records=len(groups))
+            existing = get_existing(
+                garmin,
+                min(group.date for group in groups),
+                max(group.date for group in groups),
+                args,
+            )
+            _, fit_files = encode_fitdata(
+                height, groups, args, existing, output
+            )
+            if args.no_upload:
+                logging.info("Skipping upload")
+            elif not garmin:
+                logging.info("No Garmin username - skipping sync")
+            elif not fit_files:
+                logging.info("No new measurements to upload")
+            else:
+                upload_fitdata(garmin, fit_files, args, outbox)
+
+    if not synced:
+        logging.error("No measurements to upload for date or period specified")
+        return
+    return 0
+
+
+async def sync_async(
+    args, state=None, outbox=None, archive=None, output=None
+):
+    """Sync measurements, overlapping the steps that don't depend on each other
+
+    Once the access token is refreshed, the secret updates, the height and
+    measurement fetches and the Garmin login run concurrently, then the fit
+    files are uploaded concurrently through a single Garmin session. Unlike
+    sync(), the whole range is one window, without checkpoints."""
+    import asyncio
+
+    withings = await asyncio.to_thread(
+        WithingsAccount,
+        update_secrets=False,
+        state=state,
+        archive=archive,
+        secrets=args.secrets,
+    )
+    startdate, enddate = get_sync_range(withings, args)
+
+    upload = not args.no_upload and args.garmin_username
+    garmin = GarminConnect() if upload else None
+
+    steps = [
+        asyncio.to_thread(withings.get_height),
+        asyncio.to_thread(
+            withings.get_measurements, startdate=startdate, enddate=enddate
+        ),
+    ]
+    steps.append(asyncio.to_thread(withings.withings.update_secrets))
+    # with an outbox the login waits for the upload, so that a Garmin outage
+    # doesn't keep the files from being queued
+    if garmin and outbox is None:
+        steps.append(
+            asyncio.to_thread(
+                garmin.login, args.garmin_username, args.garmin_password
+            )
+        )
+    # a failed step is only raised once the others are done, the rotated
+    # tokens must be saved even if the login or a fetch failed
+    results = await asyncio.gather(*steps, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    height, groups, *_ = results
+
+    if groups is None:
+        raise ConnectionError("Fetching the Withings measurements failed")
+    # Only upload if there are measurement returned
+    if len(groups) == 0:
+        # retry the files left over by earlier runs, like sync()
+        if garmin and outbox is not None:
+            await asyncio.to_thread(drain_outbox, garmin, args, outbox)
+        logging.error("No measurements to upload for date or period specified")
+        return
+
+    existing = await asyncio.to_thread(
+        get_existing, garmin, startdate, enddate, args
+    )
+    last_timestamp, fit_files = encode_fitdata(
+        height, groups, args, existing, output
+    )
+
+    if args.no_upload:
         logging.info("Skipping upload")
+        return 0
+    if not garmin:
+        logging.info("No Garmin username - skipping sync")
+        return 0
+    if not fit_files:
+        # Garmin Connect has every record, they are synced
+        logging.info("No new measurements to upload")
+    elif outbox is not None:
+        await asyncio.to_thread(upload_fitdata, garmin, fit_files, args, outbox)
+    else:
+        logging.debug("attempting to upload fit files...")
+        fit_files = unsent(fit_files, args)
+        states = await asyncio.gather(
+            *[
+                asyncio.to_thread(garmin.upload_file, fit)
+                for _, fit in fit_files
+            ]
+        )
+        for (_, fit), uploaded in zip(fit_files, states):
+            if uploaded:
+                mark_sent(fit.getvalue(), args)
+        logging.info("%d fit file(s) uploaded to Garmin Connect", sum(states))
+        if not all(states):
+            return 0
+    if not args.fromdate and last_timestamp is not None:
+        withings.set_lastsync(last_timestamp)
     return 0
 
 
@@ -128,19 +599,357 @@ if __name__ == "__main__":
         help="Enable Features like BLOOD_PRESSURE.",
     )
 
+    parser.add_argument(
+        "--merge-window",
+        type=int,
+        default=0,
+        metavar="SECONDS",
+        help=(
+            "Merge the measure groups of a kind up to SECONDS apart into one"
+            " record, e.g. the weight and body composition of a weigh-in"
+            " (default: 0, only groups with the same timestamp)."
+        ),
+    )
+
+    parser.add_argument(
+        "--fit-device-info",
+        choices=DEVICE_INFO_MODES,
+        default="record",
+        help=(
+            "Write a device_info message before every record (default),"
+            " once per file or once per Withings device."
+        ),
+    )
+
+    parser.add_argument(
+        "--fit-compact",
+        action="store_true",
+        help="Leave fields without a value out of the FIT file.",
+    )
+
+    parser.add_argument(
+        "--fit-deterministic",
+        action="store_true",
+        help=(
+            "Take the creation time of the FIT files from the latest"
+            " measurement, so the same measurements give the same file."
+        ),
+    )
+
+    parser.add_argument(
+        "--fit-cache",
+        type=str,
+        metavar="DIR",
+        help=(
+            "Cache the encoded FIT files in DIR by the measurements they"
+            " contain and don't upload a file that was uploaded before"
+            " (implies --fit-deterministic)."
+        ),
+    )
+
+    parser.add_argument(
+        "--fit-separate",
+        action="store_true",
+        help=(
+            "Upload weight and blood pressure as separate FIT files instead"
+            " of a single one."
+        ),
+    )
+
+    parser.add_argument(
+        "--newest-first",
+        action="store_true",
+        help=(
+            "Sync the windows of --chunk-days from the most recent one back,"
+            " so a long backfill uploads the latest measurements first."
+        ),
+    )
+
+    parser.add_argument(
+        "--reconcile",
+        action="store_true",
+        help=(
+            "Fetch the weigh-ins and blood pressures already on Garmin"
+            " Connect and only upload the missing ones."
+        ),
+    )
+
+    parser.add_argument(
+        "--secrets",
+        type=str,
+        metavar="BACKEND",
+        help=(
+            "Where the rotated Withings tokens are saved: github (Actions"
+            " secrets, default), env or env:PATH (a dotenv file, .env by"
+            " default) or file:PATH (encrypted with WITHINGS_SECRETS_KEY)."
+            " Not with --accounts, which keeps them per account."
+        ),
+    )
+
+    parser.add_argument(
+        "--state",
+        type=str,
+        metavar="FILE",
+        help=(
+            "Keep the last sync and the progress of chunked syncs in FILE"
+            " (JSON, or SQLite for .db/.sqlite files)."
+        ),
+    )
+
+    parser.add_argument(
+        "--chunk-days",
+        type=int,
+        default=0,
+        metavar="DAYS",
+        help=(
+            "Sync and checkpoint in windows of DAYS days (default: 0, the"
+            " whole range in one window)."
+        ),
+    )
+
+    parser.add_argument(
+        "--archive",
+        type=str,
+        metavar="DIR",
+        help=(
+            "Keep every fetched measurement in DIR and read date ranges that"
+            " were fetched before from there instead of Withings."
+        ),
+    )
+
+    parser.add_argument(
+        "--archive-max-age",
+        type=int,
+        metavar="DAYS",
+        help=(
+            "Fetch archived date ranges from Withings again once they were"
+            " fetched more than DAYS days ago (default: never)."
+        ),
+    )
+
+    parser.add_argument(
+        "--accounts",
+        type=str,
+        metavar="FILE",
+        help=(
+            "Sync every Withings account of the JSON accounts FILE, the"
+            " rotated tokens are written back to it."
+        ),
+    )
+
+    parser.add_argument(
+        "--queue",
+        type=str,
+        metavar="FILE",
+        help=(
+            "Run as a worker syncing the --accounts claimed from the shared"
+            " SQLite work queue FILE, until no account is left."
+        ),
+    )
+
+    parser.add_argument(
+        "--enqueue",
+        action="store_true",
+        help="Queue a sync of every account of --accounts before working.",
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        metavar="N",
+        help=(
+            "Encode the fit files of --accounts on N processes"
+            " (default: one per core)."
+        ),
+    )
+
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=8,
+        metavar="N",
+        help="Sync up to N of the --accounts at the same time (default: 8).",
+    )
+
+    parser.add_argument(
+        "--import-archive",
+        type=str,
+        metavar="ZIP",
+        help=(
+            "Sync the weight.csv and bp.csv files of a Withings data export"
+            " archive instead of calling the Withings API."
+        ),
+    )
+
+    parser.add_argument(
+        "--outbox",
+        type=str,
+        metavar="DIR",
+        help=(
+            "Queue fit files in DIR until Garmin accepted them, failed uploads"
+            " are retried by the next runs."
+        ),
+    )
+
+    parser.add_argument(
+        "--async",
+        dest="run_async",
+        action="store_true",
+        help=(
+            "Overlap independent network steps of the sync, which fetches"
+            " the range in one window (not with --chunk-days)."
+        ),
+    )
+
+    parser.add_argument(
+        "--output",
+        choices=OUTPUT_FORMATS,
+        help=(
+            "Also write the processed records as a JSON array, JSON lines,"
+            " or a Parquet or Arrow IPC file (these two need pyarrow)."
+            " Windows checkpointed by an interrupted sync aren't written"
+            " again."
+        ),
+    )
+
+    parser.add_argument(
+        "--output-file",
+        type=str,
+        metavar="FILE",
+        help="Write the --output records to FILE (default: stdout).",
+    )
+
     parser.add_argument(
         "--verbose", "-v", action="store_true", help="Run verbosely."
     )
 
+    parser.add_argument(
+        "--log-json",
+        type=str,
+        metavar="FILE",
+        help="Also write logs as JSON lines to FILE.",
+    )
+
+    parser.add_argument(
+        "--report",
+        type=str,
+        metavar="FILE",
+        help="Write a JSON run report with per-stage metrics to FILE.",
+    )
+
+    parser.add_argument(
+        "--metrics-file",
+        type=str,
+        metavar="FILE",
+        help="Write per-stage metrics in Prometheus text format to FILE.",
+    )
+
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help=(
+            "Profile the CPU time and peak memory of the fetch, prepare,"
+            " encode and upload stages, written next to the --report or"
+            " --metrics-file (default: the current directory)."
+        ),
+    )
+
     args = parser.parse_args()
+    if args.output and (args.accounts or args.queue):
+        parser.error("--output syncs a single account")
+    if args.outbox and (args.accounts or args.queue):
+        parser.error("--outbox syncs a single account")
+    # the backends are shared, the tokens of every account would overwrite
+    # each other, --accounts keeps them per account
+    if args.secrets and (args.accounts or args.queue):
+        parser.error("--secrets syncs a single account")
+    if args.secrets is None:
+        args.secrets = "github"
+    # sync_async fetches and uploads the range in one window
+    if args.run_async and (args.chunk_days or args.newest_first):
+        parser.error(
+            "--async syncs the range in one window, it doesn't take"
+            " --chunk-days or --newest-first"
+        )
 
-    logging.basicConfig(
-        level=logging.DEBUG if args.verbose else logging.INFO,
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-        stream=sys.stdout,
+    # keep the records written to stdout apart from the logs
+    setup_logging(
+        verbose=args.verbose,
+        json_file=args.log_json,
+        stream=sys.stderr if args.output and not args.output_file else None,
     )
 
     logging.debug("Script invoked with the following arguments: %s", args)
 
-    withings = WithingsAccount()
-    sync(withings, args)
+    state = open_state_store(args.state)
+    outbox = Outbox(args.outbox) if args.outbox else None
+    output = None
+    if args.output:
+        output = open_record_writer(args.output, args.output_file)
+    profiler = None
+    if args.profile:
+        from profiling import Profiler
+
+        profiler = Profiler()
+        profiler.start()
+        metrics.profiler = profiler
+    archive = None
+    if args.archive:
+        from archive import MeasureArchive
+
+        archive = MeasureArchive(args.archive, archive_max_age(args))
+    # accounts whose sync failed, see sync_batch and run_worker
+    failed = 0
+    try:
+        if args.import_archive:
+            sync_archive(args, outbox=outbox, output=output)
+        elif args.queue:
+            from batch import run_worker
+
+            failed = run_worker(
+                args.queue,
+                args.accounts,
+                args,
+                workers=args.workers,
+                enqueue=args.enqueue,
+            )
+        elif args.accounts:
+            from batch import sync_batch
+
+            failed = sync_batch(
+                args.accounts,
+                args,
+                state=state,
+                workers=args.workers,
+                jobs=args.jobs,
+            )
+        elif args.run_async:
+            import asyncio
+
+            asyncio.run(
+                sync_async(
+                    args,
+                    state=state,
+                    outbox=outbox,
+                    archive=archive,
+                    output=output,
+                )
+            )
+        else:
+            withings = WithingsAccount(
+                state=state, archive=archive, secrets=args.secrets
+            )
+            sync(withings, args, outbox=outbox, output=output)
+    finally:
+        if output is not None:
+            output.close()
+        if args.report:
+            metrics.write_report(args.report)
+        if args.metrics_file:
+            metrics.write_prometheus(args.metrics_file)
+        if profiler:
+            profiler.stop()
+            profiler.write(
+                os.path.dirname(args.report or args.metrics_file or "") or "."
+            )
+    sys.exit(1 if failed else 0)
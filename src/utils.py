@@ -1,10 +1,100 @@
+import hashlib
+import json
 import logging
-from fit import FitEncoderWeight, FitEncoderBloodPressure
+from bisect import bisect_right
+from datetime import datetime
+from operator import attrgetter, itemgetter
+from fit import FitEncoderWeight, FitEncoderBloodPressure, FitEncoderCombined
+from logs import log_event
+from measures import (
+    FIT_FIELDS,
+    RECORD_MESSAGES,
+    message_fields,
+    record_type,
+    record_values,
+)
 
+log = logging.getLogger("utils")
 
-def generate_fitdata(syncdata):
-    """Generate fit data from measured data"""
-    logging.debug("Generating fit data...")
+
+DEVICE_INFO_MODES = ("record", "file", "device")
+
+
+def write_device_info(fit, record, mode, devices):
+    """Write the device_info message of a record
+
+    mode "record" writes one before every record, "file" only before the
+    first record of the file and "device" before the first record of each
+    Withings device. `devices` maps the devices seen so far to their index."""
+    if mode == "record":
+        fit.write_device_info(timestamp=record["timestamp"])
+        return
+    device = record.get("deviceid") if mode == "device" else None
+    if device in devices:
+        return
+    devices[device] = len(devices)
+    fit.write_device_info(
+        timestamp=record["timestamp"],
+        device_index=devices[device] if mode == "device" else None,
+    )
+
+
+def write_record(fit, record):
+    """Write the FIT message of a weight or blood pressure record"""
+    message = RECORD_MESSAGES[record["type"]]
+    fit.write_message(
+        message, record["timestamp"], message_fields(message, record)
+    )
+
+
+def file_time_created(records, deterministic):
+    """get the time_created of a FIT file, None for the current time
+
+    deterministic: take the time of the latest record, so the same records
+    always give the same bytes"""
+    if not deterministic:
+        return None
+    return max(record["timestamp"] for record in records)
+
+
+def file_serial_number(records, deterministic):
+    """get the serial_number of a FIT file, None to leave it out
+
+    deterministic: hash the records, files of different records never share
+    a file id even if their latest records, and so their time_created, are
+    at the same time"""
+    if not deterministic:
+        return None
+    values = [
+        [record.get(field) for field in FIT_FIELDS] for record in records
+    ]
+    digest = hashlib.sha256(
+        json.dumps(values, separators=(",", ":")).encode()
+    ).digest()
+    # a uint32z field, 0 is its invalid value
+    return int.from_bytes(digest[:4], "little") or 1
+
+
+def write_file_id(fit, records, deterministic):
+    """Write the file_id and file_creator messages of a FIT file"""
+    fit.write_file_info(
+        serial_number=file_serial_number(records, deterministic),
+        time_created=file_time_created(records, deterministic),
+    )
+    fit.write_file_creator()
+
+
+def generate_fitdata(
+    syncdata, device_info="record", compact=False, deterministic=False
+):
+    """Generate fit data from measured data
+
+    device_info: how often device_info messages are written, see
+    write_device_info
+    compact: leave fields without a value out of the FIT definitions
+    deterministic: derive the file id from the data, see file_time_created
+    and file_serial_number"""
+    log.debug("Generating fit data...")
 
     weight_measurements = list(
         filter(lambda x: (x["type"] == "weight"), syncdata)
@@ -17,183 +107,267 @@ def generate_fitdata(syncdata):
     fit_blood_pressure = None
 
     if len(weight_measurements) > 0:
-        fit_weight = FitEncoderWeight()
-        fit_weight.write_file_info()
-        fit_weight.write_file_creator()
+        fit_weight = FitEncoderWeight(compact=compact)
+        write_file_id(fit_weight, weight_measurements, deterministic)
 
+        devices = {}
         for record in weight_measurements:
-            fit_weight.write_device_info(timestamp=record["date_time"])
-            fit_weight.write_weight_scale(
-                timestamp=record["date_time"],
-                weight=record["weight"],
-                percent_fat=record["fat_ratio"],
-                percent_hydration=record["percent_hydration"],
-                bone_mass=record["bone_mass"],
-                muscle_mass=record["muscle_mass"],
-                bmi=record["bmi"],
-            )
+            write_device_info(fit_weight, record, device_info, devices)
+            write_record(fit_weight, record)
 
         fit_weight.finish()
     else:
-        logging.info("No weight data to sync for FIT file")
+        log.info("No weight data to sync for FIT file")
 
     if len(blood_pressure_measurements) > 0:
-        fit_blood_pressure = FitEncoderBloodPressure()
-        fit_blood_pressure.write_file_info()
-        fit_blood_pressure.write_file_creator()
+        fit_blood_pressure = FitEncoderBloodPressure(compact=compact)
+        write_file_id(
+            fit_blood_pressure, blood_pressure_measurements, deterministic
+        )
 
+        devices = {}
         for record in blood_pressure_measurements:
-            fit_blood_pressure.write_device_info(timestamp=record["date_time"])
-            fit_blood_pressure.write_blood_pressure(
-                timestamp=record["date_time"],
-                diastolic_blood_pressure=record["diastolic_blood_pressure"],
-                systolic_blood_pressure=record["systolic_blood_pressure"],
-                heart_rate=record["heart_pulse"],
-            )
+            write_device_info(fit_blood_pressure, record, device_info, devices)
+            write_record(fit_blood_pressure, record)
 
         fit_blood_pressure.finish()
     else:
-        logging.info("No blood pressure data to sync for FIT file")
+        log.info("No blood pressure data to sync for FIT file")
 
-    logging.debug("Fit data generated...")
+    log.debug("Fit data generated...")
     return fit_weight, fit_blood_pressure
 
 
-def prepare_syncdata(height, groups, args):
-    """Prepare measurement data to be sent"""
-    syncdata = []
+def generate_fitdata_combined(
+    syncdata, device_info="record", compact=False, deterministic=False
+):
+    """Generate a single fit file with weight and blood pressure data
+
+    Takes the same options as generate_fitdata, returns None when there is
+    nothing to sync."""
+    log.debug("Generating combined fit data...")
+
+    records = [x for x in syncdata if x["type"] in RECORD_MESSAGES]
+    if not records:
+        log.info("No data to sync for FIT file")
+        return None
+
+    fit = FitEncoderCombined(compact=compact)
+    write_file_id(fit, records, deterministic)
+
+    devices = {}
+    for record in records:
+        write_device_info(fit, record, device_info, devices)
+        write_record(fit, record)
+
+    fit.finish()
+    log.debug("Fit data generated...")
+    return fit
+
+
+def drop_existing(syncdata, existing):
+    """Drop the records Garmin Connect already has
+
+    existing: the timestamps per record type, see GarminConnect.get_existing"""
+    remaining = [
+        record
+        for record in syncdata
+        if record["timestamp"] not in existing.get(record["type"], ())
+    ]
+    if len(remaining) < len(syncdata):
+        log.info(
+            "%d record(s) already on Garmin Connect, not syncing them",
+            len(syncdata) - len(remaining),
+        )
+    return remaining
+
+
+# the columns of a merged record that come from its first record
+MERGE_KEPT = ("timestamp", "deviceid", "type", "raw_data")
 
-    last_date_time = None
-    last_weight = None
 
-    sync_dict = {}
+def merge_records(records, tolerance=0):
+    """Merge the records of a kind that are at most `tolerance` seconds apart
 
+    A single sweep over records sorted by timestamp, holding one open record
+    per kind. The conflict rules:
+    - only records of the same kind merge, into the open record of the
+      earliest one, which keeps its timestamp and device
+    - a record joins the open record while it is at most `tolerance`
+      seconds after that timestamp, later ones open the next record
+    - a column takes the value of the latest record that has one, a missing
+      value never replaces a value
+    - the raw measures of all merged records are kept
+    The merged records are yielded in timestamp order."""
+    pending = {}
+    for record in records:
+        timestamp = record["timestamp"]
+        if pending:
+            closed = sorted(
+                (
+                    current
+                    for current in pending.values()
+                    if timestamp - current["timestamp"] > tolerance
+                ),
+                key=itemgetter("timestamp"),
+            )
+            for current in closed:
+                yield pending.pop(current["type"])
+
+        current = pending.get(record["type"])
+        if current is None:
+            pending[record["type"]] = record
+            continue
+        for column, value in record.items():
+            if value is not None and column not in MERGE_KEPT:
+                current[column] = value
+        current["raw_data"] = current["raw_data"] + record["raw_data"]
+
+    yield from sorted(pending.values(), key=itemgetter("timestamp"))
+
+
+def split_merge_cluster(groups, tolerance, date):
+    """split off the measure groups a merge could join with a group at
+    `date`, see merge_records
+
+    These are the groups chained to `date` by gaps of at most `tolerance`
+    seconds. A merge never joins groups across a wider gap, so the groups
+    on each side of it become the same records whatever is merged on the
+    other side. Returns the other groups and the chained ones, both sorted
+    by date."""
+    groups = sorted(groups, key=attrgetter("date"))
+    dates = [group.date for group in groups]
+    low = high = bisect_right(dates, date)
+    previous = date
+    while low > 0 and previous - dates[low - 1] <= tolerance:
+        low -= 1
+        previous = dates[low]
+    previous = date
+    while high < len(dates) and dates[high] - previous <= tolerance:
+        previous = dates[high]
+        high += 1
+    return groups[:low] + groups[high:], groups[low:high]
+
+
+def log_skipped(timestamp, raw_data, args, debug):
+    """log a measurement time without anything to sync"""
+    collected_metrics = "weight data"
+    if "BLOOD_PRESSURE" in args.features:
+        collected_metrics += " or blood pressure"
+
+    log.info(
+        "%s This Withings metric contains no %s.  Not syncing...",
+        datetime.fromtimestamp(timestamp),
+        collected_metrics,
+    )
+    if debug:
+        log_event(
+            log,
+            logging.DEBUG,
+            "skipped",
+            timestamp=timestamp,
+            raw_data=[str(measure) for measure in raw_data],
+        )
+
+
+def group_records(groups, args, debug):
+    """turn measure groups into records, see prepare_syncdata"""
     for group in groups:
-        # Get extra physical measurements
-        dt = group.get_datetime()
-        # create a default group_data
-        group_data = {
-            "date_time": group.get_datetime(),
-            "type": "None",
-            "raw_data": group.get_raw_data(),
-        }
+        # one pass over the measures, see measures.MEASURES
+        values = record_values(group)
+        kind = record_type(values)
+        if kind is None and values:
+            # e.g. the body composition Withings stores next to a weight
+            kind = "weight"
 
-        if dt not in sync_dict:
-            sync_dict[dt] = {}
-
-        if group.get_weight():
-            group_data = {
-                "date_time": group.get_datetime(),
-                "height": height,
-                "weight": group.get_weight(),
-                "fat_ratio": group.get_fat_ratio(),
-                "muscle_mass": group.get_muscle_mass(),
-                "hydration": group.get_hydration(),
-                "percent_hydration": None,
-                "bone_mass": group.get_bone_mass(),
-                "pulse_wave_velocity": group.get_pulse_wave_velocity(),
-                "heart_pulse": group.get_heart_pulse(),
-                "bmi": None,
-                "raw_data": group.get_raw_data(),
-                "type": "weight",
-            }
-        elif group.get_diastolic_blood_pressure():
-            group_data = {
-                "date_time": group.get_datetime(),
-                "diastolic_blood_pressure": group.get_diastolic_blood_pressure(),
-                "systolic_blood_pressure": group.get_systolic_blood_pressure(),
-                "heart_pulse": group.get_heart_pulse(),
-                "raw_data": group.get_raw_data(),
-                "type": "blood_pressure",
-            }
-
-        # execute the code below, if this is not a whitelisted entry like weight and blood pressure
-        if "weight" not in group_data and not (
-            "diastolic_blood_pressure" in group_data
-            and "BLOOD_PRESSURE" in args.features
+        # only weight and, when the feature is enabled, blood pressure
+        if kind is None or (
+            kind == "blood_pressure" and "BLOOD_PRESSURE" not in args.features
         ):
-            collected_metrics = "weight data"
-            if "BLOOD_PRESSURE" in args.features:
-                collected_metrics += " or blood pressure"
-
-            logging.info(
-                "%s This Withings metric contains no %s.  Not syncing...",
-                dt,
-                collected_metrics,
-            )
-            groupdata_log_raw_data(group_data)
-            # for now, remove the entry as we're handling only weight and feature enabled data
-            del sync_dict[dt]
+            log_skipped(group.date, group.measures, args, debug)
             continue
 
-        if height and "weight" in group_data:
-            group_data["bmi"] = round(
-                group_data["weight"] / pow(group_data["height"], 2), 1
-            )
-        if "hydration" in group_data and group_data["hydration"]:
-            group_data["percent_hydration"] = round(
-                group_data["hydration"] * 100.0 / group_data["weight"], 2
-            )
+        record = {
+            "timestamp": group.date,
+            "deviceid": group.deviceid,
+            "type": kind,
+            "raw_data": group.get_raw_data(),
+        }
+        record.update(values)
+        yield record
 
-        logging.debug("%s Detected data: ", dt)
-        groupdata_log_raw_data(group_data)
-        if "weight" in group_data:
-            logging.debug(
-                "Record: %s, type=%s\n"
-                "height=%s m, "
-                "weight=%s kg, "
-                "fat_ratio=%s %%, "
-                "muscle_mass=%s kg, "
-                "percent_hydration=%s %%, "
-                "bone_mass=%s kg, "
-                "bmi=%s",
-                group_data["date_time"],
-                group_data["type"],
-                group_data["height"],
-                group_data["weight"],
-                group_data["fat_ratio"],
-                group_data["muscle_mass"],
-                group_data["percent_hydration"],
-                group_data["bone_mass"],
-                group_data["bmi"],
-            )
-        if "diastolic_blood_pressure" in group_data:
-            logging.debug(
-                "Record: %s, type=%s\n"
-                "diastolic_blood_pressure=%s mmHg, "
-                "systolic_blood_pressure=%s mmHg, "
-                "heart_pulse=%s BPM, ",
-                group_data["date_time"],
-                group_data["type"],
-                group_data["diastolic_blood_pressure"],
-                group_data["systolic_blood_pressure"],
-                group_data["heart_pulse"],
-            )
 
-        # join groups with same timestamp
-        for k, v in group_data.items():
-            sync_dict[dt][k] = v
+def prepare_syncdata(height, groups, args):
+    """Prepare measurement data to be sent
+
+    Records are keyed by their UTC epoch timestamp, datetimes are only built
+    for display. The groups of a kind at most `args.merge_window` seconds
+    apart become one record (see merge_records), e.g. the weight and the
+    body composition Withings stores as separate groups of a weigh-in. A
+    group without weight or blood pressure is only synced as part of a
+    weight record."""
+    syncdata = []
+
+    last_timestamp = None
+    debug = log.isEnabledFor(logging.DEBUG)
 
+    groups = sorted(groups, key=attrgetter("date"))
+    records = merge_records(
+        group_records(groups, args, debug), args.merge_window
+    )
     last_measurement_type = None
 
-    for group_data in sync_dict.values():
+    for group_data in records:
+        if group_data["type"] == "weight":
+            if not group_data.get("weight"):
+                timestamp = group_data["timestamp"]
+                log_skipped(timestamp, group_data["raw_data"], args, debug)
+                continue
+            group_data["height"] = height
+            if height:
+                group_data["bmi"] = round(
+                    group_data["weight"] / pow(height, 2), 1
+                )
+            if group_data.get("hydration"):
+                group_data["percent_hydration"] = round(
+                    group_data["hydration"] * 100.0 / group_data["weight"], 2
+                )
+
         syncdata.append(group_data)
-        logging.debug("Processed data: ")
-        for k, v in group_data.items():
-            logging.debug("%s=%s", k, v)
-        if last_date_time is None or group_data["date_time"] > last_date_time:
-            last_date_time = group_data["date_time"]
-            last_measurement_type = group_data["type"]
-            logging.debug(
-                "last_dt: %s last_weight: %s", last_date_time, last_weight
+        if debug:
+            log_event(
+                log,
+                logging.DEBUG,
+                "processed",
+                **groupdata_summary(group_data),
             )
+        if last_timestamp is None or group_data["timestamp"] > last_timestamp:
+            last_timestamp = group_data["timestamp"]
+            last_measurement_type = group_data["type"]
+
+    if debug:
+        log_event(
+            log,
+            logging.DEBUG,
+            "prepared",
+            records=len(syncdata),
+            last_timestamp=last_timestamp,
+        )
 
     if last_measurement_type is None:
-        logging.error("Invalid or no data detected")
+        log.error("Invalid or no data detected")
+
+    return last_measurement_type, last_timestamp, syncdata
+
 
-    return last_measurement_type, last_date_time, syncdata
+def groupdata_raw_data(groupdata):
+    """render the raw measures of a group as a list of strings"""
+    return [str(dataentry) for dataentry in groupdata["raw_data"]]
 
 
-def groupdata_log_raw_data(groupdata):
-    for dataentry in groupdata["raw_data"]:
-        logging.debug("%s", dataentry)
+def groupdata_summary(groupdata):
+    """flatten a group for a single structured log event"""
+    summary = {k: v for k, v in groupdata.items() if k != "raw_data"}
+    if "raw_data" in groupdata:
+        summary["raw_data"] = groupdata_raw_data(groupdata)
+    return summary
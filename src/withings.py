@@ -1,20 +1,45 @@
 """This module takes care of the communication with Withings."""
 import os
 import time
-import base64
 import logging
-import requests
-import nacl.encoding
-import nacl.utils
 
-from nacl.public import PrivateKey, PublicKey, Box
 from datetime import date, datetime
+from concurrency import limiter
+from metrics import metrics
+from secrets_backends import open_secret_backend
+from state import StateStore
 
 log = logging.getLogger("withings")
 
+# requests is imported where it is used, so runs that never reach the
+# network don't pay for importing it
+
 AUTHORIZE_URL = "https://account.withings.com/oauth2_user/authorize2"
-TOKEN_URL = "https://wbsapi.withings.net/v2/oauth2"
-GETMEAS_URL = "https://wbsapi.withings.net/measure?action=getmeas"
+WITHINGS_API_URL = "https://wbsapi.withings.net"
+GITHUB_API_URL = "https://api.github.com"
+TOKEN_PATH = "/v2/oauth2"
+GETMEAS_PATH = "/measure?action=getmeas"
+
+# secret name -> user_config key of the tokens rotated on refresh
+ROTATED_SECRETS = {
+    "WITHINGS_ACCESS_TOKEN": "access_token",
+    "WITHINGS_REFRESH_TOKEN": "refresh_token",
+}
+
+STATUS_TOO_MANY_REQUESTS = 601
+MAX_RETRIES = 3
+# the longest wait before a retry, also for a longer Retry-After
+MAX_BACKOFF = 30
+
+
+def retry_delay(response, retries):
+    """get the seconds to wait before a retry, the Retry-After of the
+    response if it has one, an exponential backoff otherwise"""
+    try:
+        delay = float(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        delay = 2**retries
+    return min(max(delay, 0), MAX_BACKOFF)
 
 
 class WithingsOAuth2:
@@ -22,36 +47,57 @@ class WithingsOAuth2:
 
     app_config = user_config = None
 
-    def __init__(self):
+    def __init__(self, update_secrets=True, environ=None, secrets="github"):
+        # the batch mode passes the variables of each account
+        environ = os.environ if environ is None else environ
         try:
             self.app_config = {
-                "callback_url": os.environ["WITHINGS_CALLBACK_URL"],
-                "client_id": os.environ["WITHINGS_CLIENT_ID"],
-                "consumer_secret": os.environ["WITHINGS_CONSUMER_SECRET"],
+                "callback_url": environ["WITHINGS_CALLBACK_URL"],
+                "client_id": environ["WITHINGS_CLIENT_ID"],
+                "consumer_secret": environ["WITHINGS_CONSUMER_SECRET"],
             }
             self.user_config = {
-                "access_token": os.environ["WITHINGS_ACCESS_TOKEN"],
-                "authentification_code": os.environ["WITHINGS_AUTH_CODE"],
-                "refresh_token": os.environ["WITHINGS_REFRESH_TOKEN"],
+                "access_token": environ["WITHINGS_ACCESS_TOKEN"],
+                "authentification_code": environ["WITHINGS_AUTH_CODE"],
+                "refresh_token": environ["WITHINGS_REFRESH_TOKEN"],
             }
-            self.gh_token = os.environ["GH_TOKEN"]
-            self.gh_repository = os.environ["GH_REPOSITORY"]
         except KeyError:
             raise AttributeError("Some ENVIRONMENT variables are not found.")
 
-        self.refresh_accesstoken()
-        self.update_github_secret(
-            secret_name="WITHINGS_ACCESS_TOKEN",
-            secret_value=self.user_config["access_token"],
-            github_repository=self.gh_repository,
-            github_token=self.gh_token
+        self.user_id = environ.get(
+            "WITHINGS_USER_ID", self.app_config["client_id"]
         )
-        self.update_github_secret(
-            secret_name="WITHINGS_REFRESH_TOKEN",
-            secret_value=self.user_config["refresh_token"],
-            github_repository=self.gh_repository,
-            github_token=self.gh_token
+
+        # base URLs can be pointed to local stand-in servers
+        self.api_url = environ.get("WITHINGS_API_URL", WITHINGS_API_URL)
+        self.github_api_url = environ.get("GITHUB_API_URL", GITHUB_API_URL)
+
+        # tokens saved by an earlier run take precedence over the environment
+        self.secrets = open_secret_backend(
+            secrets, environ, self.github_api_url
+        )
+        for secret_name, value in self.secrets.load(self.user_id).items():
+            self.user_config[ROTATED_SECRETS[secret_name]] = value
+        self.rotated = False
+
+        # with update_secrets, rotated tokens are saved as soon as they are
+        # rotated, a sync that fails later can't lose them
+        self.save_rotated = update_secrets
+        self.refresh_accesstoken()
+
+    def update_secrets(self):
+        """save the rotated tokens in one write, if they were rotated"""
+        if not self.rotated:
+            log.info("Tokens not rotated, nothing to save")
+            return
+        self.secrets.save(
+            self.user_id,
+            {
+                secret_name: self.user_config[config_key]
+                for secret_name, config_key in ROTATED_SECRETS.items()
+            },
         )
+        self.rotated = False
 
     def refresh_accesstoken(self):
         """refresh Withings access token"""
@@ -65,94 +111,108 @@ class WithingsOAuth2:
             "refresh_token": self.user_config["refresh_token"],
         }
 
-        req = requests.post(TOKEN_URL, params)
-        resp = req.json()
+        import requests
+
+        with limiter("withings.refresh_token").request() as call:
+            with metrics.stage("withings.refresh_token"):
+                req = requests.post(self.api_url + TOKEN_PATH, params)
+            metrics.count("withings.refresh_token", nbytes=len(req.content))
+            resp = req.json()
+            if resp.get("status") == STATUS_TOO_MANY_REQUESTS:
+                call.overloaded()
         if resp.get("status") != 0:
             raise AttributeError(
                 "Withings login failed, please check your credentials."
             )
         body = resp.get("body")
 
+        # the access token is refreshed every run and not worth saving on
+        # its own, a new refresh token has to be saved
+        self.rotated = (
+            self.rotated
+            or body.get("refresh_token") != self.user_config["refresh_token"]
+        )
         self.user_config["access_token"] = body.get("access_token")
         self.user_config["refresh_token"] = body.get("refresh_token")
-
-    def encrypt_secret(self, public_key: str, secret_value: str) -> str:
-        """Encrypt the secret with the provided public key using sodium lib"""
-        public_key_bytes = base64.b64decode(public_key)
-        public_key = PublicKey(public_key_bytes)
-
-        private_key = PrivateKey.generate()
-        sealed_box = Box(private_key, public_key)
-
-        encrypted = sealed_box.encrypt(
-            secret_value.encode(), encoder=nacl.encoding.Base64Encoder
-        )
-        return encrypted.decode("utf-8")
-
-    def get_public_key(self, github_token, github_repository):
-        """Get the public key for the repository's secrets."""
-        headers = {
-            "Authorization": f"token {github_token}",
-            "Accept": "application/vnd.github+json",
-        }
-        response = requests.get(
-            f"https://api.github.com/repos/{github_repository}/actions/secrets/public-key",
-            headers=headers,
-        )
-        response.raise_for_status()
-        return response.json()["key"], response.json()["key_id"]
-
-    def update_github_secret(
-        self, secret_name, secret_value, github_token, github_repository
-    ):
-        public_key, key_id = self.get_public_key(
-            github_token, github_repository
-        )
-        encrypted_value = self.encrypt_secret(public_key, secret_value)
-
-        headers = {
-            "Authorization": f"token {github_token}",
-            "Accept": "application/vnd.github.v3+json",
-        }
-        data = {
-            "encrypted_value": encrypted_value,
-            "key_id": key_id,
-        }
-
-        url = f"https://api.github.com/repos/{github_repository}/actions/secrets/{secret_name}"
-
-        try:
-            logging.info(f"Updating secret: {secret_name} for repository: {github_repository}")
-            response = requests.put(url, headers=headers, json=data)
-            response.raise_for_status()  # Raises an HTTPError if the HTTP request returned an unsuccessful status code
-            logging.info(f"Successfully updated secret: {secret_name}")
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Failed to update secret: {secret_name}. Error: {e}")
-            raise e  # Re-raise the exception after logging
+        if self.save_rotated:
+            self.update_secrets()
 
 
 class WithingsAccount:
     """This class gets measurements from Withings"""
 
-    def __init__(self):
-        self.withings = WithingsOAuth2()
+    def __init__(
+        self,
+        update_secrets=True,
+        state=None,
+        archive=None,
+        environ=None,
+        secrets="github",
+    ):
+        self.withings = WithingsOAuth2(
+            update_secrets=update_secrets, environ=environ, secrets=secrets
+        )
+        self.state = state if state is not None else StateStore()
+        self.archive = archive
+        self.account = self.withings.user_id
 
     def get_lastsync(self):
-        """get last sync timestamp"""
-        if not self.withings.user_config.get("last_sync"):
+        """get the timestamp to start an incremental sync from"""
+        last_sync = self.state.get(self.account, "last_sync")
+        if not last_sync:
             return int(time.mktime(date.today().timetuple()))
-        return self.withings.user_config["last_sync"]
+        return last_sync + 1
 
-    def set_lastsync(self):
-        """set last sync timestamp"""
-        self.withings.user_config["last_sync"] = int(time.time())
+    def set_lastsync(self, timestamp):
+        """save the timestamp of the last synced measurement"""
+        if timestamp <= self.state.get(self.account, "last_sync", 0):
+            return
         log.info("Saving Last Sync")
-        self.withings.update_config()
+        self.state.set(self.account, "last_sync", timestamp)
+
+    def get_checkpoint(self, startdate):
+        """get the windows synced by an unfinished sync from startdate
+
+        Returns a list of [start, end] ranges, empty unless an earlier run
+        from the same startdate stopped early. Its end isn't compared, a
+        run resumed on a later day syncs up to a later end."""
+        checkpoint = self.state.get(self.account, "checkpoint")
+        if checkpoint and checkpoint.get("start") == startdate:
+            return checkpoint["done"]
+        return []
+
+    def add_checkpoint(self, startdate, window_start, window_end):
+        """save a synced window of the sync from startdate"""
+        done = []
+        for start, end in sorted(
+            self.get_checkpoint(startdate) + [[window_start, window_end]]
+        ):
+            if done and start <= done[-1][1] + 1:
+                done[-1][1] = max(done[-1][1], end)
+            else:
+                done.append([start, end])
+        self.state.set(
+            self.account, "checkpoint", {"start": startdate, "done": done}
+        )
+
+    def clear_checkpoint(self):
+        """forget the synced windows once a sync is complete"""
+        self.state.set(self.account, "checkpoint", None)
 
     def get_measurements(self, startdate, enddate):
-        """get Withings measurements"""
+        """get Withings measurements
+
+        Ranges that were fetched completely before are read from the
+        archive, if there is one."""
         log.info("Get Measurements")
 
+        if self.archive is not None and self.archive.covers(startdate, enddate):
+            log.info("Reading measurements from the archive")
+            with metrics.stage("archive.read"):
+                measuregrps = self.archive.get_measuregrps(startdate, enddate)
+            metrics.count("archive.read", records=len(measuregrps))
+            return [WithingsMeasureGroup(g) for g in measuregrps]
+
         params = {
             "access_token": self.withings.user_config["access_token"],
             "category": 1,
@@ -160,17 +220,71 @@ class WithingsAccount:
             "enddate": enddate,
         }
 
-        req = requests.post(GETMEAS_URL, params)
-
-        measurements = req.json()
-
-        if measurements.get("status") == 0:
-            log.debug("Measurements received")
-            return [
-                WithingsMeasureGroup(g)
-                for g in measurements.get("body").get("measuregrps")
-            ]
-        return None
+        measuregrps = self._getmeas("withings.getmeas", params)
+        if measuregrps is None:
+            return None
+
+        log.debug("Measurements received")
+        if self.archive is not None:
+            with metrics.stage("archive.append"):
+                self.archive.append(measuregrps, startdate, enddate)
+        groups = [WithingsMeasureGroup(g) for g in measuregrps]
+        metrics.count("withings.getmeas", records=len(groups))
+        return groups
+
+    def _getmeas(self, stage, params):
+        """call getmeas, following pages and backing off when rate limited
+
+        Returns None if a page failed, also once it is still rate limited
+        after MAX_RETRIES retries."""
+        import requests
+
+        url = self.withings.api_url + GETMEAS_PATH
+        params = dict(params)
+        measuregrps = []
+        retries = 0
+
+        while True:
+            # the requests of all accounts share one adaptive limit per stage
+            with limiter(stage).request() as call:
+                with metrics.stage(stage):
+                    req = requests.post(url, params)
+                metrics.count(stage, nbytes=len(req.content))
+                status = None
+                if req.status_code < 500 and req.status_code != 429:
+                    measurements = req.json()
+                    status = measurements.get("status")
+                overloaded = (
+                    status == STATUS_TOO_MANY_REQUESTS
+                    or req.status_code >= 500
+                    or req.status_code == 429
+                )
+                if overloaded:
+                    call.overloaded()
+
+            if overloaded and retries < MAX_RETRIES:
+                retries += 1
+                metrics.count(stage, retries=1)
+                delay = retry_delay(req, retries)
+                log.warning(
+                    "Withings rate limit hit, retry %d in %.0f s",
+                    retries,
+                    delay,
+                )
+                time.sleep(delay)
+                continue
+            if status != 0:
+                log.error(
+                    "Withings getmeas failed with status %s",
+                    status if status is not None else req.status_code,
+                )
+                return None
+
+            body = measurements.get("body")
+            measuregrps.extend(body.get("measuregrps"))
+            if not body.get("more"):
+                return measuregrps
+            params["offset"] = body.get("offset")
 
     def get_height(self):
         """get height from Withings"""
@@ -186,23 +300,21 @@ class WithingsAccount:
             "category": 1,
         }
 
-        req = requests.post(GETMEAS_URL, params)
+        measuregrps = self._getmeas("withings.height", params)
 
-        measurements = req.json()
-
-        if measurements.get("status") == 0:
+        if measuregrps is not None:
             log.debug("Height received")
 
             # there could be multiple height records. use the latest one
-            for record in measurements.get("body").get("measuregrps"):
+            for record in measuregrps:
                 height_group = WithingsMeasureGroup(record)
                 if height is not None:
                     if height_timestamp is not None:
-                        if height_group.get_datetime() > height_timestamp:
+                        if height_group.date > height_timestamp:
                             height = height_group.get_height()
                 else:
                     height = height_group.get_height()
-                    height_timestamp = height_group.get_datetime()
+                    height_timestamp = height_group.date
 
         return height
 
@@ -216,6 +328,7 @@ class WithingsMeasureGroup:
         self.attrib = measuregrp.get("attrib")
         self.date = measuregrp.get("date")
         self.category = measuregrp.get("category")
+        self.deviceid = measuregrp.get("deviceid")
         self.measures = [WithingsMeasure(m) for m in measuregrp["measures"]]
 
     def __iter__(self):
@@ -226,124 +339,91 @@ class WithingsMeasureGroup:
         return len(self.measures)
 
     def get_datetime(self):
-        """convenient function to get date & time"""
+        """convenient function to get date & time, for display only"""
         return datetime.fromtimestamp(self.date)
 
     def get_raw_data(self):
         """convenient function to get raw data"""
         return self.measures
 
-    def get_weight(self):
-        """convenient function to get weight"""
+    def get_measure_value(self, measure_type):
+        """get the value of the first measure of a type, None if missing"""
         for measure in self.measures:
-            if measure.type == WithingsMeasure.TYPE_WEIGHT:
+            if measure.type == measure_type:
                 return round(measure.get_value(), 2)
         return None
 
+    def get_weight(self):
+        """convenient function to get weight"""
+        return self.get_measure_value(WithingsMeasure.TYPE_WEIGHT)
+
     def get_height(self):
         """convenient function to get height"""
-        for measure in self.measures:
-            if measure.type == WithingsMeasure.TYPE_HEIGHT:
-                return round(measure.get_value(), 2)
-        return None
+        return self.get_measure_value(WithingsMeasure.TYPE_HEIGHT)
 
     def get_fat_free_mass(self):
         """convenient function to get fat free mass"""
-        for measure in self.measures:
-            if measure.type == WithingsMeasure.TYPE_FAT_FREE_MASS:
-                return round(measure.get_value(), 2)
-        return None
+        return self.get_measure_value(WithingsMeasure.TYPE_FAT_FREE_MASS)
 
     def get_fat_ratio(self):
         """convenient function to get fat ratio"""
-        for measure in self.measures:
-            if measure.type == WithingsMeasure.TYPE_FAT_RATIO:
-                return round(measure.get_value(), 2)
-        return None
+        return self.get_measure_value(WithingsMeasure.TYPE_FAT_RATIO)
 
     def get_fat_mass_weight(self):
         """convenient function to get fat mass weight"""
-        for measure in self.measures:
-            if measure.type == WithingsMeasure.TYPE_FAT_MASS_WEIGHT:
-                return round(measure.get_value(), 2)
-        return None
+        return self.get_measure_value(WithingsMeasure.TYPE_FAT_MASS_WEIGHT)
 
     def get_diastolic_blood_pressure(self):
         """convenient function to get diastolic blood pressure"""
-        for measure in self.measures:
-            if measure.type == WithingsMeasure.TYPE_DIASTOLIC_BLOOD_PRESSURE:
-                return round(measure.get_value(), 2)
-        return None
+        return self.get_measure_value(
+            WithingsMeasure.TYPE_DIASTOLIC_BLOOD_PRESSURE
+        )
 
     def get_systolic_blood_pressure(self):
         """convenient function to get systolic blood pressure"""
-        for measure in self.measures:
-            if measure.type == WithingsMeasure.TYPE_SYSTOLIC_BLOOD_PRESSURE:
-                return round(measure.get_value(), 2)
-        return None
+        return self.get_measure_value(
+            WithingsMeasure.TYPE_SYSTOLIC_BLOOD_PRESSURE
+        )
 
     def get_heart_pulse(self):
         """convenient function to get heart pulse"""
-        for measure in self.measures:
-            if measure.type == WithingsMeasure.TYPE_HEART_PULSE:
-                return round(measure.get_value(), 2)
-        return None
+        return self.get_measure_value(WithingsMeasure.TYPE_HEART_PULSE)
 
     def get_temperature(self):
         """convenient function to get temperature"""
-        for measure in self.measures:
-            if measure.type == WithingsMeasure.TYPE_TEMPERATURE:
-                return round(measure.get_value(), 2)
-        return None
+        return self.get_measure_value(WithingsMeasure.TYPE_TEMPERATURE)
 
     def get_sp02(self):
         """convenient function to get sp02"""
-        for measure in self.measures:
-            if measure.type == WithingsMeasure.TYPE_SP02:
-                return round(measure.get_value(), 2)
-        return None
+        return self.get_measure_value(WithingsMeasure.TYPE_SP02)
 
     def get_body_temperature(self):
         """convenient function to get body temperature"""
-        for measure in self.measures:
-            if measure.type == WithingsMeasure.TYPE_BODY_TEMPERATURE:
-                return round(measure.get_value(), 2)
-        return None
+        return self.get_measure_value(WithingsMeasure.TYPE_BODY_TEMPERATURE)
 
     def get_skin_temperature(self):
         """convenient function to get skin temperature"""
-        for measure in self.measures:
-            if measure.type == WithingsMeasure.TYPE_SKIN_TEMPERATURE:
-                return round(measure.get_value(), 2)
-        return None
+        return self.get_measure_value(WithingsMeasure.TYPE_SKIN_TEMPERATURE)
 
     def get_muscle_mass(self):
         """convenient function to get muscle mass"""
-        for measure in self.measures:
-            if measure.type == WithingsMeasure.TYPE_MUSCLE_MASS:
-                return round(measure.get_value(), 2)
-        return None
+        return self.get_measure_value(WithingsMeasure.TYPE_MUSCLE_MASS)
 
     def get_hydration(self):
         """convenient function to get hydration"""
-        for measure in self.measures:
-            if measure.type == WithingsMeasure.TYPE_HYDRATION:
-                return round(measure.get_value(), 2)
-        return None
+        return self.get_measure_value(WithingsMeasure.TYPE_HYDRATION)
 
     def get_bone_mass(self):
         """convenient function to get bone mass"""
-        for measure in self.measures:
-            if measure.type == WithingsMeasure.TYPE_BONE_MASS:
-                return round(measure.get_value(), 2)
-        return None
+        return self.get_measure_value(WithingsMeasure.TYPE_BONE_MASS)
+
+    def get_visceral_fat(self):
+        """convenient function to get visceral fat"""
+        return self.get_measure_value(WithingsMeasure.TYPE_VISCERAL_FAT)
 
     def get_pulse_wave_velocity(self):
         """convenient function to get pulse wave velocity"""
-        for measure in self.measures:
-            if measure.type == WithingsMeasure.TYPE_PULSE_WAVE_VELOCITY:
-                return round(measure.get_value(), 2)
-        return None
+        return self.get_measure_value(WithingsMeasure.TYPE_PULSE_WAVE_VELOCITY)
 
 
 class WithingsMeasure:
@@ -417,7 +497,7 @@ class WithingsMeasure:
         TYPE_FAT_MASS_SEGMENTS: ["Fat Mass for segments in mass unit", "kg"],
         TYPE_EXTRACELLULAR_WATER: ["Extracellular Water", "kg"],
         TYPE_INTRACELLULAR_WATER: ["Intracellular Water", "kg"],
-        TYPE_VISCERAL_FAT: ["Extracellular Water", "kg"],
+        TYPE_VISCERAL_FAT: ["Visceral Fat", ""],
         TYPE_MUSCLE_MASS_SEGMENTS: [
             "Muscle Mass for segments in mass unit",
             "kg",
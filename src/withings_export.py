@@ -0,0 +1,142 @@
+"""This module imports measurements from a Withings data export archive."""
+import csv
+import io
+import logging
+import os
+import time
+import zipfile
+
+from decimal import Decimal, InvalidOperation
+from withings import WithingsMeasure, WithingsMeasureGroup
+
+log = logging.getLogger("withings_export")
+
+CHUNK_SIZE = 1000
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# export file -> column -> measure type
+EXPORT_COLUMNS = {
+    "weight.csv": {
+        "Weight (kg)": WithingsMeasure.TYPE_WEIGHT,
+        "Fat mass (kg)": WithingsMeasure.TYPE_FAT_MASS_WEIGHT,
+        "Bone mass (kg)": WithingsMeasure.TYPE_BONE_MASS,
+        "Muscle mass (kg)": WithingsMeasure.TYPE_MUSCLE_MASS,
+        "Hydration (kg)": WithingsMeasure.TYPE_HYDRATION,
+    },
+    "bp.csv": {
+        "Heart rate": WithingsMeasure.TYPE_HEART_PULSE,
+        "Systolic": WithingsMeasure.TYPE_SYSTOLIC_BLOOD_PRESSURE,
+        "Diastolic": WithingsMeasure.TYPE_DIASTOLIC_BLOOD_PRESSURE,
+    },
+    "height.csv": {
+        "Value (m)": WithingsMeasure.TYPE_HEIGHT,
+    },
+}
+
+
+def to_measure(measure_type, text):
+    """convert a CSV value to a getmeas measure, None if it is empty"""
+    try:
+        value = Decimal(text.strip())
+    except (InvalidOperation, AttributeError):
+        return None
+    if not value.is_finite():
+        return None
+    exponent = value.as_tuple().exponent
+    return {
+        "type": measure_type,
+        "value": int(value.scaleb(-exponent)),
+        "unit": exponent,
+    }
+
+
+class WithingsExport:
+    """This class reads the measure groups of a Withings export archive
+
+    The CSV files are parsed as streams straight from the zip file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.zip = zipfile.ZipFile(path)
+        self.members = {
+            os.path.basename(name): name
+            for name in self.zip.namelist()
+            if os.path.basename(name) in EXPORT_COLUMNS
+        }
+
+    def close(self):
+        self.zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def iter_measuregrps(self, filename, startdate=0, enddate=None):
+        """yield the rows of an export file as getmeas measure groups"""
+        if filename not in self.members:
+            log.info("%s not found in %s", filename, self.path)
+            return
+        columns = EXPORT_COLUMNS[filename]
+        with self.zip.open(self.members[filename]) as raw:
+            reader = csv.DictReader(io.TextIOWrapper(raw, encoding="utf-8"))
+            for row in reader:
+                try:
+                    date = int(
+                        time.mktime(time.strptime(row["Date"], DATE_FORMAT))
+                    )
+                except (KeyError, ValueError):
+                    log.warning("Skipping row without date: %s", row)
+                    continue
+                if date < startdate or (enddate is not None and date > enddate):
+                    continue
+                measures = []
+                for column, measure_type in columns.items():
+                    measure = to_measure(measure_type, row.get(column))
+                    if measure is not None:
+                        measures.append(measure)
+                if measures:
+                    yield {"date": date, "category": 1, "measures": measures}
+
+    def get_height(self):
+        """get the latest height of the archive"""
+        height = height_date = None
+        for measuregrp in self.iter_measuregrps("height.csv"):
+            if height_date is None or measuregrp["date"] > height_date:
+                height_date = measuregrp["date"]
+                height = WithingsMeasureGroup(measuregrp).get_height()
+        return height
+
+    def iter_groups(self, startdate=0, enddate=None, chunk_size=CHUNK_SIZE):
+        """yield the weight and blood pressure groups in lists of chunk_size"""
+        for filename in ("weight.csv", "bp.csv"):
+            chunk = []
+            for measuregrp in self.iter_measuregrps(
+                filename, startdate, enddate
+            ):
+                if filename == "weight.csv":
+                    add_fat_ratio(measuregrp)
+                chunk.append(WithingsMeasureGroup(measuregrp))
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+
+def add_fat_ratio(measuregrp):
+    """derive the fat ratio from the fat mass, getmeas returns both"""
+    values = {
+        m["type"]: Decimal(m["value"]).scaleb(m["unit"])
+        for m in measuregrp["measures"]
+    }
+    weight = values.get(WithingsMeasure.TYPE_WEIGHT)
+    fat_mass = values.get(WithingsMeasure.TYPE_FAT_MASS_WEIGHT)
+    if weight and fat_mass is not None:
+        measuregrp["measures"].append(
+            to_measure(
+                WithingsMeasure.TYPE_FAT_RATIO,
+                str(round(fat_mass * 100 / weight, 2)),
+            )
+        )
@@ -0,0 +1,229 @@
+"""This module shares the account sync jobs between several workers."""
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+from collections import Counter
+from contextlib import contextmanager
+
+log = logging.getLogger("workqueue")
+
+LEASE_SECONDS = 300
+# a failed job waits this long before it is claimed again, doubled with
+# every failed attempt
+RETRY_SECONDS = 60
+MAX_RETRY_SECONDS = 3600
+
+
+class LeaseLost(RuntimeError):
+    """Another worker took over the job, e.g. after a missed heartbeat"""
+
+
+def worker_name():
+    """get a name for this worker that is unique across hosts"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue:
+    """Queue of per-account sync jobs in a SQLite database
+
+    A worker claims a job by taking a lease on it for `lease_seconds` and
+    renews the lease with heartbeats while it syncs the account. Jobs whose
+    lease ran out, e.g. because their worker died, can be claimed by another
+    worker, a failed job only once its backoff is over. The job also keeps
+    the rotated Withings tokens of the account, so the next worker picks up
+    the current ones."""
+
+    def __init__(self, path, lease_seconds=LEASE_SECONDS):
+        import sqlite3
+
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+        # transactions are started explicitly, see _write
+        self._db = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " account TEXT PRIMARY KEY, pending INTEGER,"
+            " owner TEXT, lease_until REAL, attempts INTEGER,"
+            " error TEXT, tokens TEXT, not_before REAL)"
+        )
+        columns = [
+            row[1] for row in self._db.execute("PRAGMA table_info(jobs)")
+        ]
+        if "not_before" not in columns:
+            self._db.execute("ALTER TABLE jobs ADD COLUMN not_before REAL")
+
+    @contextmanager
+    def _write(self):
+        """write transaction, it locks the database for the other workers"""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def _update(self, query, params=()):
+        """run a single update, return the number of changed rows"""
+        with self._write() as db:
+            return db.execute(query, params).rowcount
+
+    def enqueue(self, accounts):
+        """queue a sync of every account, unless one is already leased
+
+        The accounts are their ids, a duplicated one is an error: the
+        accounts would share a single job."""
+        accounts = list(accounts)
+        counts = Counter(accounts)
+        duplicates = sorted(account for account, n in counts.items() if n > 1)
+        if duplicates:
+            raise ValueError(
+                f"Duplicated account ids: {', '.join(duplicates)}"
+            )
+        now = time.time()
+        with self._write() as db:
+            for account in accounts:
+                db.execute(
+                    "INSERT OR IGNORE INTO jobs"
+                    " VALUES (?, 1, NULL, NULL, 0, NULL, NULL, NULL)",
+                    (account,),
+                )
+                db.execute(
+                    "UPDATE jobs SET pending = 1, attempts = 0,"
+                    " not_before = NULL WHERE account = ?"
+                    " AND (lease_until IS NULL OR lease_until < ?)",
+                    (account, now),
+                )
+
+    def claim(self, worker, max_attempts=3):
+        """lease the next pending job, return its account or None"""
+        now = time.time()
+        with self._write() as db:
+            row = db.execute(
+                "SELECT account FROM jobs WHERE pending = 1"
+                " AND attempts < ?"
+                " AND (lease_until IS NULL OR lease_until < ?)"
+                " AND (not_before IS NULL OR not_before <= ?)"
+                " ORDER BY attempts, account LIMIT 1",
+                (max_attempts, now, now),
+            ).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                "UPDATE jobs SET owner = ?, lease_until = ?,"
+                " attempts = attempts + 1 WHERE account = ?",
+                (worker, now + self.lease_seconds, row[0]),
+            )
+        return row[0]
+
+    def heartbeat(self, account, worker):
+        """renew the lease of a job, tell if the worker still holds it"""
+        now = time.time()
+        return bool(
+            self._update(
+                "UPDATE jobs SET lease_until = ?"
+                " WHERE account = ? AND owner = ? AND lease_until >= ?",
+                (now + self.lease_seconds, account, worker, now),
+            )
+        )
+
+    def complete(self, account, worker, error=None):
+        """release the lease of a job
+
+        A failed job stays pending, it can be claimed again after
+        RETRY_SECONDS, doubled for every failed attempt."""
+        not_before = None
+        with self._write() as db:
+            if error is not None:
+                row = db.execute(
+                    "SELECT attempts FROM jobs WHERE account = ?", (account,)
+                ).fetchone()
+                attempts = row[0] if row else 1
+                not_before = time.time() + min(
+                    RETRY_SECONDS * 2 ** (attempts - 1), MAX_RETRY_SECONDS
+                )
+            return bool(
+                db.execute(
+                    "UPDATE jobs SET pending = ?, owner = NULL,"
+                    " lease_until = NULL, error = ?, not_before = ?"
+                    " WHERE account = ? AND owner = ?",
+                    (
+                        int(error is not None),
+                        error,
+                        not_before,
+                        account,
+                        worker,
+                    ),
+                ).rowcount
+            )
+
+    def get_tokens(self, account):
+        """get the rotated tokens saved by the last sync of an account"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT tokens FROM jobs WHERE account = ?", (account,)
+            ).fetchone()
+        return json.loads(row[0]) if row and row[0] else {}
+
+    def set_tokens(self, account, worker, tokens):
+        """save the rotated tokens of an account, tell if the worker still
+        owns its job, they aren't saved otherwise"""
+        return bool(
+            self._update(
+                "UPDATE jobs SET tokens = ? WHERE account = ? AND owner = ?",
+                (json.dumps(tokens), account, worker),
+            )
+        )
+
+    def lease(self, account, worker):
+        """keep the lease of a job alive while the returned context runs"""
+        return Heartbeat(self, account, worker)
+
+
+class Heartbeat:
+    """Background thread renewing a lease every third of its duration
+
+    check() tells the worker to stop once the lease is lost."""
+
+    def __init__(self, queue, account, worker):
+        self.queue = queue
+        self.account = account
+        self.worker = worker
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.queue.lease_seconds / 3):
+            if not self.queue.heartbeat(self.account, self.worker):
+                self.lost = True
+                log.error("Lost the lease of account %s", self.account)
+                return
+
+    def check(self):
+        """renew the lease right away, raise LeaseLost if it is lost
+
+        Called before every step another worker must not repeat, the
+        background heartbeat may not have noticed yet."""
+        if not self.lost and not self.queue.heartbeat(
+            self.account, self.worker
+        ):
+            self.lost = True
+        if self.lost:
+            raise LeaseLost(f"Lost the lease of account {self.account}")
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
@@ -0,0 +1,49 @@
+"""Shared fixtures, the modules of src/ and benchmarks/ are flat imports."""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+
+@pytest.fixture
+def server(monkeypatch):
+    """stand-in servers with 4 days of measurements, 4 groups a day
+
+    The environment points at them, `server.args` are the arguments of a
+    sync of all the measurements."""
+    from fake_servers import FakeServer
+    from payloads import make_measuregrps
+    from run import make_args
+
+    measuregrps = make_measuregrps(16)
+    with FakeServer(measuregrps=measuregrps) as server:
+        for name, value in server.environ().items():
+            monkeypatch.setenv(name, value)
+        server.args = make_args(measuregrps)
+        yield server
+
+
+@pytest.fixture
+def fail_window():
+    """make the fetch of the window of a day fail
+
+    Returns a function taking the monkeypatch to patch with and the day
+    counted from START, e.g. `fail_window(monkeypatch, 2)`."""
+    from payloads import DAY, START
+    from withings import WithingsAccount
+
+    get_measurements = WithingsAccount.get_measurements
+
+    def fail(monkeypatch, day):
+        def failing(self, startdate, enddate):
+            if startdate <= START + day * DAY <= enddate:
+                return None
+            return get_measurements(self, startdate, enddate)
+
+        monkeypatch.setattr(WithingsAccount, "get_measurements", failing)
+
+    return fail
@@ -0,0 +1,119 @@
+import os
+
+import archive
+from archive import INDEX, MeasureArchive
+from payloads import DAY, START, make_measuregrps
+from state import StateStore
+from sync import sync
+from withings import WithingsAccount
+
+# fetched long after the synthetic measurements, they are all settled
+NOW = START + 100 * DAY
+# the getmeas keys of an archived group
+KEYS = ("grpid", "attrib", "date", "modified", "category", "deviceid")
+
+
+def test_groups_are_read_back_with_device_and_attrib(tmp_path):
+    groups = make_measuregrps(8)
+    groups[1]["attrib"] = 2
+    groups[2]["deviceid"] = None
+    store = MeasureArchive(str(tmp_path))
+    assert store.append(groups, START, START + 2 * DAY, NOW) == 36
+
+    expected = [
+        {key: group[key] for key in KEYS + ("measures",)} for group in groups
+    ]
+    assert store.get_measuregrps(START, START + 2 * DAY) == expected
+    assert store.get_measuregrps(START + DAY, START + 2 * DAY) == expected[4:]
+
+
+def test_append_only_appends_index_entries(tmp_path):
+    store = MeasureArchive(str(tmp_path))
+    groups = make_measuregrps(8)
+    # newest first, the pending entries are sorted when they are read
+    store.append(groups[4:], START + DAY, START + 2 * DAY, NOW)
+    store.append(groups[:4], START, START + DAY - 1, NOW)
+    assert not os.path.exists(store.index_path)
+    assert os.path.getsize(store.log_path) == 36 * INDEX.size
+    expected = store.get_measuregrps(START, START + 2 * DAY)
+    assert [group["grpid"] for group in expected] == list(range(1, 9))
+
+    store.compact()
+    assert not os.path.exists(store.log_path)
+    assert os.path.getsize(store.index_path) == 36 * INDEX.size
+    assert store.get_measuregrps(START, START + 2 * DAY) == expected
+
+
+def test_compacts_once_the_log_grows(tmp_path, monkeypatch):
+    monkeypatch.setattr(archive, "COMPACT_ENTRIES", 10)
+    store = MeasureArchive(str(tmp_path))
+    groups = make_measuregrps(8)
+    store.append(groups[:2], START, START, NOW)
+    assert os.path.exists(store.log_path)
+    store.append(groups[2:], START, START + 2 * DAY, NOW)
+    assert not os.path.exists(store.log_path)
+    assert len(store.get_measuregrps(START, START + 2 * DAY)) == 8
+
+
+def test_interrupted_compaction_reads_entries_once(tmp_path):
+    store = MeasureArchive(str(tmp_path))
+    groups = make_measuregrps(4)
+    store.append(groups, START, START + DAY, NOW)
+    with open(store.log_path, "rb") as fp:
+        log_data = fp.read()
+    store.compact()
+    # the log was not removed after the index was replaced
+    with open(store.log_path, "wb") as fp:
+        fp.write(log_data)
+    assert len(store.get_measuregrps(START, START + DAY)) == 4
+    store.compact()
+    assert os.path.getsize(store.index_path) == len(log_data)
+
+
+def test_known_groups_are_skipped_and_edits_kept(tmp_path):
+    store = MeasureArchive(str(tmp_path))
+    groups = make_measuregrps(4)
+    store.append(groups, START, START + DAY, NOW)
+    assert store.append(groups, START, START + DAY, NOW) == 0
+
+    edited = dict(groups[0], modified=groups[0]["modified"] + 60)
+    edited["measures"] = [{"type": 1, "value": 7000, "unit": -2}]
+    assert store.append([edited], START, START + DAY, NOW) == 1
+    first = store.get_measuregrps(START, START + DAY)[0]
+    assert first["modified"] == edited["modified"]
+    assert first["measures"] == edited["measures"]
+
+
+def test_recent_measurements_are_not_covered(tmp_path):
+    store = MeasureArchive(str(tmp_path), settle=2 * DAY)
+    store.append([], START, START + 5 * DAY, START + 4 * DAY)
+    assert store.covers(START, START + 2 * DAY)
+    assert not store.covers(START, START + 2 * DAY + 1)
+
+
+def test_ranges_expire_after_max_age(tmp_path):
+    store = MeasureArchive(str(tmp_path), max_age=10 * DAY)
+    store.append([], START, START + 4 * DAY, NOW)
+    assert store.covers(START, START + 4 * DAY, now=NOW + 10 * DAY)
+    assert not store.covers(START, START + 4 * DAY, now=NOW + 11 * DAY)
+
+    # fetching part of it again only refreshes that part
+    store.append([], START + 2 * DAY, START + 4 * DAY, NOW + 5 * DAY)
+    assert store.get_ranges() == [
+        [START, START + 2 * DAY - 1, NOW],
+        [START + 2 * DAY, START + 4 * DAY, NOW + 5 * DAY],
+    ]
+    assert store.covers(START + 2 * DAY, START + 4 * DAY, NOW + 11 * DAY)
+    assert not store.covers(START, START + 4 * DAY, now=NOW + 11 * DAY)
+
+
+def test_sync_reads_archived_ranges(server, tmp_path):
+    store = MeasureArchive(str(tmp_path))
+    sync(WithingsAccount(state=StateStore(), archive=store), server.args)
+    assert server.calls["POST /measure"] == 2
+    assert len(server.uploads) == 1
+
+    sync(WithingsAccount(state=StateStore(), archive=store), server.args)
+    # only the height is fetched, the measurements come from the archive
+    assert server.calls["POST /measure"] == 3
+    assert len(server.uploads) == 2
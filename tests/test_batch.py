@@ -0,0 +1,182 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import batch
+from batch import load_accounts, sync_batch
+from payloads import DAY, START
+from state import StateStore
+from withings import WithingsAccount
+
+SYNC = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "src",
+    "sync.py",
+)
+
+
+@pytest.fixture
+def accounts_path(tmp_path):
+    path = tmp_path / "accounts.json"
+    path.write_text(
+        json.dumps(
+            [
+                {"environ": {"WITHINGS_USER_ID": "alice"}},
+                {"environ": {"WITHINGS_USER_ID": "bob"}},
+            ]
+        )
+    )
+    return str(path)
+
+
+def refresh_tokens(accounts_path):
+    return {
+        account["environ"]["WITHINGS_USER_ID"]: account["environ"].get(
+            "WITHINGS_REFRESH_TOKEN"
+        )
+        for account in load_accounts(accounts_path)
+    }
+
+
+def test_tokens_of_every_account_go_to_the_accounts_file(
+    server, accounts_path
+):
+    assert sync_batch(accounts_path, server.args, StateStore(), 1) == 0
+    assert len(server.uploads) == 2
+    # nothing is written to the secrets shared by the accounts
+    assert server.secrets == {}
+    tokens = refresh_tokens(accounts_path)
+    assert sorted(tokens) == ["alice", "bob"]
+    assert len(set(tokens.values())) == 2
+    assert all(token.startswith("refresh-") for token in tokens.values())
+
+
+def test_tokens_are_saved_when_the_sync_fails(
+    server, accounts_path, monkeypatch
+):
+    def failing_height(self):
+        # the accounts file already holds the rotated token
+        assert refresh_tokens(accounts_path)[self.account] is not None
+        raise ConnectionError("height failed")
+
+    monkeypatch.setattr(WithingsAccount, "get_height", failing_height)
+    assert sync_batch(accounts_path, server.args, StateStore(), 1) == 2
+    assert None not in refresh_tokens(accounts_path).values()
+
+
+def test_failed_window_is_resumed(server, accounts_path, monkeypatch):
+    state = StateStore()
+    server.args.chunk_days = 1
+    get_measurements = WithingsAccount.get_measurements
+
+    def failing(self, startdate, enddate):
+        if startdate <= START + 2 * DAY <= enddate:
+            return None
+        return get_measurements(self, startdate, enddate)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(WithingsAccount, "get_measurements", failing)
+        assert sync_batch(accounts_path, server.args, state, 1) == 2
+    # the windows of day 0 and 1 of both accounts
+    assert len(server.uploads) == 4
+    assert state.get("alice", "checkpoint") is not None
+
+    assert sync_batch(accounts_path, server.args, state, 1) == 0
+    assert len(server.uploads) == 8
+    assert state.get("alice", "checkpoint") is None
+
+
+def test_fit_cache_of_every_account(server, accounts_path, tmp_path):
+    server.args.fit_cache = str(tmp_path / "cache")
+    assert sync_batch(accounts_path, server.args, StateStore(), 1) == 0
+    # the same records are uploaded for both accounts
+    assert len(server.uploads) == 2
+    assert (tmp_path / "cache" / "alice").is_dir()
+
+    assert sync_batch(accounts_path, server.args, StateStore(), 1) == 0
+    assert len(server.uploads) == 2
+
+
+@pytest.mark.parametrize(
+    "environs",
+    [
+        [{"WITHINGS_USER_ID": "alice"}, {}],
+        [{"WITHINGS_USER_ID": "alice"}, {"WITHINGS_USER_ID": "alice"}],
+    ],
+)
+def test_every_account_needs_its_own_user_id(tmp_path, monkeypatch, environs):
+    # never taken from the environment shared by the accounts
+    monkeypatch.setenv("WITHINGS_USER_ID", "bob")
+    path = tmp_path / "accounts.json"
+    path.write_text(
+        json.dumps([{"environ": environ} for environ in environs])
+    )
+    with pytest.raises(ValueError):
+        load_accounts(str(path))
+
+
+def test_failed_accounts_fail_the_process(tmp_path):
+    path = tmp_path / "accounts.json"
+    # no Withings credentials in the environment of the process
+    path.write_text(json.dumps([{"environ": {"WITHINGS_USER_ID": "alice"}}]))
+    env = {
+        name: value
+        for name, value in os.environ.items()
+        if not name.startswith("WITHINGS_")
+    }
+    result = subprocess.run(
+        [sys.executable, SYNC, "--accounts", str(path), "--no-upload"],
+        capture_output=True,
+        text=True,
+        env=env,
+    )
+    assert result.returncode == 1
+    assert "Synced 0 of 1 accounts" in result.stdout + result.stderr
+
+
+@pytest.mark.parametrize("newest_first", [False, True])
+def test_windows_are_uploaded_while_the_next_ones_are_fetched(
+    server, accounts_path, monkeypatch, newest_first
+):
+    server.args.chunk_days = 1
+    server.args.newest_first = newest_first
+    get_measurements = WithingsAccount.get_measurements
+    uploads_before_fetch = []
+
+    def counting(self, startdate, enddate):
+        uploads_before_fetch.append(len(server.uploads))
+        return get_measurements(self, startdate, enddate)
+
+    monkeypatch.setattr(WithingsAccount, "get_measurements", counting)
+    assert sync_batch(accounts_path, server.args, StateStore(), 1) == 0
+    # the last windows are fetched after the first ones were uploaded
+    assert uploads_before_fetch[-1] > 0
+
+
+def test_accounts_synced_at_the_same_time_are_capped(tmp_path, monkeypatch):
+    path = tmp_path / "accounts.json"
+    path.write_text(
+        json.dumps(
+            [{"environ": {"WITHINGS_USER_ID": f"user-{i}"}} for i in range(6)]
+        )
+    )
+    active = []
+    peak = []
+    lock = threading.Lock()
+
+    def slow_sync(account, *args):
+        with lock:
+            active.append(account)
+            peak.append(len(active))
+        time.sleep(0.05)
+        with lock:
+            active.remove(account)
+
+    monkeypatch.setattr(batch, "sync_account", slow_sync)
+    assert sync_batch(str(path), None, jobs=2) == 0
+    assert max(peak) == 2
@@ -0,0 +1,57 @@
+import json
+
+import fitparse
+
+import run
+
+from payloads import PER_DAY, make_measuregrps
+
+
+def test_timeit_runs_setup_untimed_before_every_call():
+    calls = []
+    timings = run.timeit(calls.append, 3, setup=lambda: len(calls))
+    assert len(timings) == 3
+    assert calls == [0, 1, 2]
+
+
+def test_compare_prints_the_ratio_to_the_baseline(tmp_path, capsys):
+    baseline = tmp_path / "baseline.json"
+    baseline.write_text(
+        json.dumps({"results": {"10": {"prepare_syncdata": {"min": 2.0}}}})
+    )
+    results = {
+        "results": {
+            "10": {
+                "prepare_syncdata": {"min": 1.0},
+                "generate_fitdata": {"min": 1.0},
+            }
+        }
+    }
+    run.compare(results, baseline)
+    assert capsys.readouterr().out == "prepare_syncdata[10]: 0.50x of baseline\n"
+
+
+def test_payloads_are_reproducible_and_sorted():
+    groups = make_measuregrps(4 * PER_DAY)
+    assert groups == make_measuregrps(4 * PER_DAY)
+    dates = [group["date"] for group in groups]
+    assert dates == sorted(dates)
+
+
+def test_unfinished_encoder_writes_the_weight_records():
+    measuregrps = make_measuregrps(PER_DAY)
+    groups = [run.WithingsMeasureGroup(g) for g in measuregrps]
+    args = run.make_args(measuregrps)
+    _, _, syncdata = run.prepare_syncdata(1.8, groups, args)
+    fit = run.unfinished_weight_encoder(syncdata)
+    fit.finish()
+    fit_weight, _ = run.generate_fitdata(syncdata)
+
+    def weights(fit):
+        messages = fitparse.FitFile(fit.getvalue()).get_messages(
+            "weight_scale"
+        )
+        return [message.get_values() for message in messages]
+
+    assert len(weights(fit)) == 2
+    assert weights(fit) == weights(fit_weight)
@@ -0,0 +1,42 @@
+import pytest
+
+from concurrency import AdaptiveLimiter
+
+
+def test_limit_grows_by_about_one_per_round_trip():
+    limiter = AdaptiveLimiter("test", initial=4)
+    for _ in range(4):
+        limiter._release(0.01, False)
+    assert limiter.limit == pytest.approx(5, abs=0.1)
+
+
+def test_overload_cuts_the_limit_once_per_round_trip():
+    limiter = AdaptiveLimiter("test", initial=8)
+    limiter._release(0.01, True)
+    assert limiter.limit == 4
+    limiter._release(0.01, True)
+    assert limiter.limit == 4
+
+
+def test_overloaded_call_cuts_the_limit():
+    limiter = AdaptiveLimiter("test", initial=8)
+    with pytest.raises(ConnectionError):
+        with limiter.request():
+            raise ConnectionError("refused")
+    assert limiter.limit == 4
+    assert limiter.inflight == 0
+
+
+def test_latency_baseline_follows_a_slower_endpoint():
+    limiter = AdaptiveLimiter("test", initial=8, window=10)
+    for _ in range(10):
+        limiter._release(0.01, False)
+    # the endpoint is ten times slower from now on
+    for _ in range(50):
+        limiter._release(0.1, False)
+    assert limiter.min_latency == 0.1
+    limit = limiter.limit
+    for _ in range(20):
+        limiter._release(0.1, False)
+    # the new latency is the baseline, the limit grows again
+    assert limiter.limit > limit
@@ -0,0 +1,109 @@
+from types import SimpleNamespace
+
+import fitparse
+import pytest
+
+from payloads import make_measuregrps
+from utils import generate_fitdata, generate_fitdata_combined, prepare_syncdata
+from withings import WithingsMeasureGroup
+
+ARGS = SimpleNamespace(features=["BLOOD_PRESSURE"], merge_window=0)
+
+
+def syncdata(count=8, devices=("scale",)):
+    measuregrps = make_measuregrps(count)
+    for index, group in enumerate(measuregrps):
+        group["deviceid"] = devices[index % len(devices)]
+    groups = [WithingsMeasureGroup(g) for g in measuregrps]
+    return prepare_syncdata(1.8, groups, ARGS)[2]
+
+
+def message_names(fit):
+    # parsing also checks the CRC
+    return [m.name for m in fitparse.FitFile(fit.getvalue()).get_messages()]
+
+
+@pytest.mark.parametrize(
+    "mode, device_infos", [("record", 8), ("file", 1), ("device", 2)]
+)
+def test_device_info_modes(mode, device_infos):
+    fit = generate_fitdata_combined(
+        syncdata(devices=("scale", "cuff")), device_info=mode
+    )
+    assert message_names(fit).count("device_info") == device_infos
+
+
+def test_compact_leaves_out_the_fields_without_value():
+    records = syncdata()
+    full = generate_fitdata_combined(records)
+    compact = generate_fitdata_combined(records, compact=True)
+    assert compact.get_size() < full.get_size()
+
+    messages = fitparse.FitFile(compact.getvalue()).get_messages(
+        "weight_scale"
+    )
+    for message in messages:
+        fields = {field.name for field in message.fields}
+        assert "physique_rating" not in fields
+        assert message.get_value("weight")
+
+
+def test_combined_file_holds_both_kinds_once():
+    names = message_names(generate_fitdata_combined(syncdata()))
+    assert names.count("file_id") == 1
+    assert names.count("weight_scale") == 4
+    assert names.count("blood_pressure") == 4
+
+
+def test_separate_files_per_kind():
+    fit_weight, fit_blood_pressure = generate_fitdata(syncdata())
+    assert "blood_pressure" not in message_names(fit_weight)
+    assert "weight_scale" not in message_names(fit_blood_pressure)
+    assert generate_fitdata([]) == (None, None)
+    assert generate_fitdata_combined([]) is None
+
+
+def file_id(fit):
+    (message,) = fitparse.FitFile(fit.getvalue()).get_messages("file_id")
+    return message.get_value("serial_number"), message.get_value(
+        "time_created"
+    )
+
+
+def test_deterministic_file_ids_differ_by_records():
+    records = syncdata()
+    fit = generate_fitdata_combined(records, deterministic=True)
+    again = generate_fitdata_combined(syncdata(), deterministic=True)
+    assert fit.getvalue() == again.getvalue()
+
+    # an edited weight, the latest record is still the same
+    edited = [dict(record) for record in records]
+    edited[0]["weight"] += 1
+    other = generate_fitdata_combined(edited, deterministic=True)
+    assert file_id(other)[1] == file_id(fit)[1]
+    assert file_id(other)[0] != file_id(fit)[0]
+
+
+def test_measures_without_a_fit_field_are_synced_but_not_written():
+    measuregrps = make_measuregrps(1)
+    plain = prepare_syncdata(
+        1.8, [WithingsMeasureGroup(g) for g in measuregrps], ARGS
+    )[2]
+    measuregrps[0]["measures"] += [
+        {"type": 5, "value": 5600, "unit": -2},
+        {"type": 8, "value": 1500, "unit": -2},
+        {"type": 54, "value": 97, "unit": 0},
+        {"type": 71, "value": 3690, "unit": -2},
+    ]
+    (record,) = prepare_syncdata(
+        1.8, [WithingsMeasureGroup(g) for g in measuregrps], ARGS
+    )[2]
+    assert record["fat_free_mass"] == 56.0
+    assert record["fat_mass_weight"] == 15.0
+    assert record["spo2"] == 97
+    assert record["body_temperature"] == 36.9
+    options = {"deterministic": True}
+    assert (
+        generate_fitdata_combined([record], **options).getvalue()
+        == generate_fitdata_combined(plain, **options).getvalue()
+    )
@@ -0,0 +1,43 @@
+from fitcache import FitCache, records_key
+from state import StateStore
+from sync import sync
+from withings import WithingsAccount
+
+
+def test_records_key_only_hashes_the_fit_fields():
+    record = {"type": "weight", "timestamp": 1, "weight": 70.0}
+    key = records_key([record], compact=False)
+    raw = dict(record, raw_data=["measure"])
+    assert records_key([raw], compact=False) == key
+    assert records_key([dict(record, weight=70.1)], compact=False) != key
+    assert records_key([record], compact=True) != key
+
+
+def test_cache_holds_every_payload_once(tmp_path):
+    cache = FitCache(str(tmp_path))
+    assert cache.get("window") is None
+    cache.put("window", [("weight", b"fit"), ("blood pressure", b"fit")])
+    cache.put("other", [("weight", b"fit")])
+    assert cache.get("window") == [
+        ("weight", b"fit"),
+        ("blood pressure", b"fit"),
+    ]
+    assert len(list((tmp_path / "files").iterdir())) == 1
+
+    assert not cache.was_sent(b"fit")
+    cache.mark_sent(b"fit")
+    assert FitCache(str(tmp_path)).was_sent(b"fit")
+
+
+def test_unchanged_window_is_neither_encoded_nor_uploaded_again(
+    server, tmp_path, caplog
+):
+    server.args.fit_cache = str(tmp_path / "cache")
+    sync(WithingsAccount(state=StateStore()), server.args)
+    assert len(server.uploads) == 1
+
+    with caplog.at_level("INFO"):
+        sync(WithingsAccount(state=StateStore()), server.args)
+    assert len(server.uploads) == 1
+    assert "Reusing the cached fit files of unchanged records" in caplog.text
+    assert "1 fit file(s) were uploaded before, skipping them" in caplog.text
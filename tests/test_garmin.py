@@ -0,0 +1,40 @@
+import io
+
+from fake_servers import FakeServer
+from garmin import GarminConnect
+
+DAY = 86400
+START = 1700000000
+
+
+def test_garmin_connect_logs_in_and_uploads_through_the_client():
+    with FakeServer() as server:
+        garmin = GarminConnect()
+        garmin.login("user", "password")
+        garmin.upload_file(io.BytesIO(b"fit payload"))
+    assert garmin.logged_in
+    assert server.calls["POST /sso/login"] == 1
+    assert len(server.uploads) == 1
+    assert b"fit payload" in server.uploads[0]
+
+
+def test_get_existing_reads_both_ranges():
+    existing = [
+        ("weight", START),
+        ("blood_pressure", START + 60),
+        ("weight", START + 10 * DAY),
+    ]
+    with FakeServer(existing=existing) as server:
+        garmin = GarminConnect()
+        found = garmin.get_existing(START - DAY, START + DAY)
+    assert found == {"weight": {START}, "blood_pressure": {START + 60}}
+    assert server.calls["GET /weight-service/weight/range"] == 1
+    assert server.calls["GET /bloodpressure-service/bloodpressure/range"] == 1
+
+
+def test_the_fake_client_is_only_patched_while_the_server_runs():
+    import garth
+
+    with FakeServer():
+        pass
+    assert isinstance(GarminConnect().client, garth.Client)
@@ -0,0 +1,47 @@
+from types import SimpleNamespace
+
+import loadtest
+
+
+def load_args(**overrides):
+    return SimpleNamespace(
+        **dict(
+            {
+                "accounts": 3,
+                "concurrency": 2,
+                "groups": 8,
+                "latency": 0.0,
+                "error_rate": 0.0,
+                "rate_limit": None,
+                "page_size": 1000,
+            },
+            **overrides,
+        )
+    )
+
+
+def test_percentiles():
+    assert loadtest.percentiles([]) == {"p50": None, "p95": None, "p99": None}
+    assert loadtest.percentiles([2.0]) == {"p50": 2.0, "p95": 2.0, "p99": 2.0}
+    cuts = loadtest.percentiles([float(i) for i in range(101)])
+    assert cuts == {"p50": 50.0, "p95": 95.0, "p99": 99.0}
+
+
+def test_every_account_is_synced():
+    results = loadtest.run(load_args())
+    assert results["succeeded"] == 3
+    assert results["failed"] == 0
+    assert results["uploads"] == 3
+    # token refresh, height and measurements of every account
+    assert results["api_calls"]["POST /v2/oauth2"] == 3
+    assert results["api_calls"]["POST /measure"] == 6
+    assert results["latency"]["p50"] > 0
+    assert results["peak_memory_mb"] > 0
+
+
+def test_failed_accounts_are_reported():
+    results = loadtest.run(load_args(error_rate=1.0))
+    assert results["succeeded"] == 0
+    assert results["failed"] == 3
+    assert results["errors"]
+    assert results["latency"]["p50"] is None
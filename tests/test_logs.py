@@ -0,0 +1,61 @@
+import json
+import logging
+
+from types import SimpleNamespace
+
+from logs import JsonLinesFormatter, log_event
+from utils import prepare_syncdata
+from withings import WithingsMeasureGroup
+
+
+class Renders:
+    """a field that counts how often it is rendered"""
+
+    count = 0
+
+    def __str__(self):
+        Renders.count += 1
+        return "rendered"
+
+
+def test_log_event_is_not_rendered_when_disabled(caplog):
+    logger = logging.getLogger("test_logs")
+    Renders.count = 0
+    with caplog.at_level(logging.INFO, logger="test_logs"):
+        log_event(logger, logging.DEBUG, "skipped", value=Renders())
+    assert not caplog.records
+    assert Renders.count == 0
+
+
+def test_json_lines_formatter_keeps_event_fields(caplog):
+    logger = logging.getLogger("test_logs")
+    with caplog.at_level(logging.DEBUG, logger="test_logs"):
+        log_event(
+            logger, logging.DEBUG, "processed", timestamp=1700000000, weight=70.5
+        )
+    entry = json.loads(JsonLinesFormatter().format(caplog.records[0]))
+    assert entry["event"] == "processed"
+    assert entry["timestamp"] == 1700000000
+    assert entry["weight"] == 70.5
+    assert "message" not in entry
+
+
+def test_prepare_syncdata_logs_one_event_per_record(caplog):
+    groups = [
+        WithingsMeasureGroup(
+            {
+                "date": 1700000000 + i * 3600,
+                "measures": [{"type": 1, "value": 7000 + i, "unit": -2}],
+            }
+        )
+        for i in range(3)
+    ]
+    args = SimpleNamespace(features=[], merge_window=0)
+    with caplog.at_level(logging.DEBUG, logger="utils"):
+        prepare_syncdata(1.8, groups, args)
+    events = [
+        record.msg.event
+        for record in caplog.records
+        if hasattr(record.msg, "event")
+    ]
+    assert events == ["processed"] * 3 + ["prepared"]
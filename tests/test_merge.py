@@ -0,0 +1,95 @@
+from types import SimpleNamespace
+
+from payloads import make_measuregrps
+from utils import merge_records, prepare_syncdata, split_merge_cluster
+from withings import WithingsMeasureGroup
+
+ARGS = SimpleNamespace(features=["BLOOD_PRESSURE"], merge_window=0)
+
+
+def record(timestamp, kind="weight", **values):
+    return dict(
+        timestamp=timestamp,
+        deviceid=f"device-{timestamp}",
+        type=kind,
+        raw_data=[timestamp],
+        **values,
+    )
+
+
+def timestamps(records):
+    return [(r["type"], r["timestamp"]) for r in records]
+
+
+def test_merge_tolerance_is_inclusive():
+    merged = list(merge_records([record(0), record(60), record(121)], 60))
+    assert timestamps(merged) == [("weight", 0), ("weight", 121)]
+    assert merged[0]["raw_data"] == [0, 60]
+    # the window starts at the first record, it isn't chained
+    merged = merge_records([record(0), record(50), record(100)], 60)
+    assert timestamps(merged) == [("weight", 0), ("weight", 100)]
+
+
+def test_only_records_of_a_kind_merge():
+    merged = merge_records(
+        [record(0), record(1, "blood_pressure"), record(2)], 60
+    )
+    assert timestamps(merged) == [("weight", 0), ("blood_pressure", 1)]
+
+
+def test_latest_value_wins():
+    (merged,) = merge_records(
+        [
+            record(0, weight=70.0, fat_ratio=20.0),
+            record(5, weight=None, fat_ratio=21.0, bone_mass=3.0),
+            record(9, fat_ratio=None),
+        ],
+        60,
+    )
+    assert merged["weight"] == 70.0
+    assert merged["fat_ratio"] == 21.0
+    assert merged["bone_mass"] == 3.0
+    # the first record keeps its time and device
+    assert merged["timestamp"] == 0
+    assert merged["deviceid"] == "device-0"
+    assert merged["raw_data"] == [0, 5, 9]
+
+
+def test_merged_records_are_in_timestamp_order():
+    records = [
+        record(0),
+        record(10, "blood_pressure"),
+        record(50),
+        record(65, "blood_pressure"),
+        record(100),
+        record(200, "blood_pressure"),
+    ]
+    assert timestamps(merge_records(records, 60)) == [
+        ("weight", 0),
+        ("blood_pressure", 10),
+        ("weight", 100),
+        ("blood_pressure", 200),
+    ]
+
+
+def test_weight_and_blood_pressure_of_the_same_second_stay_apart():
+    measuregrps = make_measuregrps(2)
+    measuregrps[1]["date"] = measuregrps[0]["date"]
+    groups = [WithingsMeasureGroup(g) for g in measuregrps]
+    syncdata = prepare_syncdata(1.8, groups, ARGS)[2]
+    assert sorted(r["type"] for r in syncdata) == ["blood_pressure", "weight"]
+    weight = next(r for r in syncdata if r["type"] == "weight")
+    assert weight.get("systolic_blood_pressure") is None
+    assert len(weight["raw_data"]) == 6
+
+
+def test_split_merge_cluster():
+    groups = [SimpleNamespace(date=date) for date in (400, 0, 50, 200, 250)]
+    rest, chained = split_merge_cluster(groups, 60, 300)
+    assert [g.date for g in rest] == [0, 50, 400]
+    assert [g.date for g in chained] == [200, 250]
+    rest, chained = split_merge_cluster(groups, 60, 399)
+    assert [g.date for g in chained] == [400]
+    rest, chained = split_merge_cluster(groups, 60, 600)
+    assert len(rest) == 5
+    assert chained == []
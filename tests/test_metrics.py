@@ -0,0 +1,49 @@
+import json
+
+import pytest
+
+from metrics import Metrics
+
+
+def test_stage_counts_calls_and_time_even_on_errors():
+    metrics = Metrics()
+    with metrics.stage("withings.getmeas"):
+        pass
+    with pytest.raises(ValueError):
+        with metrics.stage("withings.getmeas"):
+            raise ValueError
+    stage = metrics.report()["stages"]["withings.getmeas"]
+    assert stage["calls"] == 2
+    assert stage["seconds"] >= 0
+
+
+def test_count_adds_up_per_stage():
+    metrics = Metrics()
+    metrics.count("garmin.upload", nbytes=100)
+    metrics.count("garmin.upload", nbytes=50, retries=1)
+    metrics.count("prepare", records=3)
+    stages = metrics.report()["stages"]
+    assert stages["garmin.upload"]["bytes"] == 150
+    assert stages["garmin.upload"]["retries"] == 1
+    assert stages["prepare"]["records"] == 3
+    assert stages["prepare"]["calls"] == 0
+
+
+def test_reset_starts_a_new_run():
+    metrics = Metrics()
+    metrics.count("prepare", records=3)
+    metrics.reset()
+    assert metrics.report()["stages"] == {}
+
+
+def test_report_files(tmp_path):
+    metrics = Metrics()
+    metrics.count("prepare", records=3)
+    metrics.write_report(tmp_path / "report.json")
+    metrics.write_prometheus(tmp_path / "metrics.prom")
+
+    report = json.loads((tmp_path / "report.json").read_text())
+    assert report["stages"]["prepare"]["records"] == 3
+    lines = (tmp_path / "metrics.prom").read_text().splitlines()
+    assert "# TYPE withings_sync_stage_records_total counter" in lines
+    assert 'withings_sync_stage_records_total{stage="prepare"} 3' in lines
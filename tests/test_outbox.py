@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+from outbox import Outbox
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    return Outbox(str(tmp_path / "outbox"), base_delay=60, max_delay=200)
+
+
+def test_put_keeps_one_entry_per_payload(outbox):
+    first = outbox.put(b"one", "weight")
+    assert outbox.put(b"one", "weight") == first
+    second = outbox.put(b"two", "blood pressure")
+    assert outbox.entries() == [first, second]
+    assert outbox.load(second) == b"two"
+
+
+def test_drain_uploads_and_removes(outbox):
+    outbox.put(b"one", "weight")
+    outbox.put(b"two", "blood pressure")
+    uploaded = []
+
+    def upload(payload, description):
+        uploaded.append((payload, description))
+
+    assert outbox.drain(upload) == 2
+    assert uploaded == [(b"one", "weight"), (b"two", "blood pressure")]
+    assert os.listdir(outbox.path) == []
+
+
+def test_drain_skips_a_failed_entry(outbox):
+    bad = outbox.put(b"bad", "weight")
+    outbox.put(b"good", "weight")
+
+    def upload(payload, description):
+        if payload == b"bad":
+            raise ConnectionError("rejected")
+
+    assert outbox.drain(upload) == 1
+    assert outbox.entries(due_only=False) == [bad]
+    # not due again before the backoff
+    assert outbox.entries() == []
+    meta = outbox._meta(bad)
+    assert meta["attempts"] == 1
+    assert meta["error"] == "rejected"
+
+
+def test_backoff_doubles_up_to_the_max(outbox):
+    entry_id = outbox.put(b"bad", "weight")
+    assert [outbox.failed(entry_id, "error") for _ in range(4)] == [
+        60,
+        120,
+        200,
+        200,
+    ]
+
+
+def test_remove_drops_the_payload_first(outbox, monkeypatch):
+    entry_id = outbox.put(b"one", "weight")
+    unlink = os.unlink
+
+    def crash_after_first(path):
+        unlink(path)
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(os, "unlink", crash_after_first)
+    with pytest.raises(KeyboardInterrupt):
+        outbox.remove(entry_id)
+    monkeypatch.undo()
+    assert os.listdir(outbox.path) == [entry_id + ".json"]
+
+    # drain drops the leftover metadata without uploading it again
+    uploaded = []
+    assert outbox.drain(lambda *entry: uploaded.append(entry)) == 0
+    assert uploaded == []
+    assert os.listdir(outbox.path) == []
@@ -0,0 +1,87 @@
+import io
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from output import JsonRecordWriter, open_record_writer, raw_measures
+from payloads import make_measuregrps
+from state import StateStore
+from sync import sync
+from utils import prepare_syncdata
+from withings import WithingsAccount, WithingsMeasureGroup
+
+ARGS = SimpleNamespace(features=["BLOOD_PRESSURE"], merge_window=0)
+
+
+def records(count=4):
+    groups = [WithingsMeasureGroup(g) for g in make_measuregrps(count)]
+    return prepare_syncdata(1.8, groups, ARGS)[2]
+
+
+def test_raw_measures_keep_every_measure():
+    record = records(1)[0]
+    # e.g. a record merged from two weigh-ins
+    record["raw_data"] = record["raw_data"] * 2
+    measures = raw_measures(record)
+    assert isinstance(measures, list)
+    assert len(measures) == 12
+    assert measures[0]["Weight"]["Unit"] == "kg"
+    assert measures[0] == measures[6]
+
+
+def test_json_array_and_lines():
+    fp = io.StringIO()
+    writer = JsonRecordWriter(fp)
+    writer.write(records())
+    writer.close()
+    rows = json.loads(fp.getvalue())
+    assert [row["type"] for row in rows] == ["weight", "blood_pressure"] * 2
+    assert isinstance(rows[1]["measures"], list)
+
+    fp = io.StringIO()
+    writer = JsonRecordWriter(fp, lines=True)
+    writer.write(records())
+    writer.write([])
+    writer.close()
+    lines = fp.getvalue().splitlines()
+    assert [json.loads(line) for line in lines] == rows
+
+
+def test_resumed_sync_only_writes_the_windows_left(
+    server, monkeypatch, fail_window
+):
+    state = StateStore()
+    server.args.chunk_days = 1
+    fp = io.StringIO()
+    with monkeypatch.context() as patch:
+        fail_window(patch, 2)
+        with pytest.raises(ConnectionError):
+            sync(
+                WithingsAccount(state=state),
+                server.args,
+                output=JsonRecordWriter(fp, lines=True),
+            )
+    assert len(fp.getvalue().splitlines()) == 8
+
+    fp = io.StringIO()
+    sync(
+        WithingsAccount(state=state),
+        server.args,
+        output=JsonRecordWriter(fp, lines=True),
+    )
+    assert len(fp.getvalue().splitlines()) == 8
+
+
+def test_arrow_keeps_the_integer_columns(tmp_path):
+    pa = pytest.importorskip("pyarrow")
+    path = str(tmp_path / "records.arrow")
+    writer = open_record_writer("arrow", path)
+    writer.write(records())
+    writer.close()
+    table = pa.ipc.open_file(path).read_all()
+    assert table.num_rows == 4
+    assert table.schema.field("heart_pulse").type == pa.int64()
+    assert table.schema.field("visceral_fat_rating").type == pa.int64()
+    assert table.schema.field("weight").type == pa.float64()
+    assert table.column("systolic_blood_pressure").null_count == 2
@@ -0,0 +1,76 @@
+import time
+from types import SimpleNamespace
+
+import profiling
+from profiling import Profiler, collapsed_stacks
+
+SELF_TIME = 0.001
+
+
+def call_graph(layers, width):
+    """pstats-like stats of one root calling `width` functions, each of
+    them calling every function of the next layer, `layers` deep"""
+    graph = [[("graph.py", 0, "root")]] + [
+        [("graph.py", layer * width + i, f"f{layer}") for i in range(width)]
+        for layer in range(1, layers)
+    ]
+    stats = {}
+    for layer, functions in enumerate(graph):
+        # a call of a function takes its own time and the layers below
+        cumtime = SELF_TIME * (layers - layer)
+        if layer == 0:
+            cumtime = SELF_TIME + width * SELF_TIME * (layers - 1)
+        callers = graph[layer - 1] if layer else []
+        for func in functions:
+            edge = (1, 1, 0.0, cumtime / len(callers or [None]))
+            stats[func] = (
+                1,
+                1,
+                SELF_TIME,
+                cumtime,
+                {caller: edge for caller in callers},
+            )
+    return SimpleNamespace(stats=stats)
+
+
+def total_us(lines):
+    return sum(int(line.rsplit(" ", 1)[1]) for line in lines)
+
+
+def test_dense_call_graph_is_pruned():
+    # 10**11 call paths
+    stats = call_graph(12, 10)
+    start = time.perf_counter()
+    lines = collapsed_stacks(stats)
+    assert time.perf_counter() - start < 5
+    # the pruned calls count for their callers
+    assert total_us(lines) == (1 + 10 * 11) * 1000
+
+
+def test_deep_stacks_are_cut(monkeypatch):
+    monkeypatch.setattr(profiling, "MAX_DEPTH", 5)
+    stats = call_graph(10, 1)
+    lines = collapsed_stacks(stats)
+    assert max(line.count(";") for line in lines) == 4
+    # the calls below the cut count for the deepest frame
+    assert lines[-1].endswith(" 6000")
+    assert total_us(lines) == 10 * 1000
+
+
+def test_profiler_writes_the_phases(tmp_path):
+    profiler = Profiler()
+    profiler.start()
+    try:
+        with profiler.stage("prepare"):
+            sorted(range(10000), key=lambda i: -i)
+        with profiler.stage("garmin.login"):
+            pass
+    finally:
+        profiler.stop()
+    profiler.write(str(tmp_path))
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "profile-prepare.collapsed",
+        "profile-prepare.pstats",
+        "profile.json",
+    ]
+    assert profiler.summary()["prepare"]["peak_bytes"] > 0
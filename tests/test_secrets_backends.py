@@ -0,0 +1,92 @@
+import base64
+import logging
+import os
+import subprocess
+import sys
+
+import pytest
+
+from secrets_backends import (
+    EnvSecretBackend,
+    FileSecretBackend,
+    open_secret_backend,
+)
+from withings import WithingsAccount
+
+SYNC = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "src",
+    "sync.py",
+)
+
+
+def test_open_secret_backend():
+    environ = {"WITHINGS_SECRETS_KEY": base64.b64encode(bytes(32))}
+    assert isinstance(
+        open_secret_backend("file:tokens", environ, None), FileSecretBackend
+    )
+    assert isinstance(open_secret_backend("env", {}, None), EnvSecretBackend)
+    backend = EnvSecretBackend({})
+    assert open_secret_backend(backend, {}, None) is backend
+    with pytest.raises(ValueError):
+        open_secret_backend("vault", {}, None)
+    with pytest.raises(AttributeError):
+        open_secret_backend("github", {}, None)
+
+
+def test_file_backend_keeps_the_tokens_of_every_account(tmp_path):
+    key = base64.b64encode(os.urandom(32))
+    path = str(tmp_path / "tokens")
+    FileSecretBackend(path, key).save("alice", {"WITHINGS_REFRESH_TOKEN": "a"})
+    FileSecretBackend(path, key).save("bob", {"WITHINGS_REFRESH_TOKEN": "b"})
+    backend = FileSecretBackend(path, key)
+    assert backend.load("alice") == {"WITHINGS_REFRESH_TOKEN": "a"}
+    assert backend.load("carol") == {}
+
+
+def test_env_backend_keeps_the_tokens_in_a_dotenv_file(server, tmp_path):
+    path = tmp_path / ".env"
+    path.write_text("GARMIN_USERNAME=alice\nWITHINGS_REFRESH_TOKEN=old\n")
+    withings = WithingsAccount(secrets=f"env:{path}")
+    refresh_token = withings.withings.user_config["refresh_token"]
+    assert refresh_token.startswith("refresh-")
+    lines = path.read_text().splitlines()
+    assert lines[0] == "GARMIN_USERNAME=alice"
+    assert f"WITHINGS_REFRESH_TOKEN={refresh_token}" in lines
+    assert len(lines) == 3
+    assert EnvSecretBackend(str(path)).load("alice") == {
+        "WITHINGS_ACCESS_TOKEN": withings.withings.user_config[
+            "access_token"
+        ],
+        "WITHINGS_REFRESH_TOKEN": refresh_token,
+    }
+    assert path.stat().st_mode & 0o077 == 0
+
+
+def test_github_backend_logs_the_secret_names(server, caplog):
+    with caplog.at_level(logging.INFO, logger="secrets_backends"):
+        WithingsAccount(secrets="github")
+    assert set(server.secrets) == {
+        "WITHINGS_ACCESS_TOKEN",
+        "WITHINGS_REFRESH_TOKEN",
+    }
+    updates = [
+        record.args
+        for record in caplog.records
+        if record.msg == "Updating secret: %s for repository: %s"
+    ]
+    assert sorted(updates) == [
+        ("WITHINGS_ACCESS_TOKEN", "owner/repo"),
+        ("WITHINGS_REFRESH_TOKEN", "owner/repo"),
+    ]
+
+
+@pytest.mark.parametrize("option", ["--accounts", "--queue"])
+def test_shared_backend_is_rejected_with_several_accounts(option):
+    result = subprocess.run(
+        [sys.executable, SYNC, option, "accounts.json", "--secrets", "github"],
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 2
+    assert "--secrets syncs a single account" in result.stderr
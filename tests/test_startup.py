@@ -0,0 +1,7 @@
+import startup
+
+
+def test_importing_sync_defers_the_heavy_dependencies():
+    loaded = {name.split(".")[0] for name in startup.import_times("sync")}
+    assert "sync" in loaded
+    assert not loaded & set(startup.DEFERRED)
@@ -0,0 +1,40 @@
+import pytest
+
+from state import (
+    FileStateStore,
+    SQLiteStateStore,
+    StateStore,
+    open_state_store,
+)
+
+
+@pytest.mark.parametrize("name", ["state.json", "state.db"])
+def test_state_survives_a_reopen(tmp_path, name):
+    path = str(tmp_path / name)
+    state = open_state_store(path)
+    state.set("alice", "last_sync", 1700000000)
+    state.set("alice", "checkpoint", {"start": 1, "done": [[1, 2]]})
+    state.set("bob", "last_sync", 1600000000)
+
+    state = open_state_store(path)
+    assert state.get("alice", "last_sync") == 1700000000
+    assert state.get("alice", "checkpoint") == {"start": 1, "done": [[1, 2]]}
+    assert state.get("bob", "last_sync") == 1600000000
+    assert state.get("carol", "last_sync", 0) == 0
+
+
+@pytest.mark.parametrize("name", ["state.json", "state.db"])
+def test_none_removes_a_value(tmp_path, name):
+    path = str(tmp_path / name)
+    state = open_state_store(path)
+    state.set("alice", "checkpoint", {"start": 1})
+    state.set("alice", "checkpoint", None)
+    assert open_state_store(path).get("alice", "checkpoint") is None
+
+
+def test_open_state_store_picks_the_backend(tmp_path):
+    assert type(open_state_store()) is StateStore
+    assert isinstance(open_state_store(str(tmp_path / "s.json")), FileStateStore)
+    assert isinstance(
+        open_state_store(str(tmp_path / "s.sqlite")), SQLiteStateStore
+    )
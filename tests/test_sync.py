@@ -0,0 +1,172 @@
+import io
+import json
+from datetime import datetime
+
+import pytest
+
+from output import JsonRecordWriter
+from payloads import DAY, START
+from state import StateStore
+from sync import missing_ranges, split_range, sync
+from withings import WithingsAccount
+
+
+def test_split_range():
+    assert split_range(0, 99, 0) == [(0, 99)]
+    assert split_range(0, 2 * DAY, 1) == [
+        (0, DAY - 1),
+        (DAY, 2 * DAY - 1),
+        (2 * DAY, 2 * DAY),
+    ]
+    assert split_range(0, 2 * DAY, 1, newest_first=True) == [
+        (DAY + 1, 2 * DAY),
+        (1, DAY),
+        (0, 0),
+    ]
+
+
+def test_failed_window_stops_the_run_and_is_fetched_again(
+    server, monkeypatch, fail_window
+):
+    state = StateStore()
+    server.args.chunk_days = 1
+    with monkeypatch.context() as patch:
+        fail_window(patch, 2)
+        with pytest.raises(ConnectionError):
+            sync(WithingsAccount(state=state), server.args)
+    # the windows of day 0 and 1
+    assert len(server.uploads) == 2
+
+    sync(WithingsAccount(state=state), server.args)
+    # only the windows of day 2 and 3 are uploaded again
+    assert len(server.uploads) == 4
+
+
+def test_failed_window_does_not_move_the_last_sync(
+    server, monkeypatch, fail_window
+):
+    state = StateStore()
+    server.args.chunk_days = 1
+    server.args.fromdate = None
+    withings = WithingsAccount(state=state)
+    state.set(withings.account, "last_sync", START - 1)
+    fail_window(monkeypatch, 2)
+    with pytest.raises(ConnectionError):
+        sync(withings, server.args)
+    assert START + DAY < state.get(withings.account, "last_sync")
+    assert state.get(withings.account, "last_sync") < START + 2 * DAY
+
+
+def test_single_window_by_default(server):
+    server.args.chunk_days = 0
+    sync(WithingsAccount(), server.args)
+    assert len(server.uploads) == 1
+    assert server.calls["POST /measure"] == 2
+
+
+def test_window_on_garmin_already_is_synced(server):
+    state = StateStore()
+    server.args.chunk_days = 1
+    server.args.fromdate = None
+    server.args.reconcile = True
+    server.existing = [
+        ("weight" if group["grpid"] % 2 else "blood_pressure", group["date"])
+        for group in server.measuregrps
+    ]
+    withings = WithingsAccount(state=state)
+    state.set(withings.account, "last_sync", START - 1)
+    sync(withings, server.args)
+    assert not server.uploads
+    last_date = server.measuregrps[-1]["date"]
+    assert state.get(withings.account, "last_sync") == last_date
+    assert state.get(withings.account, "checkpoint") is None
+
+
+def test_missing_ranges():
+    assert missing_ranges(0, 99, []) == [(0, 99)]
+    assert missing_ranges(0, 99, [[0, 49]]) == [(50, 99)]
+    assert missing_ranges(0, 99, [[20, 29], [60, 120]]) == [
+        (0, 19),
+        (30, 59),
+    ]
+    assert missing_ranges(0, 99, [[0, 99]]) == []
+
+
+def test_interrupted_newest_first_sync_resumes_on_a_later_day(
+    server, monkeypatch, fail_window
+):
+    state = StateStore()
+    server.args.chunk_days = 1
+    server.args.newest_first = True
+    server.args.fromdate = None
+    server.args.todate = datetime.fromtimestamp(START + 2 * DAY)
+    withings = WithingsAccount(state=state)
+    state.set(withings.account, "last_sync", START - 1)
+    with monkeypatch.context() as patch:
+        fail_window(patch, 0)
+        with pytest.raises(ConnectionError):
+            sync(withings, server.args)
+    # the windows of day 2 and 1, the last sync waits for day 0
+    assert len(server.uploads) == 2
+    assert state.get(withings.account, "last_sync") == START - 1
+
+    # the next day, the same start but a later end
+    server.args.todate = datetime.fromtimestamp(START + 3 * DAY)
+    sync(WithingsAccount(state=state), server.args)
+    # only the windows of day 3 and 0
+    assert len(server.uploads) == 4
+    last_date = server.measuregrps[-1]["date"]
+    assert state.get(withings.account, "last_sync") == last_date
+    assert state.get(withings.account, "checkpoint") is None
+
+
+@pytest.mark.parametrize("newest_first", [False, True])
+def test_weigh_in_split_by_a_window_boundary_is_merged(
+    server, monkeypatch, fail_window, newest_first
+):
+    # the weight a little before midnight, the body composition after it
+    for grpid, date, measure in [
+        (100, START + DAY - 5, {"type": 1, "value": 7000, "unit": -2}),
+        (101, START + DAY + 5, {"type": 6, "value": 200, "unit": -1}),
+    ]:
+        server.measuregrps.append(
+            {
+                "grpid": grpid,
+                "attrib": 0,
+                "date": date,
+                "created": date,
+                "modified": date,
+                "category": 1,
+                "deviceid": "scale",
+                "measures": [measure],
+            }
+        )
+    server.measuregrps.sort(key=lambda group: group["date"])
+    # windows from midnight to midnight in both orders
+    server.args.todate = datetime.fromtimestamp(START + 3 * DAY)
+    server.args.chunk_days = 1
+    server.args.merge_window = 60
+    server.args.newest_first = newest_first
+    state = StateStore()
+    fp = io.StringIO()
+    with monkeypatch.context() as patch:
+        # the window after the boundary, or before it with newest first
+        fail_window(patch, 0 if newest_first else 1)
+        with pytest.raises(ConnectionError):
+            sync(
+                WithingsAccount(state=state),
+                server.args,
+                output=JsonRecordWriter(fp, lines=True),
+            )
+    sync(
+        WithingsAccount(state=state),
+        server.args,
+        output=JsonRecordWriter(fp, lines=True),
+    )
+
+    rows = [json.loads(line) for line in fp.getvalue().splitlines()]
+    assert len(rows) == 17
+    assert len({row["timestamp"] for row in rows}) == 17
+    (merged,) = [row for row in rows if row["timestamp"] == START + DAY - 5]
+    assert merged["weight"] == 70.0
+    assert merged["fat_ratio"] == 20.0
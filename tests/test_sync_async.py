@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+from outbox import Outbox
+from payloads import DAY, START
+from secrets_backends import GitHubSecretBackend
+from state import StateStore
+from sync import sync_async
+from withings import WithingsAccount
+
+SYNC = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "src",
+    "sync.py",
+)
+
+
+def test_sync_async_uploads(server):
+    assert asyncio.run(sync_async(server.args)) == 0
+    assert len(server.uploads) == 1
+    assert set(server.secrets) == {
+        "WITHINGS_ACCESS_TOKEN",
+        "WITHINGS_REFRESH_TOKEN",
+    }
+
+
+def test_failed_step_is_raised_after_the_secret_update(server, monkeypatch):
+    save = GitHubSecretBackend.save
+
+    def slow_save(self, account, secrets):
+        time.sleep(0.2)
+        save(self, account, secrets)
+
+    def failing_height(self):
+        raise ConnectionError("height failed")
+
+    monkeypatch.setattr(GitHubSecretBackend, "save", slow_save)
+    monkeypatch.setattr(WithingsAccount, "get_height", failing_height)
+
+    async def run():
+        try:
+            await sync_async(server.args)
+        except ConnectionError:
+            # the secrets are saved by the time the error surfaces
+            return dict(server.secrets)
+
+    assert len(asyncio.run(run())) == 2
+    assert not server.uploads
+
+
+def test_no_garmin_username_is_not_confused_with_no_files(server, caplog):
+    server.args.garmin_username = None
+    with caplog.at_level(logging.INFO):
+        asyncio.run(sync_async(server.args))
+    assert "No Garmin username - skipping sync" in caplog.messages
+
+    server.args.garmin_username = "user"
+    server.args.reconcile = True
+    server.existing = [
+        ("weight" if group["grpid"] % 2 else "blood_pressure", group["date"])
+        for group in server.measuregrps
+    ]
+    caplog.clear()
+    with caplog.at_level(logging.INFO):
+        asyncio.run(sync_async(server.args))
+    assert "No Garmin username - skipping sync" not in caplog.messages
+    assert "No new measurements to upload" in caplog.messages
+    assert not server.uploads
+
+
+def test_records_on_garmin_already_advance_the_last_sync(server):
+    state = StateStore()
+    server.args.fromdate = None
+    server.args.reconcile = True
+    server.existing = [
+        ("weight" if group["grpid"] % 2 else "blood_pressure", group["date"])
+        for group in server.measuregrps
+    ]
+    withings = WithingsAccount(update_secrets=False, state=state)
+    state.set(withings.account, "last_sync", START - 1)
+    asyncio.run(sync_async(server.args, state=state))
+    assert not server.uploads
+    last_date = server.measuregrps[-1]["date"]
+    assert state.get(withings.account, "last_sync") == last_date
+
+
+def test_outbox_is_drained_without_new_measurements(server, tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox"))
+    outbox.put(b"left over", "weight")
+    # a range without measurements
+    server.args.fromdate = datetime.fromtimestamp(START - 10 * DAY)
+    server.args.todate = datetime.fromtimestamp(START - 5 * DAY)
+    assert asyncio.run(sync_async(server.args, outbox=outbox)) is None
+    assert len(server.uploads) == 1
+    assert outbox.entries(due_only=False) == []
+
+
+def test_windows_are_rejected():
+    result = subprocess.run(
+        [sys.executable, SYNC, "--async", "--chunk-days", "1"],
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 2
+    assert "--async syncs the range in one window" in result.stderr
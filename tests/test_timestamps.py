@@ -0,0 +1,45 @@
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import fitparse
+
+from fit import FIT_EPOCH, FitEncoder
+from payloads import make_measuregrps
+from utils import generate_fitdata_combined, prepare_syncdata
+from withings import WithingsMeasureGroup
+
+ARGS = SimpleNamespace(features=["BLOOD_PRESSURE"], merge_window=0)
+
+
+def test_fit_timestamps_count_from_the_fit_epoch():
+    fit = FitEncoder()
+    assert fit.timestamp(FIT_EPOCH + 10) == 10
+    moment = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    assert fit.timestamp(moment) == fit.timestamp(int(moment.timestamp()))
+
+
+def test_records_keep_the_epoch_timestamps_of_their_groups():
+    measuregrps = make_measuregrps(8)
+    groups = [WithingsMeasureGroup(g) for g in measuregrps]
+    _, last_timestamp, syncdata = prepare_syncdata(1.8, groups, ARGS)
+    timestamps = [record["timestamp"] for record in syncdata]
+    assert timestamps == [g["date"] for g in measuregrps]
+    assert all(type(timestamp) is int for timestamp in timestamps)
+    assert last_timestamp == measuregrps[-1]["date"]
+
+
+def test_fit_messages_carry_the_utc_time():
+    measuregrps = make_measuregrps(4)
+    groups = [WithingsMeasureGroup(g) for g in measuregrps]
+    _, _, syncdata = prepare_syncdata(1.8, groups, ARGS)
+    fit = generate_fitdata_combined(syncdata)
+
+    messages = fitparse.FitFile(fit.getvalue()).get_messages()
+    times = [
+        message.get_value("timestamp")
+        for message in messages
+        if message.name in ("weight_scale", "blood_pressure")
+    ]
+    assert [
+        int(t.replace(tzinfo=timezone.utc).timestamp()) for t in times
+    ] == [g["date"] for g in measuregrps]
@@ -0,0 +1,55 @@
+import time
+
+import pytest
+
+from fake_servers import FakeServer
+from payloads import make_measuregrps
+from withings import MAX_BACKOFF, MAX_RETRIES, WithingsAccount
+
+
+@pytest.fixture
+def delays(monkeypatch):
+    """the backoff delays, without sleeping"""
+    delays = []
+    monkeypatch.setattr(time, "sleep", delays.append)
+    return delays
+
+
+def fetch_rate_limited(delays, **options):
+    with FakeServer(measuregrps=make_measuregrps(8), **options) as server:
+        withings = WithingsAccount(environ=server.environ())
+        # only the fetches are rate limited, not the token refresh
+        server.rate_limit = 0
+        return withings.get_measurements(startdate=0, enddate=2**31)
+
+
+def test_getmeas_follows_the_pages():
+    with FakeServer(measuregrps=make_measuregrps(25), page_size=10) as server:
+        withings = WithingsAccount(environ=server.environ())
+        groups = withings.get_measurements(startdate=0, enddate=2**31)
+    assert len(groups) == 25
+    assert server.calls["POST /measure"] == 3
+
+
+def test_getmeas_gives_up_after_the_retries(delays):
+    assert fetch_rate_limited(delays) is None
+    assert delays == [2**retry for retry in range(1, MAX_RETRIES + 1)]
+
+
+def test_getmeas_honours_retry_after(delays):
+    fetch_rate_limited(delays, retry_after=1)
+    assert delays == [1] * MAX_RETRIES
+
+
+def test_getmeas_caps_the_backoff(delays):
+    fetch_rate_limited(delays, retry_after=3600)
+    assert delays == [MAX_BACKOFF] * MAX_RETRIES
+
+
+def test_getmeas_retries_server_errors(delays):
+    with FakeServer(measuregrps=make_measuregrps(8)) as server:
+        withings = WithingsAccount(environ=server.environ())
+        server.error_rate = 1.0
+        assert withings.get_measurements(startdate=0, enddate=2**31) is None
+    assert len(delays) == MAX_RETRIES
+    assert server.calls["POST /measure"] == MAX_RETRIES + 1
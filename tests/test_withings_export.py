@@ -0,0 +1,85 @@
+import time
+import zipfile
+
+import pytest
+
+from withings_export import WithingsExport, to_measure
+
+WEIGHT_CSV = """Date,Weight (kg),Fat mass (kg),Bone mass (kg),Muscle mass (kg),Hydration (kg),Comments
+2024-01-03 07:00:00,80.0,20.0,3.1,57.2,42.0,
+2024-01-02 07:00:00,80.5,,,,,
+2024-01-01 07:00:00,81.0,20.5,3.1,57.0,42.1,
+broken,81.0,,,,,
+"""
+BP_CSV = """Date,Heart rate,Systolic,Diastolic,Comments
+2024-01-02 08:00:00,60,120,80,
+"""
+HEIGHT_CSV = """Date,Value (m)
+2020-01-01 00:00:00,1.80
+2023-01-01 00:00:00,1.82
+"""
+
+
+def epoch(text):
+    return int(time.mktime(time.strptime(text, "%Y-%m-%d %H:%M:%S")))
+
+
+@pytest.fixture
+def export(tmp_path):
+    path = tmp_path / "export.zip"
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("data/weight.csv", WEIGHT_CSV)
+        archive.writestr("data/bp.csv", BP_CSV)
+        archive.writestr("data/height.csv", HEIGHT_CSV)
+    with WithingsExport(str(path)) as export:
+        yield export
+
+
+def test_to_measure_keeps_the_decimals():
+    assert to_measure(1, "80.25") == {"type": 1, "value": 8025, "unit": -2}
+    assert to_measure(1, "") is None
+    assert to_measure(1, None) is None
+    assert to_measure(1, "nan") is None
+
+
+def test_latest_height(export):
+    assert export.get_height() == 1.82
+
+
+def test_groups_in_chunks_and_range(export):
+    chunks = list(export.iter_groups(chunk_size=2))
+    assert [len(chunk) for chunk in chunks] == [2, 1, 1]
+
+    groups = [group for chunk in chunks for group in chunk]
+    assert [group.date for group in groups] == [
+        epoch("2024-01-03 07:00:00"),
+        epoch("2024-01-02 07:00:00"),
+        epoch("2024-01-01 07:00:00"),
+        epoch("2024-01-02 08:00:00"),
+    ]
+    assert groups[0].get_weight() == 80.0
+    # the fat ratio is derived from the fat mass
+    assert groups[0].get_fat_ratio() == 25.0
+    assert groups[1].get_fat_ratio() is None
+    assert groups[3].get_systolic_blood_pressure() == 120
+
+    start = epoch("2024-01-02 00:00:00")
+    end = epoch("2024-01-02 23:59:59")
+    dates = [
+        group.date
+        for chunk in export.iter_groups(start, end)
+        for group in chunk
+    ]
+    assert dates == [
+        epoch("2024-01-02 07:00:00"),
+        epoch("2024-01-02 08:00:00"),
+    ]
+
+
+def test_missing_files_are_skipped(tmp_path):
+    path = tmp_path / "export.zip"
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("weight.csv", WEIGHT_CSV)
+    with WithingsExport(str(path)) as export:
+        assert export.get_height() is None
+        assert sum(len(chunk) for chunk in export.iter_groups()) == 3
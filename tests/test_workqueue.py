@@ -0,0 +1,161 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import workqueue
+from batch import QueueSecretBackend, run_worker
+from workqueue import LeaseLost, WorkQueue
+from withings import WithingsAccount
+
+SYNC = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "src",
+    "sync.py",
+)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(workqueue.time, "time", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return WorkQueue(str(tmp_path / "queue.db"), lease_seconds=60)
+
+
+def test_failed_job_is_retried_after_a_backoff(queue, clock):
+    queue.enqueue(["alice"])
+    assert queue.claim("w1") == "alice"
+    assert queue.complete("alice", "w1", "failed")
+    assert queue.claim("w1") is None
+    clock[0] += workqueue.RETRY_SECONDS
+    assert queue.claim("w1") == "alice"
+    assert queue.complete("alice", "w1", "failed")
+    # the second failure waits twice as long
+    clock[0] += workqueue.RETRY_SECONDS
+    assert queue.claim("w1") is None
+    clock[0] += workqueue.RETRY_SECONDS
+    assert queue.claim("w1") == "alice"
+    assert queue.complete("alice", "w1")
+    assert queue.claim("w1") is None
+
+
+def test_tokens_are_only_saved_by_the_owner(queue, clock):
+    queue.enqueue(["alice"])
+    queue.claim("w1")
+    assert queue.set_tokens("alice", "w1", {"WITHINGS_REFRESH_TOKEN": "a"})
+    # the lease ran out and another worker took over
+    clock[0] += 61
+    assert queue.claim("w2") == "alice"
+    assert not queue.set_tokens("alice", "w1", {"WITHINGS_REFRESH_TOKEN": "b"})
+    assert queue.get_tokens("alice") == {"WITHINGS_REFRESH_TOKEN": "a"}
+
+    with pytest.raises(LeaseLost):
+        QueueSecretBackend(queue, "w1").save("alice", {})
+
+
+def test_check_raises_once_the_lease_is_lost(queue, clock):
+    queue.enqueue(["alice"])
+    queue.claim("w1")
+    with queue.lease("alice", "w1") as lease:
+        lease.check()
+        clock[0] += 61
+        queue.claim("w2")
+        with pytest.raises(LeaseLost):
+            lease.check()
+        assert lease.lost
+
+
+def test_duplicated_accounts_are_not_queued(queue, tmp_path):
+    with pytest.raises(ValueError):
+        queue.enqueue(["alice", "bob", "alice"])
+    assert queue.claim("w1") is None
+
+    accounts_path = tmp_path / "accounts.json"
+    accounts_path.write_text(
+        json.dumps([{"environ": {"WITHINGS_USER_ID": "alice"}}] * 2)
+    )
+    with pytest.raises(ValueError):
+        run_worker(queue.path, str(accounts_path), None, 1, True)
+    assert queue.claim("w1") is None
+
+
+def test_worker_saves_the_tokens_in_the_queue(server, tmp_path):
+    accounts_path = tmp_path / "accounts.json"
+    accounts_path.write_text(
+        json.dumps(
+            [
+                {"environ": {"WITHINGS_USER_ID": "alice"}},
+                {"environ": {"WITHINGS_USER_ID": "bob"}},
+            ]
+        )
+    )
+    server.args.state = None
+    queue_path = str(tmp_path / "queue.db")
+    failed = run_worker(queue_path, str(accounts_path), server.args, 1, True)
+    assert failed == 0
+    assert len(server.uploads) == 2
+    assert server.secrets == {}
+    queue = WorkQueue(queue_path)
+    tokens = {
+        queue.get_tokens(account)["WITHINGS_REFRESH_TOKEN"]
+        for account in ("alice", "bob")
+    }
+    assert len(tokens) == 2
+
+
+def test_worker_stops_once_the_lease_is_lost(server, tmp_path, monkeypatch):
+    accounts_path = tmp_path / "accounts.json"
+    accounts_path.write_text(
+        json.dumps([{"environ": {"WITHINGS_USER_ID": "alice"}}])
+    )
+    server.args.state = None
+    queue_path = str(tmp_path / "queue.db")
+    get_height = WithingsAccount.get_height
+
+    def taken_over(self):
+        # the lease runs out and another worker claims the account
+        other = WorkQueue(queue_path)
+        other._update("UPDATE jobs SET lease_until = 0")
+        assert other.claim("other") == "alice"
+        return get_height(self)
+
+    monkeypatch.setattr(WithingsAccount, "get_height", taken_over)
+    failed = run_worker(queue_path, str(accounts_path), server.args, 1, True)
+    assert failed == 1
+    assert not server.uploads
+
+
+def test_failed_jobs_fail_the_worker_process(tmp_path):
+    accounts_path = tmp_path / "accounts.json"
+    accounts_path.write_text(
+        json.dumps([{"environ": {"WITHINGS_USER_ID": "alice"}}])
+    )
+    # no Withings credentials in the environment of the process
+    env = {
+        name: value
+        for name, value in os.environ.items()
+        if not name.startswith("WITHINGS_")
+    }
+    result = subprocess.run(
+        [
+            sys.executable,
+            SYNC,
+            "--accounts",
+            str(accounts_path),
+            "--queue",
+            str(tmp_path / "queue.db"),
+            "--enqueue",
+            "--no-upload",
+        ],
+        capture_output=True,
+        text=True,
+        env=env,
+    )
+    assert result.returncode == 1